@@ -1,5 +1,25 @@
 # -*- mode: python ; coding: utf-8 -*-
 
+# Qt modules and stdlib packages the app never imports. Keeping them out of the
+# archive shrinks what the one-file bootloader has to unpack on every launch.
+excluded_modules = [
+    'PyQt5.QtNetwork', 'PyQt5.QtQml', 'PyQt5.QtQuick', 'PyQt5.QtSql', 'PyQt5.QtSvg',
+    'PyQt5.QtPrintSupport', 'PyQt5.QtMultimedia', 'PyQt5.QtWebEngineWidgets',
+    'PyQt5.QtWebEngineCore', 'PyQt5.QtOpenGL', 'PyQt5.QtXml', 'PyQt5.QtTest',
+    'tkinter', 'unittest', 'pydoc', 'doctest', 'xmlrpc', 'lib2to3',
+]
+
+# Only the platform integration and native style plugins are needed for a
+# plain QWidget window; everything else under Qt5/plugins is dropped.
+kept_qt_plugins = ('/plugins/platforms/', '/plugins/styles/')
+
+
+def keep_entry(entry):
+    dest = entry[0].replace('\\', '/')
+    if '/Qt5/plugins/' not in dest and not dest.startswith('PyQt5/Qt/plugins/'):
+        return True
+    return any(plugin in dest for plugin in kept_qt_plugins)
+
 
 a = Analysis(
     ['C:\\Users\\sultan.m\\Documents\\Ginesys\\PatchRun\\app\\main.py'],
@@ -10,10 +30,12 @@ a = Analysis(
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
-    excludes=[],
+    excludes=excluded_modules,
     noarchive=False,
     optimize=0,
 )
+a.binaries = [entry for entry in a.binaries if keep_entry(entry)]
+a.datas = [entry for entry in a.datas if keep_entry(entry)]
 pyz = PYZ(a.pure)
 
 exe = EXE(
@@ -26,7 +48,8 @@ exe = EXE(
     debug=False,
     bootloader_ignore_signals=False,
     strip=False,
-    upx=True,
+    # UPX-packed Qt DLLs must be decompressed (and are re-scanned by AV) on every start.
+    upx=False,
     upx_exclude=[],
     runtime_tmpdir=None,
     console=False,
@@ -0,0 +1,192 @@
+import threading
+from patchrun import server_concurrency, is_connection_limit
+
+# Adaptive per-server concurrency for patch runs. Each server's limit follows an
+# AIMD feedback loop between 1 and the configured concurrency, which becomes the
+# ceiling:
+#
+# - slow start: +1 per finished database (doubling every round) until the first
+#   sign of overload, then +1/limit per database (+1 per round);
+# - connection errors ("too many clients", refused connections) halve the limit;
+# - connect latency above LATENCY_TOLERANCE times the best seen cuts it by a
+#   quarter. Connect time is the signal because patch time depends on each
+#   database's size, while a loaded server is slow to accept any session;
+# - at most one decrease per round (as many completions as the limit), so one
+#   burst of failures does not collapse the limit to 1.
+#
+# With a pool, a sampler thread also reads connection headroom from each server's
+# postgres database (max_connections minus reserved slots minus client backends)
+# and caps the limit so that `margin` slots stay free for everyone else, and
+# connection errors close the pool's idle connections to that server, which hold
+# slots of databases already patched.
+
+INITIAL_LIMIT = 2
+DECREASE_FACTOR = 0.5
+LATENCY_DECREASE_FACTOR = 0.75
+LATENCY_TOLERANCE = 2.0
+LATENCY_SMOOTHING = 0.2
+MIN_BASELINE = 0.01
+HEADROOM_INTERVAL = 5.0
+DEFAULT_HEADROOM_MARGIN = 5
+HEADROOM_QUERY = (
+    "SELECT current_setting('max_connections')::int - current_setting('superuser_reserved_connections')::int"
+    " - (SELECT count(*) FROM pg_stat_activity WHERE backend_type = 'client backend')"
+)
+
+
+class ServerLimit:
+    def __init__(self, server, ceiling):
+        self.server = server
+        self.ceiling = ceiling
+        self.cap = ceiling
+        self.limit = float(min(ceiling, INITIAL_LIMIT))
+        self.slow_start = True
+        self.latency = None
+        self.baseline = None
+        self.in_flight = 0
+        self.completed = 0
+        self.last_decrease = None
+        self.peak = self.current()
+
+    def current(self):
+        return max(1, min(int(self.limit), self.cap))
+
+
+class AdaptiveConcurrency:
+    # Passed to patchrun.run_patch / run_patch_async as limits. on_change(server name,
+    # old limit, new limit, reason) is called when a decrease or the headroom cap moves
+    # a server's effective limit.
+    def __init__(self, pool=None, margin=DEFAULT_HEADROOM_MARGIN, on_change=None, interval=HEADROOM_INTERVAL):
+        self.pool = pool
+        self.margin = margin
+        self.on_change = on_change
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.servers = {}
+        self.stopped = threading.Event()
+        self.sampler = None
+
+    def start(self, servers, concurrency):
+        with self.lock:
+            for server in servers:
+                self.servers[server['name']] = ServerLimit(server, server_concurrency(server, concurrency))
+        if self.pool is not None and self.servers:
+            self.stopped.clear()
+            self.sampler = threading.Thread(target=self.sample_headroom, daemon=True)
+            self.sampler.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.sampler is not None:
+            self.sampler.join()
+            self.sampler = None
+
+    def limit(self, name):
+        with self.lock:
+            return self.servers[name].current()
+
+    def summary(self):
+        with self.lock:
+            return ", ".join(f"{name}: {server.current()} of {server.ceiling} (peak {server.peak})"
+                             for name, server in self.servers.items())
+
+    def started(self, name):
+        with self.lock:
+            self.servers[name].in_flight += 1
+
+    def finished(self, name):
+        with self.lock:
+            self.servers[name].in_flight -= 1
+
+    def record(self, outcome):
+        # Feeds one finished database into its server's limit.
+        if outcome.skipped or outcome.cancelled:
+            return
+        with self.lock:
+            server = self.servers.get(outcome.server)
+            if server is None:
+                return
+            before = server.current()
+            server.completed += 1
+            reason = None
+            connection_error = is_connection_limit(outcome) or (not outcome.ok and outcome.connect_time is None)
+            if connection_error:
+                reason = self.decrease(server, DECREASE_FACTOR, 'connection errors')
+            elif outcome.connect_time is not None:
+                server.latency = outcome.connect_time if server.latency is None else \
+                    server.latency + LATENCY_SMOOTHING * (outcome.connect_time - server.latency)
+                server.baseline = max(MIN_BASELINE, min(server.baseline or server.latency, server.latency))
+                if server.latency > LATENCY_TOLERANCE * server.baseline:
+                    reason = self.decrease(server, LATENCY_DECREASE_FACTOR,
+                                           f'connect latency {server.latency * 1000:.0f}ms')
+                else:
+                    # Increases are not reported one by one; summary() has the peak.
+                    server.limit = min(server.ceiling, server.limit + (1 if server.slow_start else 1 / server.limit))
+            after = server.current()
+            server.peak = max(server.peak, after)
+        if connection_error and self.pool is not None:
+            self.pool.close_idle(server.server)
+        self.changed(outcome.server, before, after, reason)
+
+    def decrease(self, server, factor, reason):
+        if server.last_decrease is not None and server.completed - server.last_decrease < server.current():
+            return None
+        server.slow_start = False
+        server.last_decrease = server.completed
+        server.limit = max(1.0, server.limit * factor)
+        return reason
+
+    def changed(self, name, before, after, reason):
+        if self.on_change and reason and before != after:
+            self.on_change(name, before, after, reason)
+
+    def sample_headroom(self):
+        while not self.stopped.wait(self.interval):
+            for name, server in list(self.servers.items()):
+                try:
+                    with self.pool.connection(server.server, 'postgres') as conn:
+                        cursor = conn.cursor()
+                        cursor.execute(HEADROOM_QUERY)
+                        free = cursor.fetchone()[0]
+                        conn.commit()
+                except Exception:
+                    # Headroom is an optional input; latency and errors still steer the limit.
+                    continue
+                self.apply_headroom(name, free)
+
+    def apply_headroom(self, name, free):
+        # Our own sessions are part of the count, so they may stay open.
+        with self.lock:
+            server = self.servers[name]
+            before = server.current()
+            server.cap = max(1, min(server.ceiling, server.in_flight + free - self.margin))
+            after = server.current()
+        self.changed(name, before, after, f'{free} free connection slots')
+
+    def async_slot(self, name):
+        return AsyncSlot(self, name)
+
+
+class AsyncSlot:
+    # Stand-in for the per-server asyncio.Semaphore of run_patch_async whose size
+    # follows the adaptive limit. Waiters are woken as databases finish.
+    def __init__(self, limits, name):
+        import asyncio
+        self.limits = limits
+        self.name = name
+        self.condition = asyncio.Condition()
+
+    def available(self):
+        with self.limits.lock:
+            server = self.limits.servers[self.name]
+            return server.in_flight < server.current()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(self.available)
+            self.limits.started(self.name)
+
+    async def __aexit__(self, *exc_info):
+        self.limits.finished(self.name)
+        async with self.condition:
+            self.condition.notify_all()
@@ -0,0 +1,382 @@
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import subprocess
+import patchrun
+from connpool import ConnectionPool
+from metrics import RunMetrics
+from adaptive import AdaptiveConcurrency, HEADROOM_QUERY
+
+# Benchmark of the listing and patch paths against a fake connection layer with
+# injected connect / execute / commit latency and a failure rate. Every scenario runs
+# in its own process so that peak RSS belongs to that scenario alone.
+#
+#   python bench.py                                   default matrix, 10..5000 databases
+#   python bench.py --databases 1000 --concurrency 16 32 --execute-ms 200
+#   python bench.py --config throwaway.ini --databases 50   real cluster from a config file
+#
+# Only the threads engine is measured. The latencies are sleeps, which release the
+# GIL the same way a blocking libpq call does.
+#
+#   python bench.py --databases 2000 --concurrency 64 --saturation 16 --max-connections 80 --adaptive
+#
+# --saturation makes the fake server slow down past that many concurrent patches
+# (connect latency grows quadratically, execute time linearly) and --max-connections
+# refuses sessions beyond that many open connections, as a loaded server would.
+#
+#   python bench.py --databases 500 --concurrency 16 --execute-ms 5 --rtt-ms 40 --pipeline
+#
+# --rtt-ms adds a network round trip to every message the client sends and waits
+# for (psycopg2's implicit BEGIN and the COMMIT included), as on a distant server;
+# --pipeline sends each patch as pipelined messages instead.
+
+DEFAULT_DATABASES = [10, 100, 1000, 5000]
+DEFAULT_CONCURRENCY = [8, 32, 64]
+DEFAULT_PATCH = 'UPDATE settings SET value = value WHERE key = \'bench\''
+
+
+class FakeError(Exception):
+    def __init__(self, message, pgcode):
+        super().__init__(message)
+        self.pgcode = pgcode
+
+
+class FakeServer:
+    # Shared by every fake connection of a run; holds the latency profile and the
+    # database list returned by the catalog queries.
+    def __init__(self, databases, connect_ms, execute_ms, commit_ms, jitter, failure_rate, seed=None,
+                 max_connections=None, saturation=None, rtt_ms=0.0):
+        self.databases = [f"tenant_{index:05d}" for index in range(databases)]
+        self.max_connections = max_connections
+        self.saturation = saturation
+        self.open = 0
+        self.active = 0
+        self.connect_ms = connect_ms
+        self.execute_ms = execute_ms
+        self.commit_ms = commit_ms
+        self.rtt_ms = rtt_ms
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def delay(self, milliseconds, interrupt=None):
+        # Returns True when interrupt (a threading.Event) was set during the wait.
+        if milliseconds <= 0:
+            return False
+        with self.lock:
+            factor = self.random.uniform(1 - self.jitter, 1 + self.jitter)
+        if interrupt is None:
+            time.sleep(milliseconds * factor / 1000)
+            return False
+        return interrupt.wait(milliseconds * factor / 1000)
+
+    def fails(self):
+        with self.lock:
+            return self.random.random() < self.failure_rate
+
+    def load(self):
+        # Active patches per saturation level; 0 without --saturation.
+        with self.lock:
+            return self.active / self.saturation if self.saturation else 0.0
+
+    def connect(self, dbname, host, port, user, password):
+        with self.lock:
+            if self.max_connections is not None and self.open >= self.max_connections:
+                raise FakeError('FATAL:  sorry, too many clients already', None)
+            self.open += 1
+        self.delay(self.connect_ms * (1 + self.load() ** 2))
+        return FakeConnection(self, dbname)
+
+    def begin(self):
+        with self.lock:
+            self.active += 1
+
+    def end(self):
+        with self.lock:
+            self.active -= 1
+
+    def free_connections(self):
+        with self.lock:
+            return (self.max_connections or 1000) - self.open
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+        self.rowcount = -1
+
+    def execute(self, query, params=None):
+        server = self.conn.server
+        self.rows = []
+        self.rowcount = -1
+        round_trips = 1
+        if not self.conn.autocommit and not self.conn.begun:
+            # psycopg2 sends BEGIN on its own ahead of the first statement of a transaction.
+            self.conn.begun = True
+            round_trips += 1
+        server.delay(server.rtt_ms * round_trips)
+        if query == 'ROLLBACK':
+            self.conn.end()
+            return
+        if query in ('DISCARD ALL', patchrun.SESSION_SETTINGS_QUERY):
+            return
+        if query == patchrun.LOCK_PROBE_QUERY:
+            self.rows = [(0,)]
+            self.rowcount = 1
+        elif query == HEADROOM_QUERY:
+            self.rows = [(server.free_connections(),)]
+            self.rowcount = 1
+        elif query == patchrun.DATABASE_LIST_QUERY:
+            self.rows = [(name,) for name in server.databases]
+            self.rowcount = len(self.rows)
+        elif query == patchrun.DATABASE_DETAILS_QUERY:
+            self.rows = [(name, 8 * 1024 * 1024, 'UTF8') for name in server.databases]
+            self.rowcount = len(self.rows)
+        else:
+            self.conn.begin()
+            if server.delay(server.execute_ms * max(1.0, server.load()), self.conn.cancel_requested):
+                self.conn.cancel_requested.clear()
+                raise FakeError('canceling statement due to user request', '57014')
+            if server.fails():
+                raise FakeError('canceling statement due to lock timeout', '55P03')
+            self.rowcount = 1
+            if query.endswith('COMMIT'):
+                # A pipelined patch commits within its last message.
+                server.delay(server.commit_ms)
+                self.conn.end()
+            elif query.endswith('ROLLBACK'):
+                self.conn.end()
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, server, dbname):
+        self.server = server
+        self.dbname = dbname
+        self.closed = 0
+        self.autocommit = False
+        self.begun = False
+        self.in_transaction = False
+        self.cancel_requested = threading.Event()
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def begin(self):
+        if not self.in_transaction:
+            self.in_transaction = True
+            self.server.begin()
+
+    def end(self):
+        self.begun = False
+        if self.in_transaction:
+            self.in_transaction = False
+            self.server.end()
+
+    def commit(self):
+        if self.begun:
+            self.server.delay(self.server.rtt_ms)
+        if self.in_transaction:
+            self.server.delay(self.server.commit_ms)
+        self.end()
+
+    def rollback(self):
+        if self.begun:
+            self.server.delay(self.server.rtt_ms)
+        self.end()
+
+    def get_transaction_status(self):
+        # 0 idle, 2 in transaction, as in psycopg2.extensions
+        return 2 if self.in_transaction else 0
+
+    def cancel(self):
+        self.cancel_requested.set()
+
+    def close(self):
+        if not self.closed:
+            self.end()
+            with self.server.lock:
+                self.server.open -= 1
+        self.closed = 1
+
+
+def peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        # Windows reports the peak working set.
+        return getattr(psutil.Process().memory_info(), 'peak_wset', None)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run_scenario(args):
+    # One (databases, concurrency) point; returns a dict of results.
+    if args.config:
+        server = patchrun.make_server(**patchrun.load_config_credentials(args.config))
+        pool = ConnectionPool()
+    else:
+        fake = FakeServer(args.databases, args.connect_ms, args.execute_ms, args.commit_ms,
+                          args.jitter, args.failure_rate, args.seed, args.max_connections, args.saturation,
+                          args.rtt_ms)
+        server = patchrun.make_server('bench', 5432, 'bench', 'bench')
+        pool = ConnectionPool(connect=fake.connect)
+    try:
+        started = time.perf_counter()
+        targets, errors = patchrun.discover_targets(pool, [server])
+        listing = time.perf_counter() - started
+        if errors:
+            raise RuntimeError("; ".join(errors.values()))
+        targets = targets[:args.databases]
+        metrics = RunMetrics()
+        options = patchrun.PatchOptions(max_retries=args.retries, retry_backoff=args.retry_backoff,
+                                        adaptive=args.adaptive, pipeline=args.pipeline)
+        limits = AdaptiveConcurrency(pool, options.connection_headroom) if args.adaptive else None
+        control = patchrun.RunControl()
+        cancelled_at = []
+        if args.cancel_after is not None:
+            def cancel():
+                cancelled_at.append(time.perf_counter())
+                control.cancel()
+            timer = threading.Timer(args.cancel_after, cancel)
+            timer.start()
+        outcomes = patchrun.run_patch(pool, targets, args.patch, args.concurrency, metrics=metrics, options=options,
+                                      control=control, limits=limits)
+        returned = time.perf_counter()
+        if args.cancel_after is not None:
+            timer.cancel()
+    finally:
+        pool.close_all()
+    latencies = [outcome.elapsed for outcome in outcomes]
+    return {
+        'databases': len(targets),
+        'concurrency': args.concurrency,
+        'listing_ms': listing * 1000,
+        'databases_per_second': metrics.throughput(),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'connect_p50_ms': metrics.phases['connect'].quantile(0.5) * 1000,
+        'peak_in_flight': metrics.peak_in_flight,
+        'failed': sum(1 for outcome in outcomes if not outcome.ok),
+        'retried': sum(1 for outcome in outcomes if outcome.attempts > 1),
+        'cancelled': sum(1 for outcome in outcomes if outcome.cancelled),
+        'cancel_ms': (returned - cancelled_at[0]) * 1000 if cancelled_at else None,
+        'limits': limits.summary() if limits else None,
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+
+def scenario_command(args, databases, concurrency):
+    command = [sys.executable, __file__, '--scenario', '--databases', str(databases), '--concurrency', str(concurrency),
+               '--connect-ms', str(args.connect_ms), '--execute-ms', str(args.execute_ms),
+               '--commit-ms', str(args.commit_ms), '--rtt-ms', str(args.rtt_ms), '--jitter', str(args.jitter),
+               '--failure-rate', str(args.failure_rate), '--retries', str(args.retries),
+               '--retry-backoff', str(args.retry_backoff), '--patch', args.patch]
+    if args.seed is not None:
+        command += ['--seed', str(args.seed)]
+    if args.config:
+        command += ['--config', args.config]
+    if args.cancel_after is not None:
+        command += ['--cancel-after', str(args.cancel_after)]
+    if args.max_connections is not None:
+        command += ['--max-connections', str(args.max_connections)]
+    if args.saturation is not None:
+        command += ['--saturation', str(args.saturation)]
+    if args.adaptive:
+        command.append('--adaptive')
+    if args.pipeline:
+        command.append('--pipeline')
+    return command
+
+
+def format_row(result):
+    rss = result['peak_rss_bytes']
+    return (f"{result['databases']:>9}{result['concurrency']:>6}{result['listing_ms']:>11.1f}"
+            f"{result['databases_per_second']:>9.1f}{result['p50_ms']:>9.1f}{result['p99_ms']:>9.1f}"
+            f"{result['connect_p50_ms']:>12.1f}{result['peak_in_flight']:>6}{result['failed']:>7}{result['retried']:>8}"
+            f"{rss / (1024 * 1024) if rss else 0:>9.1f}")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark listing and patching against a fake or throwaway server.')
+    parser.add_argument('--databases', type=int, nargs='+', default=DEFAULT_DATABASES, help='target database counts')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=DEFAULT_CONCURRENCY, help='concurrency levels')
+    parser.add_argument('--connect-ms', type=float, default=20.0, help='injected connect latency')
+    parser.add_argument('--execute-ms', type=float, default=50.0, help='injected execute latency')
+    parser.add_argument('--commit-ms', type=float, default=5.0, help='injected commit latency')
+    parser.add_argument('--rtt-ms', type=float, default=0.0, help='injected network round trip per message')
+    parser.add_argument('--jitter', type=float, default=0.5, help='latencies vary uniformly by this fraction')
+    parser.add_argument('--failure-rate', type=float, default=0.01,
+                        help='fraction of patch attempts failing with a lock timeout')
+    parser.add_argument('--retries', type=int, default=0, help='retries of lock timeouts (default: none)')
+    parser.add_argument('--retry-backoff', type=float, default=0.1, help='first retry delay in seconds')
+    parser.add_argument('--seed', type=int, help='random seed for repeatable runs')
+    parser.add_argument('--patch', default=DEFAULT_PATCH, help='SQL executed on every database')
+    parser.add_argument('--cancel-after', type=float, metavar='SECONDS',
+                        help='cancel each run after this long and report how long the cancel took')
+    parser.add_argument('--max-connections', type=int, help='fake server refuses sessions beyond this many')
+    parser.add_argument('--saturation', type=int, help='fake server slows down past this many concurrent patches')
+    parser.add_argument('--adaptive', action='store_true', help='let the concurrency adapt, up to --concurrency')
+    parser.add_argument('--pipeline', action='store_true', help='send each patch as pipelined messages')
+    parser.add_argument('--config', help='benchmark a real (throwaway!) cluster from this config.ini instead')
+    parser.add_argument('--output', help='append the results as JSON lines to this file')
+    parser.add_argument('--scenario', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.scenario:
+        args.databases = args.databases[0]
+        args.concurrency = args.concurrency[0]
+        print(json.dumps(run_scenario(args)))
+        return 0
+
+    print(f"{'databases':>9}{'conc':>6}{'list ms':>11}{'db/s':>9}{'p50 ms':>9}{'p99 ms':>9}"
+          f"{'connect p50':>12}{'peak':>6}{'failed':>7}{'retried':>8}{'RSS MB':>9}")
+    for databases in args.databases:
+        for concurrency in args.concurrency:
+            completed = subprocess.run(scenario_command(args, databases, concurrency), capture_output=True, text=True)
+            if completed.returncode != 0:
+                print(f"{databases:>9}{concurrency:>6}  failed: {completed.stderr.strip().splitlines()[-1:]}",
+                      file=sys.stderr)
+                continue
+            result = json.loads(completed.stdout)
+            print(format_row(result), flush=True)
+            if result['cancel_ms'] is not None:
+                print(f"{'':>15}cancelled {result['cancelled']} databases, run returned {result['cancel_ms']:.0f} ms "
+                      f"after the cancel", flush=True)
+            if result['limits']:
+                print(f"{'':>15}adaptive limit {result['limits']}", flush=True)
+            if args.output:
+                with open(args.output, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(dict(result, ts=time.strftime('%Y-%m-%dT%H:%M:%S'))) + "\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
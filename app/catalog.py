@@ -0,0 +1,186 @@
+import sqlite3
+import time
+from collections import namedtuple
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import patchrun
+from ledger import server_key
+
+# Local cache of every server's database list and metadata, so the window can show
+# the list immediately at start-up and refresh it in the background. It also keeps
+# how long each database took to patch, for longest-first scheduling (schedule.py),
+# and the schema fingerprints of the pre-flight check (preflight.py).
+
+CATALOG_FILE = 'catalog_cache.db'
+DEFAULT_TTL = 15 * 60
+# Weight of the latest run in a database's remembered patch duration.
+DURATION_SMOOTHING = 0.3
+
+CatalogEntry = namedtuple('CatalogEntry', ['server', 'name', 'size', 'encoding', 'last_patched'])
+
+
+class DatabaseCatalog:
+    def __init__(self, path=CATALOG_FILE, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        with closing(self.connect()) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS databases ("
+                " server TEXT NOT NULL,"
+                " dbname TEXT NOT NULL,"
+                " size_bytes INTEGER,"
+                " encoding TEXT,"
+                " PRIMARY KEY (server, dbname))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS servers ("
+                " server TEXT PRIMARY KEY,"
+                " fetched_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS durations ("
+                " server TEXT NOT NULL,"
+                " dbname TEXT NOT NULL,"
+                " seconds REAL NOT NULL,"
+                " runs INTEGER NOT NULL,"
+                " updated_at REAL NOT NULL,"
+                " PRIMARY KEY (server, dbname))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS fingerprints ("
+                " server TEXT NOT NULL,"
+                " dbname TEXT NOT NULL,"
+                " fingerprint TEXT NOT NULL,"
+                " computed_at REAL NOT NULL,"
+                " PRIMARY KEY (server, dbname))"
+            )
+            conn.commit()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def fetched_at(self, server):
+        with closing(self.connect()) as conn:
+            row = conn.execute("SELECT fetched_at FROM servers WHERE server = ?", (server_key(server),)).fetchone()
+        return row[0] if row else None
+
+    def is_stale(self, server):
+        fetched_at = self.fetched_at(server)
+        return fetched_at is None or time.time() - fetched_at > self.ttl
+
+    def cached(self, server, patch_ledger=None):
+        with closing(self.connect()) as conn:
+            rows = conn.execute(
+                "SELECT dbname, size_bytes, encoding FROM databases WHERE server = ? ORDER BY dbname DESC",
+                (server_key(server),)
+            ).fetchall()
+        return self.entries(server, rows, patch_ledger)
+
+    def entries(self, server, rows, patch_ledger=None):
+        last_patched = patch_ledger.last_applied(server) if patch_ledger else {}
+        return [CatalogEntry(server, name, size, encoding, last_patched.get(name)) for name, size, encoding in rows]
+
+    def store(self, server, rows):
+        # Writes only the difference to the cached list: removed databases are deleted,
+        # new ones and those whose size or encoding changed are upserted. Returns
+        # (added, removed) names.
+        key = server_key(server)
+        with closing(self.connect()) as conn:
+            cached = {name: (size, encoding) for name, size, encoding in conn.execute(
+                "SELECT dbname, size_bytes, encoding FROM databases WHERE server = ?", (key,))}
+            current = {name for name, _, _ in rows}
+            added = current - set(cached)
+            removed = set(cached) - current
+            conn.executemany("DELETE FROM databases WHERE server = ? AND dbname = ?", [(key, name) for name in removed])
+            conn.executemany(
+                "INSERT OR REPLACE INTO databases (server, dbname, size_bytes, encoding) VALUES (?, ?, ?, ?)",
+                [(key, name, size, encoding) for name, size, encoding in rows if cached.get(name) != (size, encoding)]
+            )
+            conn.execute("INSERT OR REPLACE INTO servers (server, fetched_at) VALUES (?, ?)", (key, time.time()))
+            conn.commit()
+        return added, removed
+
+    def record_durations(self, servers, outcomes):
+        # Folds the elapsed time of every database that was actually patched into its
+        # remembered duration. servers maps display name to server.
+        rows = [(server_key(servers[outcome.server]), outcome.database, outcome.elapsed)
+                for outcome in outcomes if outcome.ok and not outcome.skipped and outcome.server in servers]
+        if not rows:
+            return
+        now = time.time()
+        with closing(self.connect()) as conn:
+            conn.executemany(
+                "INSERT INTO durations (server, dbname, seconds, runs, updated_at) VALUES (?, ?, ?, 1, ?)"
+                " ON CONFLICT (server, dbname) DO UPDATE SET"
+                " seconds = seconds + ? * (excluded.seconds - seconds), runs = runs + 1, updated_at = excluded.updated_at",
+                [(key, name, seconds, now, DURATION_SMOOTHING) for key, name, seconds in rows]
+            )
+            conn.commit()
+
+    def history(self, targets):
+        # Maps (server name, database) of every target to (remembered duration in
+        # seconds or None, cached size in bytes or None).
+        history = {}
+        with closing(self.connect()) as conn:
+            for server, databases in patchrun.group_by_server(targets):
+                key = server_key(server)
+                seconds = dict(conn.execute("SELECT dbname, seconds FROM durations WHERE server = ?", (key,)))
+                sizes = dict(conn.execute("SELECT dbname, size_bytes FROM databases WHERE server = ?", (key,)))
+                for name in databases:
+                    history[(server['name'], name)] = (seconds.get(name), sizes.get(name))
+        return history
+
+    def fingerprints(self, targets):
+        # Maps (server name, database) to the cached schema fingerprint of every target
+        # fingerprinted within the TTL.
+        fingerprints = {}
+        oldest = time.time() - self.ttl
+        with closing(self.connect()) as conn:
+            for server, databases in patchrun.group_by_server(targets):
+                cached = dict(conn.execute(
+                    "SELECT dbname, fingerprint FROM fingerprints WHERE server = ? AND computed_at >= ?",
+                    (server_key(server), oldest)
+                ))
+                fingerprints.update({(server['name'], name): cached[name] for name in databases if name in cached})
+        return fingerprints
+
+    def store_fingerprints(self, servers, fingerprints):
+        # servers maps display name to server.
+        now = time.time()
+        with closing(self.connect()) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO fingerprints (server, dbname, fingerprint, computed_at) VALUES (?, ?, ?, ?)",
+                [(server_key(servers[name]), db, fingerprint, now) for (name, db), fingerprint in fingerprints.items()]
+            )
+            conn.commit()
+
+    def forget_fingerprints(self, servers, outcomes):
+        # A patched schema has changed, so its cached fingerprint no longer holds.
+        rows = [(server_key(servers[outcome.server]), outcome.database)
+                for outcome in outcomes if outcome.ok and not outcome.skipped and outcome.server in servers]
+        with closing(self.connect()) as conn:
+            conn.executemany("DELETE FROM fingerprints WHERE server = ? AND dbname = ?", rows)
+            conn.commit()
+
+    def refresh(self, pool, servers, patch_ledger=None):
+        # Re-reads every server in parallel. Servers that cannot be reached keep their
+        # cached entries. Returns (entries, errors, added count, removed count).
+        entries = {}
+        errors = {}
+        added = removed = 0
+        with ThreadPoolExecutor(max_workers=max(1, len(servers))) as executor:
+            futures = {executor.submit(patchrun.list_database_details, pool, server): server for server in servers}
+            for future in as_completed(futures):
+                server = futures[future]
+                try:
+                    rows = future.result()
+                except Exception as e:
+                    errors[server['name']] = str(e)
+                    entries[server['name']] = self.cached(server, patch_ledger)
+                    continue
+                server_added, server_removed = self.store(server, rows)
+                added += len(server_added)
+                removed += len(server_removed)
+                entries[server['name']] = self.entries(server, rows, patch_ledger)
+        ordered = [entry for server in servers for entry in entries[server['name']]]
+        return ordered, errors, added, removed
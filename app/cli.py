@@ -0,0 +1,410 @@
+import sys
+import re
+import time
+import signal
+import fnmatch
+import argparse
+import patchrun
+from sqlscript import PatchFile
+from copyload import CopyLoad, COPY_FORMATS
+from ledger import PatchLedger, LEDGER_FILE, hash_patch
+from runlog import RunLog, RUN_LOG_FILE
+from metrics import RunMetrics, METRICS_FILE
+import resultset
+from resultset import ResultSpool, RESULTS_FILE
+from gather import Aggregation, parse_order, parse_aggregation, gathered
+from connpool import ConnectionPool
+from adaptive import AdaptiveConcurrency
+from catalog import DatabaseCatalog, CATALOG_FILE
+from schedule import longest_first, RunEta, format_eta
+from preflight import preflight, preflight_passed, preflight_report, target_list
+from journal import (RunJournal, JOURNAL_FILE, FINISHED, CANCELLED, run_settings, settings_options, resume_plan,
+                     load_resumed_work, describe_run, skips_committed)
+
+# Headless entry point for scripted and scheduled patch runs. Must not import Qt.
+#
+#   python cli.py --patch fix.sql --match "ginesys*" --concurrency 16
+#   python cli.py --copy items.csv --table main.item_master --match "ginesys*"
+#   python cli.py --read check.sql --output counts.csv --match "ginesys*"
+#   python cli.py --read orders.sql --merge-key "created_at DESC, id"
+#   python cli.py --read items.sql --aggregate "count(*), sum(qty), max(updated_at) BY status"
+#
+# Exit codes: 0 every database patched, 1 at least one database failed,
+# 2 bad arguments / credentials / nothing to patch, 3 cancelled with Ctrl+C.
+#
+# The first Ctrl+C cancels the run (no new databases, in-flight patches cancelled
+# on the server); a second one exits immediately.
+
+DEFAULT_CONCURRENCY = 8
+ETA_REPORT_INTERVAL = 10.0
+ENGINES = ('threads', 'asyncio')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Apply a SQL patch to many PostgreSQL databases.')
+    work = parser.add_mutually_exclusive_group()
+    work.add_argument('--patch', help='SQL file to execute on every selected database')
+    work.add_argument('--copy', metavar='FILE', help='data file to bulk load with COPY into --table of every database')
+    work.add_argument('--read', metavar='FILE',
+                      help='read-only query whose rows are collected from every database into --output')
+    work.add_argument('--resume', nargs='?', const='', metavar='RUN_ID',
+                      help='patch the databases an interrupted or cancelled run did not finish, with the patch and '
+                           'settings of that run (default: the last run in --journal)')
+    parser.add_argument('--output', default=RESULTS_FILE, help='CSV file for the rows of --read (default: %(default)s)')
+    gather = parser.add_mutually_exclusive_group()
+    gather.add_argument('--merge-key', help='merge the --read rows of all databases on this ORDER BY key, e.g. '
+                                            '"created_at DESC, id"; every database must return rows in that order, '
+                                            'text keys sorted with COLLATE "C"')
+    gather.add_argument('--aggregate', help='combine the --read rows of all databases into count/sum/min/max per '
+                                            'group, e.g. "count(*), sum(amount) BY status"')
+    parser.add_argument('--table', help='target table of --copy, optionally schema-qualified')
+    parser.add_argument('--columns', help='comma-separated target columns of --copy (default: all, in table order)')
+    parser.add_argument('--format', choices=COPY_FORMATS, default='csv', help='--copy file format (default: csv)')
+    parser.add_argument('--no-header', action='store_true', help='the --copy CSV file has no header line')
+    parser.add_argument('--delimiter', help='--copy field delimiter (default: comma for csv, tab for text)')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--config', default=patchrun.CONFIG_FILE, help='config.ini with a [PostgreSQL] section (default)')
+    source.add_argument('--pgcon', help='pgcon.txt connection string to read credentials from instead')
+    selection = parser.add_mutually_exclusive_group()
+    selection.add_argument('--match', default='*', help='glob pattern on database names (default: all)')
+    selection.add_argument('--regex', help='regular expression on database names')
+    parser.add_argument('--all-servers', action='store_true',
+                        help='use every server in the inventory: all [PostgreSQL:<name>] sections, or every pgcon.txt line')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='databases patched at the same time on each server (a server section may override it)')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='adjust the concurrency of each server to its load, up to --concurrency')
+    parser.add_argument('--engine', choices=ENGINES, default='threads', help='execution backend')
+    parser.add_argument('--list', action='store_true', help='only print the selected databases, do not patch')
+    parser.add_argument('--ledger', default=LEDGER_FILE, help='local patch ledger file (SQLite)')
+    parser.add_argument('--force', action='store_true', help='re-run on databases the ledger says are already patched')
+    parser.add_argument('--ledger-in-database', action='store_true',
+                        help='also keep the ledger in a patchrun_ledger table inside each target database')
+    parser.add_argument('--catalog', default=CATALOG_FILE,
+                        help='local catalog with database sizes and past patch durations (default: %(default)s)')
+    parser.add_argument('--keep-order', action='store_true',
+                        help='patch in name order instead of longest expected duration first')
+    parser.add_argument('--preflight', action='store_true',
+                        help='first dry-run the patch (rolled back) on one database per schema fingerprint and '
+                             'stop if any fails')
+    parser.add_argument('--preflight-only', action='store_true', help='run the --preflight check and exit')
+    parser.add_argument('--lock-timeout', help="lock_timeout per patch transaction, e.g. 5s (default: [Execution] or 5s)")
+    parser.add_argument('--statement-timeout', help='statement_timeout per patch transaction, 0 for none')
+    parser.add_argument('--retries', type=int, help='retries of databases failing with a lock timeout or deadlock')
+    parser.add_argument('--probe-locks', action='store_true',
+                        help='postpone databases where other sessions hold or wait for locks')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='send each patch transaction (BEGIN, settings, statements, COMMIT) without waiting '
+                             'for replies in between, in one round trip per batch instead of one per step')
+    parser.add_argument('--run-log', default=RUN_LOG_FILE, help='structured JSONL run log (default: %(default)s)')
+    parser.add_argument('--journal', default=JOURNAL_FILE,
+                        help='crash-safe journal of patch runs used by --resume (default: %(default)s)')
+    parser.add_argument('--metrics-file', default=METRICS_FILE,
+                        help='Prometheus textfile written after the run (default: %(default)s)')
+    args = parser.parse_args(argv)
+    if not args.patch and not args.copy and not args.read and not args.list and args.resume is None:
+        parser.error('--patch, --copy, --read or --resume is required unless --list is given')
+    if args.copy and not args.table:
+        parser.error('--copy requires --table')
+    if args.read and args.engine != 'threads':
+        parser.error('--read runs on the threads engine only')
+    if (args.merge_key or args.aggregate) and not args.read:
+        parser.error('--merge-key and --aggregate require --read')
+    return args
+
+
+def load_work(args):
+    # Both are streamed per database rather than read into memory: the patch from disk
+    # in batches, the COPY data from one shared memory mapping.
+    if args.copy:
+        return CopyLoad(args.copy, args.table, args.columns.split(',') if args.columns else None, args.format,
+                        header=not args.no_header, delimiter=args.delimiter)
+    return PatchFile(args.patch)
+
+
+def run_read(pool, targets, args):
+    # Rows are spooled to a temporary file while the databases are read (or folded into
+    # the --aggregate groups), then streamed to --output, so memory stays bounded
+    # whatever the result size.
+    try:
+        with open(args.read, 'r', encoding='utf-8') as f:
+            query = resultset.read_query_text(f.read())
+        order = parse_order(args.merge_key) if args.merge_key else None
+        sink = Aggregation(*parse_aggregation(args.aggregate)) if args.aggregate else ResultSpool()
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    except OSError as e:
+        print(f"Error reading query file: {e}", file=sys.stderr)
+        return 2
+    metrics = RunMetrics()
+    control = patchrun.RunControl()
+
+    def interrupt(signum, frame):
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        print("Cancelling...", file=sys.stderr, flush=True)
+        control.cancel()
+
+    previous_handler = signal.signal(signal.SIGINT, interrupt)
+    result = None
+    try:
+        outcomes = resultset.run_read_query(pool, targets, query, args.concurrency, sink, print_read_outcome, metrics,
+                                            load_options(args), control)
+        print(resultset.summarize(outcomes, sink))
+        try:
+            result = gathered(sink, order)
+        except ValueError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return 1
+        try:
+            result.export_csv(args.output)
+        except OSError as e:
+            print(f"Could not write {args.output}: {e}", file=sys.stderr)
+            return 2
+        print(f"Results: {result.row_count} rows in {args.output}")
+        print(metrics.summary())
+    finally:
+        signal.signal(signal.SIGINT, previous_handler)
+        for spool in (sink, result):
+            if isinstance(spool, ResultSpool):
+                spool.close()
+    if control.cancelled:
+        return 3
+    return 0 if all(outcome.ok for outcome in outcomes) else 1
+
+
+def load_servers(args):
+    if args.all_servers:
+        if args.pgcon:
+            return patchrun.load_pgcon_inventory(args.pgcon)
+        return patchrun.load_config_inventory(args.config)
+    if args.pgcon:
+        credentials = patchrun.load_pgcon_credentials(args.pgcon)
+    else:
+        credentials = patchrun.load_config_credentials(args.config)
+    return [patchrun.make_server(**credentials)] if credentials else []
+
+
+def load_resume(journal, servers, args):
+    # Returns (run, its unfinished targets, its patch). The settings of the run replace
+    # those of the command line, so the rest goes on as the run would have.
+    run = journal.last_run(args.resume or None)
+    if run is None:
+        raise ValueError(f"No run {args.resume} in {args.journal}" if args.resume else f"No run in {args.journal}")
+    print(describe_run(journal, run))
+    targets, started = resume_plan(journal, run, servers)
+    settings = run.settings
+    if started:
+        print(f"{len(started)} databases had started without a recorded result and are dispatched again: "
+              f"{target_list(started)}.")
+        if not skips_committed(settings):
+            print("Without the in-database ledger, those that had committed are patched a second time.",
+                  file=sys.stderr)
+    targets += started
+    args.concurrency = settings['concurrency']
+    args.engine = settings['engine']
+    args.force = not settings['skip_applied']
+    args.ledger_in_database = settings['ledger_in_database']
+    return run, targets, load_resumed_work(run) if targets else None
+
+
+def select_targets(targets, args):
+    if args.regex:
+        pattern = re.compile(args.regex)
+        return [(server, db) for server, db in targets if pattern.search(db)]
+    return [(server, db) for server, db in targets if fnmatch.fnmatchcase(db, args.match)]
+
+
+def load_options(args):
+    # [Execution] settings of --config, overridden by the command line.
+    options = patchrun.load_config_options(args.config)
+    overrides = {
+        'lock_timeout': args.lock_timeout,
+        'statement_timeout': args.statement_timeout,
+        'max_retries': args.retries,
+        'probe_locks': args.probe_locks or None,
+        'adaptive': args.adaptive or None,
+        'preflight': args.preflight or args.preflight_only or None,
+        'pipeline': args.pipeline or None,
+    }
+    return options._replace(**{key: value for key, value in overrides.items() if value is not None})
+
+
+def print_outcome(outcome):
+    if outcome.cancelled == patchrun.NOT_STARTED:
+        return
+    if outcome.cancelled:
+        print(f"CANCEL {outcome.server}/{outcome.database} ({outcome.elapsed:.2f}s): {outcome.cancelled}",
+              file=sys.stderr, flush=True)
+    elif outcome.skipped:
+        print(f"SKIP  {outcome.server}/{outcome.database} (already applied)", flush=True)
+    elif outcome.ok:
+        retried = f", attempt {outcome.attempts}" if outcome.attempts > 1 else ""
+        print(f"OK    {outcome.server}/{outcome.database} ({outcome.elapsed:.2f}s{retried})", flush=True)
+    else:
+        code = f" [{outcome.sqlstate}]" if outcome.sqlstate else ""
+        print(f"ERROR {outcome.server}/{outcome.database} ({outcome.elapsed:.2f}s){code}: {outcome.error}",
+              file=sys.stderr, flush=True)
+
+
+def print_limit_change(server, before, after, reason):
+    print(f"LIMIT {server}: {before} -> {after} ({reason})", file=sys.stderr, flush=True)
+
+
+def print_read_outcome(outcome):
+    if outcome.ok:
+        print(f"READ  {outcome.server}/{outcome.database} ({outcome.elapsed:.2f}s): {outcome.rows} rows", flush=True)
+    else:
+        print_outcome(outcome)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        servers = load_servers(args)
+    except OSError as e:
+        print(f"Error loading credentials: {e}", file=sys.stderr)
+        return 2
+    if not servers:
+        print("Error: PostgreSQL credentials not found.", file=sys.stderr)
+        return 2
+
+    pool = ConnectionPool()
+    try:
+        journal = resumed = None
+        if args.resume is not None:
+            journal = RunJournal(args.journal)
+            try:
+                resumed, targets, query = load_resume(journal, servers, args)
+            except ValueError as e:
+                print(f"Error: {e}", file=sys.stderr)
+                return 2
+            except OSError as e:
+                print(f"Error reading patch file: {e}", file=sys.stderr)
+                return 2
+            if not targets:
+                print("Nothing to resume: every database of the run has finished.")
+                return 0
+        else:
+            targets, errors = patchrun.discover_targets(pool, servers)
+            for name, error in errors.items():
+                print(f"Error fetching databases from {name}: {error}", file=sys.stderr)
+            if errors:
+                return 2
+            targets = select_targets(targets, args)
+            if not targets:
+                print("No database matches the given filter.", file=sys.stderr)
+                return 2
+            if args.list:
+                print("\n".join(f"{server['name']}/{db}" for server, db in targets))
+                return 0
+            if args.read:
+                return run_read(pool, targets, args)
+
+            try:
+                query = load_work(args)
+                if query.size() == 0:
+                    print("Error: patch file is empty.", file=sys.stderr)
+                    return 2
+            except ValueError as e:
+                print(f"Error: {e}", file=sys.stderr)
+                return 2
+            except OSError as e:
+                print(f"Error reading patch file: {e}", file=sys.stderr)
+                return 2
+
+        journal = journal or RunJournal(args.journal)
+        patch_ledger = PatchLedger(args.ledger, in_database=args.ledger_in_database, skip_applied=not args.force)
+        run_log = RunLog(hash_patch(query), args.run_log)
+        metrics = RunMetrics()
+        options = settings_options(resumed.settings) if resumed else load_options(args)
+        control = patchrun.RunControl()
+        limits = None
+        if options.adaptive:
+            limits = AdaptiveConcurrency(pool, options.connection_headroom, on_change=print_limit_change)
+
+        def interrupt(signum, frame):
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            print("Cancelling...", file=sys.stderr, flush=True)
+            control.cancel()
+
+        catalog = DatabaseCatalog(args.catalog)
+        estimates = {}
+        if not args.keep_order:
+            # Sizes come from the catalog cache, refreshed here when it is older than its TTL.
+            # They only steer the order, so servers that cannot be read keep their cache.
+            stale = [server for server in servers if catalog.is_stale(server)]
+            if stale:
+                try:
+                    catalog.refresh(pool, stale)
+                except Exception as e:
+                    print(f"Could not refresh database sizes: {e}", file=sys.stderr)
+            targets, estimates = longest_first(targets, catalog.history(targets))
+        eta = RunEta(targets, estimates, args.concurrency)
+        last_eta = [time.monotonic()]
+
+        journal_run = None
+        journal_status = None
+
+        def report(outcome):
+            run_log.record(outcome)
+            journal_run.record(outcome)
+            eta.finished(outcome)
+            print_outcome(outcome)
+            if time.monotonic() - last_eta[0] >= ETA_REPORT_INTERVAL:
+                last_eta[0] = time.monotonic()
+                print(f"ETA   {format_eta(eta.seconds_left())} left", file=sys.stderr, flush=True)
+
+        previous_handler = signal.signal(signal.SIGINT, interrupt)
+        try:
+            if options.preflight:
+                checked = preflight(pool, targets, query, args.concurrency, options, control, catalog, patch_ledger)
+                print("\n".join(preflight_report(checked)), flush=True)
+                if not preflight_passed(checked):
+                    print("Pre-flight check failed; no database was patched.", file=sys.stderr)
+                    return 1
+                if args.preflight_only:
+                    return 0
+            journal_run = journal.begin(run_log.run_id, query, run_log.patch_hash, targets,
+                                        run_settings(args.concurrency, args.engine, options, patch_ledger),
+                                        resumed.run_id if resumed else None)
+            if args.engine == 'asyncio':
+                try:
+                    outcomes = patchrun.run_patch_async(targets, query, args.concurrency, report, patch_ledger,
+                                                        metrics, options, control, limits, journal_run.started)
+                except ImportError:
+                    print("The asyncio engine requires the asyncpg package (pip install asyncpg).", file=sys.stderr)
+                    return 2
+            else:
+                outcomes = patchrun.run_patch(pool, targets, query, args.concurrency, report, patch_ledger, metrics,
+                                              options, control, limits, journal_run.started)
+            journal_status = CANCELLED if control.cancelled else FINISHED
+        finally:
+            signal.signal(signal.SIGINT, previous_handler)
+            run_log.close()
+            if journal_run:
+                journal_run.close(journal_status)
+            if isinstance(query, CopyLoad):
+                query.close()
+        catalog.record_durations({server['name']: server for server in servers}, outcomes)
+        catalog.forget_fingerprints({server['name']: server for server in servers}, outcomes)
+        print(patchrun.summarize(outcomes))
+        if control.cancelled:
+            print("\n".join(patchrun.cancellation_report(outcomes)))
+        print(f"Run log: {run_log.run_id} in {run_log.path}")
+        print(metrics.summary())
+        if limits:
+            print(f"Adaptive concurrency: {limits.summary()}")
+        try:
+            metrics.write_textfile(args.metrics_file)
+        except OSError as e:
+            print(f"Could not write {args.metrics_file}: {e}", file=sys.stderr)
+        if control.cancelled:
+            return 3
+        return 0 if all(outcome.ok for outcome in outcomes) else 1
+    finally:
+        pool.close_all()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
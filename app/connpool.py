@@ -0,0 +1,215 @@
+import time
+import threading
+from contextlib import contextmanager
+
+DEFAULT_MAX_SIZE = 256
+DEFAULT_IDLE_TIMEOUT = 300
+TOO_MANY_CONNECTIONS = '53300'
+# A refused connection carries no SQLSTATE in psycopg2, only the server's message.
+CONNECTION_LIMIT_ERRORS = ('too many clients', 'too many connections', 'remaining connection slots')
+# psycopg2.extensions.TRANSACTION_STATUS_IDLE
+TRANSACTION_STATUS_IDLE = 0
+
+
+class ConnectionPool:
+    # Keeps idle psycopg2 connections keyed by (host, port, user, dbname) so that
+    # repeated Fetch/Execute clicks against the same databases skip the handshake.
+    # connect defaults to psycopg2.connect; the benchmark passes a fake one.
+    #
+    # Each server keeps at most idle_per_server idle connections (max_size by default);
+    # past that a released connection is closed. A server refusing a connection for
+    # its connection limit gets all its idle connections back (see acquire), so a run
+    # over more databases than the server's max_connections recovers on its retries.
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT, connect=None,
+                 idle_per_server=None):
+        self.max_size = max(1, max_size)
+        self.idle_timeout = idle_timeout
+        self.connect = connect
+        self.idle_per_server = self.max_size if idle_per_server is None else max(0, idle_per_server)
+        self.idle = {}
+        self.size = 0
+        self.lock = threading.Condition()
+
+    @staticmethod
+    def key(credentials, dbname):
+        return (credentials['host'], str(credentials['port']), credentials['user'], dbname)
+
+    @staticmethod
+    def server_of(key):
+        return key[:3]
+
+    @contextmanager
+    def connection(self, credentials, dbname):
+        conn = self.acquire(credentials, dbname)
+        try:
+            yield conn
+        finally:
+            self.release(conn, credentials, dbname)
+
+    def acquire(self, credentials, dbname):
+        key = self.key(credentials, dbname)
+        while True:
+            with self.lock:
+                conn = self.take_idle(key)
+                if conn is None:
+                    self.reserve_slot()
+            if conn is None:
+                break
+            if self.is_healthy(conn):
+                return conn
+            self.discard(conn)
+
+        if self.connect is None:
+            # Imported on first use so the GUI can paint before the driver is loaded.
+            import psycopg2
+            self.connect = psycopg2.connect
+        try:
+            return self.connect(
+                dbname=dbname,
+                host=credentials['host'],
+                port=credentials['port'],
+                user=credentials['user'],
+                password=credentials['password']
+            )
+        except Exception as e:
+            with self.lock:
+                self.size -= 1
+                self.lock.notify()
+            if is_connection_limit_error(e):
+                # The server is out of slots; give back the ones held idle here, so
+                # that a retry of this database can get one.
+                self.close_idle(credentials)
+            raise
+
+    def release(self, conn, credentials, dbname):
+        broken = False
+        if not conn.closed:
+            try:
+                if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                broken = True
+        if broken or conn.closed:
+            self.discard(conn)
+            return
+        key = self.key(credentials, dbname)
+        with self.lock:
+            server = self.server_of(key)
+            if self.idle_count(server) >= self.idle_per_server:
+                self.size -= 1
+                self.close_quietly(conn)
+            else:
+                self.idle.setdefault(key, []).append((conn, time.monotonic()))
+            self.lock.notify()
+
+    def idle_count(self, server):
+        # Caller holds the lock.
+        return sum(len(entries) for key, entries in self.idle.items() if self.server_of(key) == server)
+
+    def take_idle(self, key):
+        # Caller holds the lock. Most recently used connections are handed out first.
+        self.evict_expired()
+        entries = self.idle.get(key)
+        if not entries:
+            return None
+        conn, _ = entries.pop()
+        if not entries:
+            del self.idle[key]
+        return conn
+
+    def reserve_slot(self):
+        # Caller holds the lock. Blocks until a new connection may be opened, closing
+        # the least recently used idle connection of another database if the pool is full.
+        while self.size >= self.max_size:
+            if not self.close_oldest_idle():
+                self.lock.wait()
+        self.size += 1
+
+    def close_oldest_idle(self):
+        oldest_key = None
+        oldest_time = None
+        for key, entries in self.idle.items():
+            if entries and (oldest_time is None or entries[0][1] < oldest_time):
+                oldest_key = key
+                oldest_time = entries[0][1]
+        if oldest_key is None:
+            return False
+        conn, _ = self.idle[oldest_key].pop(0)
+        if not self.idle[oldest_key]:
+            del self.idle[oldest_key]
+        self.size -= 1
+        self.close_quietly(conn)
+        return True
+
+    def evict_expired(self):
+        deadline = time.monotonic() - self.idle_timeout
+        for key in list(self.idle):
+            fresh = []
+            for conn, last_used in self.idle[key]:
+                if last_used < deadline:
+                    self.size -= 1
+                    self.close_quietly(conn)
+                else:
+                    fresh.append((conn, last_used))
+            if fresh:
+                self.idle[key] = fresh
+            else:
+                del self.idle[key]
+        self.lock.notify_all()
+
+    def evict_idle(self):
+        with self.lock:
+            self.evict_expired()
+
+    def close_idle(self, credentials):
+        # Closes every idle connection to one server, freeing its connection slots.
+        server = self.server_of(self.key(credentials, None))
+        with self.lock:
+            for key in [key for key in self.idle if self.server_of(key) == server]:
+                for conn, _ in self.idle.pop(key):
+                    self.size -= 1
+                    self.close_quietly(conn)
+            self.lock.notify_all()
+
+    def is_healthy(self, conn):
+        # DISCARD ALL doubles as the liveness probe and drops any session state
+        # (SET, temp tables, prepared statements) left behind by the previous patch.
+        if conn.closed:
+            return False
+        try:
+            conn.autocommit = True
+            cursor = conn.cursor()
+            cursor.execute("DISCARD ALL")
+            cursor.close()
+            conn.autocommit = False
+            return True
+        except Exception:
+            return False
+
+    def discard(self, conn):
+        self.close_quietly(conn)
+        with self.lock:
+            self.size -= 1
+            self.lock.notify()
+
+    def close_all(self):
+        with self.lock:
+            for entries in self.idle.values():
+                for conn, _ in entries:
+                    self.size -= 1
+                    self.close_quietly(conn)
+            self.idle.clear()
+            self.lock.notify_all()
+
+    @staticmethod
+    def close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def is_connection_limit_error(error):
+    # psycopg2 exposes the SQLSTATE as pgcode, asyncpg as sqlstate.
+    sqlstate = getattr(error, 'pgcode', None) or getattr(error, 'sqlstate', None)
+    return sqlstate == TOO_MANY_CONNECTIONS or any(text in str(error) for text in CONNECTION_LIMIT_ERRORS)
@@ -0,0 +1,84 @@
+import os
+from PyQt5.QtWidgets import (QDialog, QFormLayout, QHBoxLayout, QLineEdit, QPushButton, QComboBox, QCheckBox,
+                             QDialogButtonBox, QFileDialog, QMessageBox)
+from copyload import CopyLoad, COPY_FORMATS
+
+# Asks for the data file and target table of a COPY bulk load.
+
+FORMAT_BY_EXTENSION = {'.csv': 'csv', '.tsv': 'text', '.txt': 'text', '.bin': 'binary', '.copy': 'binary'}
+
+
+class CopyLoadDialog(QDialog):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle('Bulk Load with COPY')
+        self.copy_load = None
+
+        self.fileInput = QLineEdit()
+        self.fileInput.setPlaceholderText('CSV, text or binary COPY file')
+        browse_button = QPushButton('Browse...')
+        browse_button.clicked.connect(self.browse)
+        file_layout = QHBoxLayout()
+        file_layout.addWidget(self.fileInput)
+        file_layout.addWidget(browse_button)
+
+        self.tableInput = QLineEdit()
+        self.tableInput.setPlaceholderText('schema.table')
+        self.columnsInput = QLineEdit()
+        self.columnsInput.setPlaceholderText('All columns, in table order')
+        self.formatInput = QComboBox()
+        self.formatInput.addItems(COPY_FORMATS)
+        self.formatInput.currentTextChanged.connect(self.onFormatChanged)
+        self.headerCheck = QCheckBox('First line is a header')
+        self.headerCheck.setChecked(True)
+        self.delimiterInput = QLineEdit()
+        self.delimiterInput.setMaxLength(1)
+        self.delimiterInput.setPlaceholderText('Default')
+
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+
+        layout = QFormLayout()
+        layout.addRow('File:', file_layout)
+        layout.addRow('Table:', self.tableInput)
+        layout.addRow('Columns:', self.columnsInput)
+        layout.addRow('Format:', self.formatInput)
+        layout.addRow('', self.headerCheck)
+        layout.addRow('Delimiter:', self.delimiterInput)
+        layout.addRow(buttons)
+        self.setLayout(layout)
+
+    def browse(self):
+        path, _ = QFileDialog.getOpenFileName(self, 'Select data file', '',
+                                              'Data files (*.csv *.tsv *.txt *.bin *.copy);;All files (*)')
+        if not path:
+            return
+        self.fileInput.setText(path)
+        extension = os.path.splitext(path)[1].lower()
+        if extension in FORMAT_BY_EXTENSION:
+            self.formatInput.setCurrentText(FORMAT_BY_EXTENSION[extension])
+
+    def onFormatChanged(self, copy_format):
+        self.headerCheck.setEnabled(copy_format == 'csv')
+        self.delimiterInput.setEnabled(copy_format != 'binary')
+
+    def accept(self):
+        path = self.fileInput.text().strip()
+        columns = self.columnsInput.text()
+        try:
+            copy_load = CopyLoad(path, self.tableInput.text(), columns.split(',') if columns.strip() else None,
+                                 self.formatInput.currentText(), header=self.headerCheck.isChecked(),
+                                 delimiter=self.delimiterInput.text() or None)
+            size = copy_load.size()
+        except ValueError as e:
+            QMessageBox.critical(self, "Warning!", str(e))
+            return
+        except OSError as e:
+            QMessageBox.critical(self, "Warning!", f"Cannot read the data file: {e}")
+            return
+        if size == 0:
+            QMessageBox.critical(self, "Warning!", 'The selected data file is empty.')
+            return
+        self.copy_load = copy_load
+        super().accept()
@@ -0,0 +1,118 @@
+import os
+import mmap
+import threading
+
+# Bulk loading of one data file into many databases with COPY ... FROM STDIN. The
+# file is memory-mapped once per run and every concurrent COPY stream reads through
+# its own CopyReader over that shared mapping, so the data is neither re-read from
+# disk nor duplicated per database; only the chunk being handed to the driver is
+# copied.
+
+COPY_FORMATS = ('csv', 'text', 'binary')
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def split_table_name(table):
+    # 'schema.table' or 'table'; returns (schema or None, name). Like PostgreSQL, unquoted
+    # names are folded to lower case and double-quoted ones are kept as written.
+    parts = [part.strip() for part in table.strip().split('.')]
+    if len(parts) > 2 or not all(parts):
+        raise ValueError(f"Invalid table name: {table}")
+    parts = [part[1:-1].replace('""', '"') if len(part) > 1 and part[0] == part[-1] == '"'
+             else part.lower() for part in parts]
+    return (None, parts[0]) if len(parts) == 1 else (parts[0], parts[1])
+
+
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+class CopyReader:
+    # File-like view over the shared mapping; psycopg2's copy_expert only calls read().
+    def __init__(self, view):
+        self.view = view
+        self.pos = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.view) - self.pos
+        chunk = self.view[self.pos:self.pos + size]
+        self.pos += len(chunk)
+        return bytes(chunk)
+
+
+class CopyLoad:
+    # Used wherever a patch is expected: execute_patch() streams it with COPY instead
+    # of executing SQL, and the ledger hashes the data together with the COPY command.
+    def __init__(self, path, table, columns=None, format='csv', header=True, delimiter=None, encoding='UTF8'):
+        if format not in COPY_FORMATS:
+            raise ValueError(f"Unknown COPY format: {format}")
+        self.path = path
+        self.schema, self.table = split_table_name(table)
+        self.columns = [column.strip() for column in columns if column.strip()] if columns else None
+        self.format = format
+        self.header = header and format == 'csv'
+        self.delimiter = delimiter if format != 'binary' else None
+        self.encoding = encoding if format != 'binary' else None
+        self.content_hash = None
+        self.mapping = None
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return f"{self.path} -> {self.qualified_table()}"
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def qualified_table(self):
+        name = quote_identifier(self.table)
+        return f"{quote_identifier(self.schema)}.{name}" if self.schema else name
+
+    def copy_sql(self):
+        columns = f" ({', '.join(quote_identifier(column) for column in self.columns)})" if self.columns else ''
+        options = [f"FORMAT {self.format}"]
+        if self.header:
+            options.append("HEADER true")
+        if self.delimiter:
+            options.append("DELIMITER '" + self.delimiter.replace("'", "''") + "'")
+        if self.encoding:
+            options.append(f"ENCODING '{self.encoding}'")
+        return f"COPY {self.qualified_table()}{columns} FROM STDIN WITH ({', '.join(options)})"
+
+    def data(self):
+        # Mapped on first use by whichever worker gets here first.
+        with self.lock:
+            if self.mapping is None:
+                with open(self.path, 'rb') as f:
+                    self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.mapping
+
+    def reader(self):
+        return CopyReader(memoryview(self.data()))
+
+    async def async_chunks(self):
+        # Source for asyncpg's copy_to_table.
+        view = memoryview(self.data())
+        for start in range(0, len(view), COPY_CHUNK_SIZE):
+            yield view[start:start + COPY_CHUNK_SIZE]
+
+    def copy_options(self):
+        # Keyword arguments for asyncpg's copy_to_table.
+        options = {'schema_name': self.schema, 'columns': self.columns, 'format': self.format}
+        if self.header:
+            options['header'] = True
+        if self.delimiter:
+            options['delimiter'] = self.delimiter
+        if self.encoding:
+            options['encoding'] = self.encoding
+        return options
+
+    def close(self):
+        with self.lock:
+            if self.mapping is not None:
+                try:
+                    self.mapping.close()
+                except BufferError:
+                    # A reader still holds a view; the mapping goes when it does.
+                    pass
+                self.mapping = None
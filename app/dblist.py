@@ -0,0 +1,187 @@
+import re
+from bisect import bisect_left
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QSortFilterProxyModel
+
+# Model/view database list for servers with thousands of tenants. The view only
+# paints visible rows, selection is kept in the model as check marks so it survives
+# filtering and refreshes, and the filter works on a sorted index of names.
+
+
+def entry_key(entry):
+    return (entry.server['name'], entry.name)
+
+
+def sort_key(entry):
+    return (entry.name.lower(), entry.server['name'], entry.name)
+
+
+def row_runs(rows):
+    # Sorted row numbers as (first, last) runs of consecutive rows.
+    runs = []
+    for row in rows:
+        if runs and runs[-1][1] == row - 1:
+            runs[-1] = (runs[-1][0], row)
+        else:
+            runs.append((row, row))
+    return runs
+
+
+class DatabaseListModel(QAbstractListModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.entries = []
+        self.sort_keys = []
+        self.checked = set()
+        self.multi_server = False
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.entries)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        entry = self.entries[index.row()]
+        if role == Qt.DisplayRole:
+            return f"{entry.name} [{entry.server['name']}]" if self.multi_server else entry.name
+        if role == Qt.CheckStateRole:
+            return Qt.Checked if entry_key(entry) in self.checked else Qt.Unchecked
+        if role == Qt.ToolTipRole:
+            size = f"{entry.size / (1024 * 1024):.0f} MB" if entry.size is not None else "unknown"
+            return (f"Server: {entry.server['name']}\nSize: {size}\nEncoding: {entry.encoding}\n"
+                    f"Last patched: {entry.last_patched or 'never'}")
+        if role == Qt.UserRole:
+            return (entry.server, entry.name)
+        return None
+
+    def flags(self, index):
+        return Qt.ItemIsEnabled
+
+    def setEntries(self, entries):
+        # Applies the difference to the list as row removals, in-place updates and row
+        # insertions, so the view keeps its scroll position and current index, and the
+        # check marks of databases that still exist. Returns (added, removed) counts.
+        new_entries = {entry_key(entry): entry for entry in entries}
+        old_keys = {entry_key(entry) for entry in self.entries}
+        removed_rows = [row for row, entry in enumerate(self.entries) if entry_key(entry) not in new_entries]
+        for first, last in reversed(row_runs(removed_rows)):
+            self.beginRemoveRows(QModelIndex(), first, last)
+            del self.entries[first:last + 1]
+            self.endRemoveRows()
+        self.checked &= set(new_entries)
+        for row, entry in enumerate(self.entries):
+            current = new_entries[entry_key(entry)]
+            if current != entry:
+                self.entries[row] = current
+                self.dataChanged.emit(self.index(row), self.index(row))
+        added = sorted((entry for key, entry in new_entries.items() if key not in old_keys), key=sort_key)
+        order = [sort_key(entry) for entry in self.entries]
+        start = 0
+        while start < len(added):
+            # New entries that fall between the same two existing rows go in as one block.
+            row = bisect_left(order, sort_key(added[start]))
+            end = start + 1
+            while end < len(added) and (row == len(order) or sort_key(added[end]) < order[row]):
+                end += 1
+            position = row + start
+            self.beginInsertRows(QModelIndex(), position, position + end - start - 1)
+            self.entries[position:position] = added[start:end]
+            self.endInsertRows()
+            start = end
+        self.sort_keys = [entry.name.lower() for entry in self.entries]
+        multi_server = len({entry.server['name'] for entry in self.entries}) > 1
+        if multi_server != self.multi_server:
+            # Names are shown with their server once there is more than one.
+            self.multi_server = multi_server
+            if self.entries:
+                self.dataChanged.emit(self.index(0), self.index(len(self.entries) - 1), [Qt.DisplayRole])
+        return len(added), len(removed_rows)
+
+    def prefixRange(self, prefix):
+        # Rows whose lower-cased name starts with prefix form one contiguous block.
+        prefix = prefix.lower()
+        low = bisect_left(self.sort_keys, prefix)
+        high = bisect_left(self.sort_keys, prefix + '\U0010ffff', low)
+        return low, high
+
+    def toggle(self, row):
+        key = entry_key(self.entries[row])
+        if key in self.checked:
+            self.checked.discard(key)
+        else:
+            self.checked.add(key)
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.CheckStateRole])
+
+    def setChecked(self, rows, checked):
+        keys = {entry_key(self.entries[row]) for row in rows}
+        if checked:
+            self.checked |= keys
+        else:
+            self.checked -= keys
+        if self.entries:
+            self.dataChanged.emit(self.index(0), self.index(len(self.entries) - 1), [Qt.CheckStateRole])
+
+    def selectedTargets(self):
+        return [(entry.server, entry.name) for entry in self.entries if entry_key(entry) in self.checked]
+
+
+class DatabaseFilterProxy(QSortFilterProxyModel):
+    # Plain text is a case-insensitive prefix resolved with a binary search on the
+    # sorted names, so each row check is a range comparison. Regex mode scans names
+    # once per change and narrows the previous result when the pattern only grew.
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.text = ''
+        self.use_regex = False
+        self.prefix_range = None
+        self.regex_rows = None
+        self.regex_text = None
+        self.error = None
+
+    def setFilter(self, text, use_regex):
+        model = self.sourceModel()
+        self.error = None
+        self.prefix_range = None
+        if not text:
+            self.regex_rows = None
+            self.regex_text = None
+        elif use_regex:
+            try:
+                pattern = re.compile(text, re.IGNORECASE)
+            except re.error as e:
+                self.error = str(e)
+                return
+            candidates = range(model.rowCount())
+            if self.regex_rows is not None and self.regex_text and text.startswith(self.regex_text) \
+                    and re.escape(text) == text:
+                # A literal pattern that only got longer can only match a subset.
+                candidates = self.regex_rows
+            self.regex_rows = {row for row in candidates if pattern.search(model.entries[row].name)}
+            self.regex_text = text
+        else:
+            self.prefix_range = model.prefixRange(text)
+            self.regex_rows = None
+            self.regex_text = None
+        self.text = text
+        self.use_regex = use_regex
+        self.invalidateFilter()
+
+    def resetIndex(self):
+        # Call after setEntries; rows have moved.
+        self.regex_rows = None
+        self.regex_text = None
+        self.setFilter(self.text, self.use_regex)
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        if self.prefix_range is not None:
+            return self.prefix_range[0] <= source_row < self.prefix_range[1]
+        if self.regex_rows is not None:
+            return source_row in self.regex_rows
+        return True
+
+    def visibleSourceRows(self):
+        if self.prefix_range is not None:
+            return range(*self.prefix_range)
+        if self.regex_rows is not None:
+            return sorted(self.regex_rows)
+        return range(self.sourceModel().rowCount())
@@ -0,0 +1,244 @@
+import re
+import heapq
+import threading
+from functools import total_ordering
+from resultset import ResultSpool, PAGE_SIZE, check_columns
+
+# Scatter-gather on top of resultset.run_read_query. Nothing in here may import Qt.
+#
+# Ordered merge: every database returns rows ORDER BY the same key, so the spool
+# holds one sorted run per database and heapq.merge combines them holding one chunk
+# per database, instead of collecting everything and sorting. The merge runs once
+# every database has been read: merging as rows arrive would need a session open on
+# every database at once, far past the concurrency limit.
+#
+# Keys are compared in Python, i.e. text by code point. That is the order of
+# COLLATE "C" (byte order of UTF-8), not of a database's default collation, where
+# e.g. 'a' sorts before 'B'; text keys must therefore be sorted with COLLATE "C"
+# (ORDER BY name COLLATE "C"). Each run is checked against the key as it is merged.
+#
+# Aggregation: an Aggregation is passed to run_read_query in place of the spool and
+# folds each fetched batch into per-group COUNT / SUM / MIN / MAX as it arrives, so
+# only the groups are ever kept. Each database is folded on its own first and its
+# groups combined into the totals once it has been read completely, so a database
+# failing mid-fetch leaves nothing behind. To combine aggregates the databases
+# computed themselves, aggregate their output (e.g. sum(count) of a per-tenant count(*)).
+
+MERGE_BATCH_SIZE = 500
+COLLATE_HINT = '; text keys must be sorted with COLLATE "C", e.g. ORDER BY name COLLATE "C"'
+ORDER_ITEM = re.compile(r'^\s*("(?:[^"]|"")+"|[^\s,"]+)\s*(?:\s(asc|desc))?\s*$', re.IGNORECASE)
+AGGREGATE_ITEM = re.compile(r'^\s*(count|sum|min|max)\s*\(\s*(\*|"(?:[^"]|"")+"|[^\s()"]+)\s*\)\s*$', re.IGNORECASE)
+BY_CLAUSE = re.compile(r'\s+by\s+', re.IGNORECASE)
+
+
+def column_name(text):
+    # Columns come back named as PostgreSQL reports them: quoted names as written,
+    # unquoted ones folded to lower case.
+    if len(text) > 1 and text[0] == text[-1] == '"':
+        return text[1:-1].replace('""', '"')
+    return text.lower()
+
+
+def column_index(columns, name):
+    try:
+        return columns.index(name)
+    except ValueError:
+        raise ValueError(f"Column {name} is not in the result ({', '.join(columns)})") from None
+
+
+def parse_order(text):
+    # "created_at DESC, id" -> [('created_at', True), ('id', False)].
+    order = []
+    for item in text.split(','):
+        match = ORDER_ITEM.match(item)
+        if not match:
+            raise ValueError(f"Invalid merge key: {item.strip() or text}")
+        order.append((column_name(match.group(1)), (match.group(2) or '').lower() == 'desc'))
+    return order
+
+
+def parse_aggregation(text):
+    # "count(*), sum(amount), max(updated_at) BY status, region" -> (aggregates, group columns).
+    parts = BY_CLAUSE.split(text.strip())
+    if len(parts) > 2:
+        raise ValueError(f"Invalid aggregation: {text}")
+    aggregates = []
+    for item in parts[0].split(','):
+        match = AGGREGATE_ITEM.match(item)
+        if not match:
+            raise ValueError(f"Invalid aggregate: {item.strip() or text} (use count, sum, min or max)")
+        column = None if match.group(2) == '*' else column_name(match.group(2))
+        if column is None and match.group(1).lower() != 'count':
+            raise ValueError(f"{match.group(1)}(*) is not an aggregate")
+        aggregates.append((match.group(1).lower(), column))
+    group_by = [column_name(column.strip()) for column in parts[1].split(',')] if len(parts) == 2 else []
+    if not all(group_by):
+        raise ValueError(f"Invalid group columns: {parts[1]}")
+    return aggregates, group_by
+
+
+@total_ordering
+class SortKey:
+    # Key of one row under a mixed ASC/DESC order, NULLs placed as PostgreSQL does by
+    # default (last ascending, first descending).
+    __slots__ = ('values', 'order')
+
+    def __init__(self, values, order):
+        self.values = values
+        self.order = order
+
+    def __eq__(self, other):
+        return self.values == other.values
+
+    def __lt__(self, other):
+        for (_, descending), mine, theirs in zip(self.order, self.values, other.values):
+            if mine == theirs:
+                continue
+            if mine is None or theirs is None:
+                return (theirs is None) != descending
+            return (mine > theirs) if descending else (mine < theirs)
+        return False
+
+
+def sorted_run(spool, source, positions, order):
+    # Rows of one database with their keys, checking they really arrive in key order.
+    previous = None
+    for row in spool.stream(source):
+        key = SortKey([row[position] for position in positions], order)
+        if previous is not None and key < previous:
+            hint = COLLATE_HINT if any(isinstance(value, str) for value in key.values) else ''
+            raise ValueError(f"Rows of {source[0]}/{source[1]} are not ordered by the merge key; "
+                             f"add a matching ORDER BY to the query{hint}")
+        previous = key
+        yield key, row
+
+
+def merge_spool(spool, order):
+    # Returns a new ResultSpool with the rows of every database merged in key order.
+    if spool.columns is None:
+        return spool
+    offset = len(spool.tag_columns)
+    positions = [offset + column_index(spool.columns, name) for name, _ in order]
+    runs = [sorted_run(spool, source, positions, order) for source in spool.sources()]
+    merged = ResultSpool(spool.page_size, spool.tag_columns)
+    batch = []
+    try:
+        for _, row in heapq.merge(*runs, key=lambda item: item[0]):
+            batch.append(row)
+            if len(batch) == MERGE_BATCH_SIZE:
+                merged.write(spool.columns, batch)
+                batch = []
+        merged.write(spool.columns, batch)
+    except BaseException:
+        merged.close()
+        raise
+    return merged
+
+
+def combine(function, current, value):
+    # One aggregate of current (None while there is none) with another value of it.
+    if value is None:
+        return current
+    if current is None:
+        return value
+    if function in ('count', 'sum'):
+        return current + value
+    return min(current, value) if function == 'min' else max(current, value)
+
+
+class Aggregation:
+    # Same segment() as ResultSpool, so run_read_query can feed it batches from every
+    # worker. Each group holds one running value per aggregate.
+    def __init__(self, aggregates, group_by=()):
+        self.aggregates = list(aggregates)
+        self.group_by = list(group_by)
+        self.lock = threading.Lock()
+        self.columns = None
+        self.groups = {}
+        self.row_count = 0
+
+    def segment(self, server, database):
+        return AggregationSegment(self)
+
+    def check_columns(self, columns):
+        with self.lock:
+            check_columns(self.columns, columns)
+
+    def merge(self, columns, groups, row_count):
+        # Combines the groups of one database into the totals.
+        with self.lock:
+            check_columns(self.columns, columns)
+            if self.columns is None:
+                self.columns = list(columns)
+            for key, values in groups.items():
+                current = self.groups.get(key)
+                if current is None:
+                    self.groups[key] = values
+                    continue
+                for index, (function, _) in enumerate(self.aggregates):
+                    current[index] = combine(function, current[index], values[index])
+            self.row_count += row_count
+
+    def header(self):
+        return self.group_by + [f"{function}({column or '*'})" for function, column in self.aggregates]
+
+    def rows(self):
+        # One row per group ordered by the group values, NULL groups last.
+        with self.lock:
+            order = [(name, False) for name in self.group_by]
+            return [list(key) + list(values)
+                    for key, values in sorted(self.groups.items(), key=lambda item: SortKey(item[0], order))]
+
+    def to_spool(self, page_size=PAGE_SIZE):
+        spool = ResultSpool(page_size, tag_columns=[])
+        spool.write(self.header(), self.rows())
+        return spool
+
+
+class AggregationSegment:
+    # The groups of one database while it is being read; see SpoolSegment.
+    def __init__(self, aggregation):
+        self.aggregation = aggregation
+        self.columns = None
+        self.group_positions = None
+        self.positions = None
+        self.groups = {}
+        self.row_count = 0
+
+    def add(self, columns, rows):
+        if self.columns is None:
+            self.aggregation.check_columns(columns)
+            self.columns = list(columns)
+            self.group_positions = [column_index(self.columns, name) for name in self.aggregation.group_by]
+            self.positions = [None if column is None else column_index(self.columns, column)
+                              for _, column in self.aggregation.aggregates]
+        for row in rows:
+            key = tuple(row[position] for position in self.group_positions)
+            values = self.groups.get(key)
+            if values is None:
+                values = self.groups[key] = [0 if function == 'count' else None
+                                             for function, _ in self.aggregation.aggregates]
+            for index, ((function, _), position) in enumerate(zip(self.aggregation.aggregates, self.positions)):
+                value = 1 if position is None else row[position]
+                if value is not None and function == 'count':
+                    value = 1
+                values[index] = combine(function, values[index], value)
+        self.row_count += len(rows)
+
+    def commit(self):
+        if self.columns is not None:
+            self.aggregation.merge(self.columns, self.groups, self.row_count)
+        self.groups = {}
+
+    def discard(self):
+        self.groups = {}
+
+
+def gathered(sink, order=None):
+    # The result to show or export once every database has been read: the aggregated
+    # groups, the merged rows, or the spool itself in arrival order.
+    if isinstance(sink, Aggregation):
+        return sink.to_spool()
+    if order:
+        return merge_spool(sink, order)
+    return sink
@@ -0,0 +1,244 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import namedtuple
+from contextlib import closing
+from sqlscript import PatchFile
+from copyload import CopyLoad
+from ledger import server_key, hash_patch
+from patchrun import PatchOptions
+
+# Crash-safe journal of patch runs, so an interrupted run can be resumed. A run
+# writes its plan (patch, settings and every target) before the first database
+# starts, then one row update per database as it starts and as it ends; every
+# update is committed on its own, so whatever the process gets killed by, the
+# journal says which databases committed. Resuming dispatches the databases that
+# never finished (planned, started without a result, or cancelled) as a new run with
+# the settings of the original one. Failed databases are not retried: they need the
+# patch or the database fixed first, then a normal run.
+#
+# A database whose commit went through just before a crash still shows as started:
+# its result, in the local ledger as in the journal, is only recorded after the
+# commit, so resuming cannot tell it from one that rolled back. Only the in-database
+# ledger of a run that skips applied databases keeps it from being patched a second
+# time (see skips_committed); otherwise the GUI asks before dispatching such
+# databases again, and the CLI dispatches them with a warning.
+#
+# Credentials are not journaled: targets are matched to the configured servers by
+# host and port on resume.
+
+JOURNAL_FILE = 'run_journal.db'
+RUNNING = 'running'
+FINISHED = 'finished'
+PLANNED = 'planned'
+STARTED = 'started'
+COMMITTED = 'committed'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+CANCELLED = 'cancelled'
+UNFINISHED = (PLANNED, STARTED, CANCELLED)
+
+# work describes the patch (see describe_work), settings how it was run (see run_settings).
+JournaledRun = namedtuple('JournaledRun', ['run_id', 'patch_hash', 'work', 'settings', 'started_at', 'finished_at',
+                                           'status', 'resumed_from'])
+JournaledTarget = namedtuple('JournaledTarget', ['server', 'server_name', 'database', 'state', 'error'])
+
+
+def describe_work(query):
+    # Patch files and COPY data are referenced by path; the hash check on resume
+    # refuses them if they changed since.
+    if isinstance(query, CopyLoad):
+        return {'kind': 'copy', 'path': os.path.abspath(query.path), 'table': query.qualified_table(),
+                'columns': query.columns, 'format': query.format, 'header': query.header,
+                'delimiter': query.delimiter, 'encoding': query.encoding}
+    if isinstance(query, PatchFile):
+        return {'kind': 'file', 'path': os.path.abspath(query.path)}
+    return {'kind': 'text', 'text': query}
+
+
+def load_work(work):
+    if work['kind'] == 'copy':
+        return CopyLoad(work['path'], work['table'], work['columns'], work['format'], work['header'],
+                        work['delimiter'], work['encoding'])
+    if work['kind'] == 'file':
+        return PatchFile(work['path'])
+    return work['text']
+
+
+def run_settings(concurrency, engine, options, patch_ledger=None):
+    return {
+        'concurrency': concurrency,
+        'engine': engine.lower(),
+        'options': (options or PatchOptions())._asdict(),
+        'skip_applied': patch_ledger.skip_applied if patch_ledger else True,
+        'ledger_in_database': patch_ledger.in_database if patch_ledger else False,
+    }
+
+
+def settings_options(settings):
+    # Options journaled by another version may lack fields or have extra ones.
+    return PatchOptions(**{key: value for key, value in settings['options'].items() if key in PatchOptions._fields})
+
+
+def target_state(outcome):
+    if outcome.skipped:
+        return SKIPPED
+    if outcome.cancelled:
+        return CANCELLED
+    return COMMITTED if outcome.ok else FAILED
+
+
+class RunJournal:
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        with closing(self.connect()) as conn:
+            # WAL keeps a commit to one append, and a reader from another process
+            # (e.g. a resume while the run is still going) does not block the writer.
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                " run_id TEXT PRIMARY KEY,"
+                " patch_hash TEXT NOT NULL,"
+                " work TEXT NOT NULL,"
+                " settings TEXT NOT NULL,"
+                " started_at REAL NOT NULL,"
+                " finished_at REAL,"
+                " status TEXT NOT NULL,"
+                " resumed_from TEXT)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS run_targets ("
+                " run_id TEXT NOT NULL,"
+                " server TEXT NOT NULL,"
+                " server_name TEXT NOT NULL,"
+                " dbname TEXT NOT NULL,"
+                " position INTEGER NOT NULL,"
+                " state TEXT NOT NULL,"
+                " error TEXT,"
+                " updated_at REAL NOT NULL,"
+                " PRIMARY KEY (run_id, server, dbname))"
+            )
+            conn.commit()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def begin(self, run_id, query, patch_hash, targets, settings, resumed_from=None):
+        # Records the plan and returns the JournalRun to report progress to.
+        now = time.time()
+        with closing(self.connect()) as conn:
+            conn.execute(
+                "INSERT INTO runs (run_id, patch_hash, work, settings, started_at, status, resumed_from)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (run_id, patch_hash, json.dumps(describe_work(query)), json.dumps(settings), now, RUNNING,
+                 resumed_from)
+            )
+            conn.executemany(
+                "INSERT INTO run_targets (run_id, server, server_name, dbname, position, state, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(run_id, server_key(server), server['name'], db, position, PLANNED, now)
+                 for position, (server, db) in enumerate(targets)]
+            )
+            conn.commit()
+        return JournalRun(self, run_id, targets)
+
+    def last_run(self, run_id=None):
+        # The given run, or the most recent one; None when there is none.
+        with closing(self.connect()) as conn:
+            if run_id:
+                row = conn.execute("SELECT * FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+            else:
+                row = conn.execute("SELECT * FROM runs ORDER BY started_at DESC LIMIT 1").fetchone()
+        if row is None:
+            return None
+        run_id, patch_hash, work, settings, started_at, finished_at, status, resumed_from = row
+        return JournaledRun(run_id, patch_hash, json.loads(work), json.loads(settings), started_at, finished_at,
+                            status, resumed_from)
+
+    def targets(self, run_id):
+        with closing(self.connect()) as conn:
+            rows = conn.execute(
+                "SELECT server, server_name, dbname, state, error FROM run_targets WHERE run_id = ? ORDER BY position",
+                (run_id,)
+            ).fetchall()
+        return [JournaledTarget(*row) for row in rows]
+
+
+class JournalRun:
+    # One run being journaled. started() and record() fit run_patch's on_start and
+    # on_result; they may be called from the run's thread or its event loop.
+    def __init__(self, journal, run_id, targets):
+        self.run_id = run_id
+        self.keys = {server['name']: server_key(server) for server, _ in targets}
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(journal.path, timeout=30, check_same_thread=False)
+        # In WAL mode NORMAL still survives the process crashing; only a power loss
+        # can take back the last commits. It saves an fsync per database.
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+
+    def update(self, server_name, db, state, error=None):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE run_targets SET state = ?, error = ?, updated_at = ? WHERE run_id = ? AND server = ? AND dbname = ?",
+                (state, error, time.time(), self.run_id, self.keys[server_name], db)
+            )
+            self.conn.commit()
+
+    def started(self, server_name, db):
+        self.update(server_name, db, STARTED)
+
+    def record(self, outcome):
+        self.update(outcome.server, outcome.database, target_state(outcome), outcome.error or None)
+
+    def close(self, status=None):
+        # Without a status the run stays RUNNING, i.e. it shows as interrupted.
+        with self.lock:
+            if status:
+                self.conn.execute("UPDATE runs SET status = ?, finished_at = ? WHERE run_id = ?",
+                                  (status, time.time(), self.run_id))
+                self.conn.commit()
+            self.conn.close()
+
+
+def resume_plan(journal, run, servers):
+    # Returns (targets that never ran or were cancelled, targets that had started
+    # without a recorded result and may have committed) for run, matched to servers;
+    # raises ValueError when the run's servers are not configured.
+    by_key = {server_key(server): server for server in servers}
+    unfinished = [target for target in journal.targets(run.run_id) if target.state in UNFINISHED]
+    missing = sorted({target.server_name for target in unfinished if target.server not in by_key})
+    if missing:
+        raise ValueError(f"Servers of run {run.run_id} are not configured: {', '.join(missing)}")
+    pending = [(by_key[target.server], target.database) for target in unfinished if target.state != STARTED]
+    started = [(by_key[target.server], target.database) for target in unfinished if target.state == STARTED]
+    return pending, started
+
+
+def skips_committed(settings):
+    # Whether a run with these settings skips a database that committed without a
+    # recorded result, i.e. checks the in-database ledger.
+    return settings['ledger_in_database'] and settings['skip_applied']
+
+
+def load_resumed_work(run):
+    # The patch of run, refusing it when it is no longer the one that was journaled.
+    query = load_work(run.work)
+    if hash_patch(query) != run.patch_hash:
+        raise ValueError(f"The patch of run {run.run_id} has changed since ({run.work.get('path', 'text')})")
+    return query
+
+
+def describe_run(journal, run):
+    # One line on where run stands, e.g. for a resume prompt.
+    counts = {}
+    for target in journal.targets(run.run_id):
+        counts[target.state] = counts.get(target.state, 0) + 1
+    unfinished = sum(counts.get(state, 0) for state in UNFINISHED)
+    status = 'interrupted' if run.status == RUNNING else run.status
+    started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run.started_at))
+    work = run.work.get('path') or 'query text'
+    return (f"Run {run.run_id} ({work}, started {started}, {status}): {sum(counts.values())} databases, "
+            f"{counts.get(COMMITTED, 0)} committed, {counts.get(SKIPPED, 0)} skipped, "
+            f"{counts.get(FAILED, 0)} failed, {unfinished} unfinished.")
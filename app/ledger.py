@@ -0,0 +1,143 @@
+import hashlib
+import sqlite3
+import time
+from contextlib import closing
+from sqlscript import PatchFile
+from copyload import CopyLoad
+
+# Records which patch (by content hash) has been applied to which (server, database)
+# so that re-runs after a partial failure only touch the databases that still need it.
+
+LEDGER_FILE = 'patch_ledger.db'
+TARGET_LEDGER_TABLE = 'public.patchrun_ledger'
+TARGET_LEDGER_DDL = (
+    f"CREATE TABLE IF NOT EXISTS {TARGET_LEDGER_TABLE} ("
+    " patch_hash text PRIMARY KEY,"
+    " applied_at timestamptz NOT NULL DEFAULT now())"
+)
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_patch(query):
+    # Patch files are hashed once and the result kept on the PatchFile.
+    if isinstance(query, PatchFile):
+        if query.content_hash is None:
+            digest = hashlib.sha256()
+            with open(query.path, 'rb') as f:
+                for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                    digest.update(block)
+            query.content_hash = digest.hexdigest()
+        return query.content_hash
+    if isinstance(query, CopyLoad):
+        # The same data loaded into another table or columns is a different patch.
+        if query.content_hash is None:
+            digest = hashlib.sha256(query.copy_sql().encode('utf-8'))
+            digest.update(query.data())
+            query.content_hash = digest.hexdigest()
+        return query.content_hash
+    return hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+
+def server_key(server):
+    # Ledger rows are keyed by address, not by the display name, so renaming an
+    # inventory section does not forget its history.
+    return f"{server['host']}:{server['port']}"
+
+
+class PatchLedger:
+    # The local ledger is a SQLite file. With in_database=True every successful patch
+    # also inserts its hash into TARGET_LEDGER_TABLE inside the patched database, in
+    # the same transaction, and that table is consulted before patching.
+    def __init__(self, path=LEDGER_FILE, in_database=False, skip_applied=True):
+        self.path = path
+        self.in_database = in_database
+        self.skip_applied = skip_applied
+        with closing(self.connect()) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS applied_patches ("
+                " patch_hash TEXT NOT NULL,"
+                " server TEXT NOT NULL,"
+                " dbname TEXT NOT NULL,"
+                " applied_at TEXT NOT NULL,"
+                " PRIMARY KEY (patch_hash, server, dbname))"
+            )
+            conn.commit()
+
+    def connect(self):
+        # A short-lived connection per call keeps the ledger usable from any thread.
+        return sqlite3.connect(self.path, timeout=30)
+
+    def applied(self, patch_hash):
+        with closing(self.connect()) as conn:
+            rows = conn.execute(
+                "SELECT server, dbname FROM applied_patches WHERE patch_hash = ?", (patch_hash,)
+            ).fetchall()
+        return set(rows)
+
+    def last_applied(self, server):
+        # Most recent successful patch time per database of one server.
+        with closing(self.connect()) as conn:
+            rows = conn.execute(
+                "SELECT dbname, MAX(applied_at) FROM applied_patches WHERE server = ? GROUP BY dbname",
+                (server_key(server),)
+            ).fetchall()
+        return dict(rows)
+
+    def partition(self, patch_hash, targets):
+        # Returns (pending, already_applied) lists of targets.
+        if not self.skip_applied:
+            return list(targets), []
+        applied = self.applied(patch_hash)
+        pending = []
+        done = []
+        for server, db in targets:
+            if (server_key(server), db) in applied:
+                done.append((server, db))
+            else:
+                pending.append((server, db))
+        return pending, done
+
+    def record(self, patch_hash, server, db):
+        with closing(self.connect()) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO applied_patches (patch_hash, server, dbname, applied_at) VALUES (?, ?, ?, ?)",
+                (patch_hash, server_key(server), db, time.strftime('%Y-%m-%d %H:%M:%S'))
+            )
+            conn.commit()
+
+
+def target_has_patch(cursor, patch_hash):
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (TARGET_LEDGER_TABLE,))
+    if not cursor.fetchone()[0]:
+        return False
+    cursor.execute(f"SELECT 1 FROM {TARGET_LEDGER_TABLE} WHERE patch_hash = %s", (patch_hash,))
+    return cursor.fetchone() is not None
+
+
+def record_in_target(cursor, patch_hash):
+    cursor.execute(TARGET_LEDGER_DDL)
+    cursor.execute(
+        f"INSERT INTO {TARGET_LEDGER_TABLE} (patch_hash) VALUES (%s) ON CONFLICT (patch_hash) DO NOTHING",
+        (patch_hash,)
+    )
+
+
+async def target_has_patch_async(conn, patch_hash):
+    if not await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", TARGET_LEDGER_TABLE):
+        return False
+    return await conn.fetchval(f"SELECT 1 FROM {TARGET_LEDGER_TABLE} WHERE patch_hash = $1", patch_hash) is not None
+
+
+async def record_in_target_async(conn, patch_hash):
+    await conn.execute(TARGET_LEDGER_DDL)
+    await conn.execute(
+        f"INSERT INTO {TARGET_LEDGER_TABLE} (patch_hash) VALUES ($1) ON CONFLICT (patch_hash) DO NOTHING",
+        patch_hash
+    )
+
+
+def record_in_target_sql(patch_hash):
+    # record_in_target as literal SQL, for a patch sent as pipelined messages. The hash
+    # is hex, so it needs no quoting beyond the quotes.
+    return (f"{TARGET_LEDGER_DDL};\n"
+            f"INSERT INTO {TARGET_LEDGER_TABLE} (patch_hash) VALUES ('{patch_hash}') ON CONFLICT (patch_hash) DO NOTHING")
@@ -0,0 +1,52 @@
+import time
+from PyQt5.QtCore import QTimer
+from PyQt5.QtWidgets import QPlainTextEdit
+
+# Read-only log window that batches appends. Lines are queued and written to the
+# widget once per flush interval, the widget keeps only the newest lines, and the
+# complete session is appended to a history file on disk.
+
+FLUSH_INTERVAL_MS = 100
+MAX_LINES = 5000
+HISTORY_FILE = 'patchrun_history.log'
+
+
+class LogView(QPlainTextEdit):
+    def __init__(self, parent=None, history_file=HISTORY_FILE, max_lines=MAX_LINES):
+        super().__init__(parent)
+        self.setReadOnly(True)
+        self.setMaximumBlockCount(max_lines)
+        self.pending = []
+        self.history_file = history_file
+        self.history = None
+        self.flush_timer = QTimer(self)
+        self.flush_timer.timeout.connect(self.flush)
+        self.flush_timer.start(FLUSH_INTERVAL_MS)
+
+    def append(self, text):
+        # Same call as QTextEdit.append, but only queues the line.
+        self.pending.append(text)
+
+    def flush(self):
+        if not self.pending:
+            return
+        lines, self.pending = self.pending, []
+        self.appendPlainText("\n".join(lines))
+        self.writeHistory(lines)
+
+    def writeHistory(self, lines):
+        try:
+            if self.history is None:
+                self.history = open(self.history_file, 'a', encoding='utf-8')
+            stamp = time.strftime('%Y-%m-%d %H:%M:%S')
+            self.history.write("".join(f"{stamp} {line}\n" for line in lines))
+            self.history.flush()
+        except OSError:
+            # The on-screen log must keep working even if the history file cannot be written.
+            self.history = None
+
+    def closeHistory(self):
+        self.flush()
+        if self.history is not None:
+            self.history.close()
+            self.history = None
@@ -1,71 +1,101 @@
-import sys
-import re
-import configparser
-from threading import Thread
-import psycopg2
-from PyQt5.QtWidgets import *
-from PyQt5.QtCore import *
+import time
+STARTUP_STARTED = time.perf_counter()
 
-CONFIG_FILE = 'config.ini'
+import sys
+from PyQt5.QtWidgets import (QApplication, QWidget, QVBoxLayout, QGridLayout, QLabel, QLineEdit, QSpinBox,
+                             QComboBox, QCheckBox, QSplitter, QListView, QPushButton, QTextEdit,
+                             QProgressBar, QMessageBox, QFileDialog, QHBoxLayout)
+from PyQt5.QtCore import Qt, QTimer
+from connpool import ConnectionPool
+from dblist import DatabaseListModel, DatabaseFilterProxy
+from logview import LogView
+
+# Only what the first paint needs is imported here. patchrun, the SQLite catalog,
+# journal and ledger, the worker threads and the result windows are imported where
+# they are used, after the window is on screen (see loadState).
+
+STARTUP_IMPORTED = time.perf_counter()
+
+DEFAULT_CONCURRENCY = 8
+MAX_CONCURRENCY = 64
+MAX_ASYNC_CONCURRENCY = 500
+ENGINE_THREADS = 'Threads'
+ENGINE_ASYNCIO = 'Asyncio'
+GATHER_COLLECT = 'Collect rows'
+GATHER_MERGE = 'Merge by key'
+GATHER_AGGREGATE = 'Aggregate'
+GATHER_PLACEHOLDERS = {
+    GATHER_COLLECT: '',
+    GATHER_MERGE: 'ORDER BY key every database sorts by (text with COLLATE "C"), e.g. created_at DESC, id',
+    GATHER_AGGREGATE: 'e.g. count(*), sum(amount), max(updated_at) BY status',
+}
+POOL_EVICT_INTERVAL_MS = 60 * 1000
+VERSION_FILE = 'version.txt'
+STARTUP_PROFILE_FILE = 'startup_profile.csv'
+METRICS_REFRESH_MS = 1000
+MAX_TIMEOUT_MS = 24 * 60 * 60 * 1000
+TIMEOUT_STEP_MS = 100
+TIMEOUT_UNITS = {'us': 0.001, 'ms': 1, 's': 1000, 'min': 60 * 1000, 'h': 3600 * 1000, 'd': 86400 * 1000}
+
+
+def timeout_milliseconds(value):
+    # PostgreSQL duration setting ('5s', '250ms', '1.5min', bare milliseconds) in whole
+    # milliseconds, None when it is not one. A non-zero timeout never becomes 0 (none).
+    import re
+    match = re.fullmatch(r'\s*(\d+(?:\.\d*)?)\s*(us|ms|s|min|h|d)?\s*', value or '')
+    if not match:
+        return None
+    milliseconds = float(match.group(1)) * TIMEOUT_UNITS[match.group(2) or 'ms']
+    return max(round(milliseconds), 1) if milliseconds > 0 else 0
+
+class StartupProfile:
+    # Enabled with --profile-startup. Times are measured from the first line of this
+    # script, so the interpreter/bootloader start-up before it is not included.
+    def __init__(self):
+        self.marks = [('start', STARTUP_STARTED), ('imports', STARTUP_IMPORTED)]
 
-class DatabaseThread(QThread):
-    databases_fetched = pyqtSignal(list)
-    error_occurred = pyqtSignal(str)
-    query_executed = pyqtSignal(str)
+    def mark(self, name):
+        self.marks.append((name, time.perf_counter()))
 
-    def __init__(self, credentials, query=None, databases=None):
-        super().__init__()
-        self.credentials = credentials
-        self.query = query
-        self.databases = databases
+    def phases(self):
+        return [(name, (at - self.marks[i][1]) * 1000) for i, (name, at) in enumerate(self.marks[1:])]
 
-    def run(self):
-        if self.query:
-            self.execute_query()
-        else:
-            self.fetch_databases()
+    def report(self):
+        total = (self.marks[-1][1] - STARTUP_STARTED) * 1000
+        details = ", ".join(f"{name} {ms:.0f} ms" for name, ms in self.phases())
+        return f"Startup to first paint: {total:.0f} ms ({details})"
 
-    def fetch_databases(self):
+    def save(self):
         try:
-            conn = psycopg2.connect(
-                dbname='postgres',
-                host=self.credentials['host'],
-                port=self.credentials['port'],
-                user=self.credentials['user'],
-                password=self.credentials['password']
-            )
-            cursor = conn.cursor()
-            cursor.execute("SELECT datname FROM pg_database WHERE datname NOT LIKE '%azure%' AND datname <> 'template0' AND datname <> 'template1' AND datname<>'postgres' ORDER BY datname desc")
-            databases = cursor.fetchall()
-            conn.commit()
-            conn.close()
-            self.databases_fetched.emit([db[0] for db in databases])
-        except Exception as e:
-            self.error_occurred.emit(f"Error fetching databases: {str(e)}")
-
-    def execute_query(self):
-        results = []
-        for db in self.databases:
-            try:
-                conn = psycopg2.connect(
-                    dbname=db,
-                    host=self.credentials['host'],
-                    port=self.credentials['port'],
-                    user=self.credentials['user'],
-                    password=self.credentials['password']
-                )
-                cursor = conn.cursor()
-                cursor.execute(self.query)
-                conn.commit()
-                conn.close()
-                results.append(f"Patch successfully applied to database {db}.")
-            except Exception as e:
-                results.append(f"Error from database {db}: {str(e)}")
-        self.query_executed.emit("\n".join(results))
+            with open(VERSION_FILE, 'r') as f:
+                version = f.read().strip()
+        except OSError:
+            version = 'unknown'
+        total = (self.marks[-1][1] - STARTUP_STARTED) * 1000
+        fields = [time.strftime('%Y-%m-%d %H:%M:%S'), version, f"{total:.1f}"]
+        fields += [f"{name}={ms:.1f}" for name, ms in self.phases()]
+        with open(STARTUP_PROFILE_FILE, 'a') as f:
+            f.write(",".join(fields) + "\n")
 
 class MainWindow(QWidget):
-    def __init__(self):
+    def __init__(self, startup_profile=None):
         super().__init__()
+        self.startup_profile = startup_profile
+        self.pool = ConnectionPool()
+        # Timeout settings as read from config.ini, see timeoutSetting.
+        self.configured_timeouts = {}
+        self.pool_timer = QTimer(self)
+        self.pool_timer.timeout.connect(self.pool.evict_idle)
+        self.pool_timer.start(POOL_EVICT_INTERVAL_MS)
+        # Opened by loadState once the window is shown.
+        self.catalog = None
+        self.journal = None
+        self.db_thread = None
+        self.catalog_timer = QTimer(self)
+        self.catalog_timer.timeout.connect(self.refreshStaleCatalog)
+        self.run_metrics = None
+        self.metrics_timer = QTimer(self)
+        self.metrics_timer.timeout.connect(self.updateMetricsPanel)
         self.initUI()
         
     def initUI(self):
@@ -102,6 +132,73 @@ class MainWindow(QWidget):
         grid_layout.addWidget(self.pgPasswordLabel, 1, 2)
         grid_layout.addWidget(self.pgPasswordInput, 1, 3)
 
+        self.concurrencyLabel = QLabel('Parallel:')
+        self.concurrencyInput = QSpinBox()
+        self.concurrencyInput.setRange(1, MAX_CONCURRENCY)
+        self.concurrencyInput.setValue(DEFAULT_CONCURRENCY)
+        self.concurrencyInput.setToolTip('Number of databases patched at the same time on each server')
+        grid_layout.addWidget(self.concurrencyLabel, 2, 0)
+        grid_layout.addWidget(self.concurrencyInput, 2, 1)
+
+        self.engineLabel = QLabel('Engine:')
+        self.engineInput = QComboBox()
+        self.engineInput.addItems([ENGINE_THREADS, ENGINE_ASYNCIO])
+        self.engineInput.currentTextChanged.connect(self.onEngineChanged)
+        grid_layout.addWidget(self.engineLabel, 2, 2)
+        grid_layout.addWidget(self.engineInput, 2, 3)
+
+        self.inventoryCheck = QCheckBox('All servers in config.ini')
+        self.inventoryCheck.setToolTip('Fetch and patch every [PostgreSQL] and [PostgreSQL:<name>] server in config.ini')
+        grid_layout.addWidget(self.inventoryCheck, 3, 0, 1, 2)
+
+        self.skipAppliedCheck = QCheckBox('Skip databases already patched')
+        self.skipAppliedCheck.setChecked(True)
+        self.skipAppliedCheck.setToolTip('Consult the local patch ledger and skip databases where this exact patch already succeeded')
+        grid_layout.addWidget(self.skipAppliedCheck, 3, 2)
+
+        self.targetLedgerCheck = QCheckBox('Record in target database')
+        self.targetLedgerCheck.setToolTip('Also keep the ledger in a patchrun_ledger table inside each patched database')
+        grid_layout.addWidget(self.targetLedgerCheck, 3, 3)
+
+        self.lockTimeoutLabel = QLabel('Lock timeout:')
+        self.lockTimeoutInput = QSpinBox()
+        self.lockTimeoutInput.setRange(0, MAX_TIMEOUT_MS)
+        self.lockTimeoutInput.setSingleStep(TIMEOUT_STEP_MS)
+        self.lockTimeoutInput.setSuffix(' ms')
+        self.lockTimeoutInput.setSpecialValueText('none')
+        self.lockTimeoutInput.setToolTip('Give up waiting for a lock after this long and retry the database later')
+        grid_layout.addWidget(self.lockTimeoutLabel, 4, 0)
+        grid_layout.addWidget(self.lockTimeoutInput, 4, 1)
+
+        self.statementTimeoutLabel = QLabel('Statement timeout:')
+        self.statementTimeoutInput = QSpinBox()
+        self.statementTimeoutInput.setRange(0, MAX_TIMEOUT_MS)
+        self.statementTimeoutInput.setSingleStep(TIMEOUT_STEP_MS)
+        self.statementTimeoutInput.setSuffix(' ms')
+        self.statementTimeoutInput.setSpecialValueText('none')
+        self.statementTimeoutInput.setToolTip('Cancel a patch batch that runs longer than this')
+        grid_layout.addWidget(self.statementTimeoutLabel, 4, 2)
+        grid_layout.addWidget(self.statementTimeoutInput, 4, 3)
+
+        self.probeLocksCheck = QCheckBox('Postpone databases with lock contention')
+        self.probeLocksCheck.setToolTip('Check pg_locks first and retry later where other sessions hold or wait for locks')
+        grid_layout.addWidget(self.probeLocksCheck, 5, 0, 1, 2)
+
+        self.adaptiveCheck = QCheckBox('Adapt to server load')
+        self.adaptiveCheck.setToolTip('Start low and raise the number of parallel databases while the server keeps up, '
+                                      'up to Parallel; back off on slow connects or connection errors')
+        grid_layout.addWidget(self.adaptiveCheck, 5, 2, 1, 2)
+
+        self.preflightCheck = QCheckBox('Dry run once per schema first')
+        self.preflightCheck.setToolTip('Group the databases by schema fingerprint, run the patch in a rolled-back '
+                                       'transaction on one database per group, and stop if any of them fails')
+        grid_layout.addWidget(self.preflightCheck, 6, 0, 1, 2)
+
+        self.pipelineCheck = QCheckBox('Pipeline statements')
+        self.pipelineCheck.setToolTip('Send BEGIN, the patch statements and COMMIT without waiting for each reply: '
+                                      'one round trip per database instead of several, for high-latency servers')
+        grid_layout.addWidget(self.pipelineCheck, 6, 2, 1, 2)
+
         main_layout.addLayout(grid_layout)
 
         # Create a splitter for the bottom part
@@ -111,14 +208,40 @@ class MainWindow(QWidget):
         left_widget = QWidget()
         left_layout = QVBoxLayout()
 
-        self.db_list_widget = QListWidget()
-        self.db_list_widget.setSelectionMode(QAbstractItemView.MultiSelection)
+        self.db_model = DatabaseListModel(self)
+        self.db_proxy = DatabaseFilterProxy(self)
+        self.db_proxy.setSourceModel(self.db_model)
+        self.db_list_view = QListView()
+        self.db_list_view.setModel(self.db_proxy)
+        self.db_list_view.setUniformItemSizes(True)
+        self.db_list_view.clicked.connect(self.toggleDatabase)
+
+        self.dbFilterInput = QLineEdit()
+        self.dbFilterInput.setPlaceholderText('Filter databases (prefix)...')
+        self.dbFilterInput.textChanged.connect(self.applyDatabaseFilter)
+        self.dbRegexCheck = QCheckBox('Regex')
+        self.dbRegexCheck.toggled.connect(self.applyDatabaseFilter)
+        filter_layout = QHBoxLayout()
+        filter_layout.addWidget(self.dbFilterInput)
+        filter_layout.addWidget(self.dbRegexCheck)
+
+        self.select_shown_button = QPushButton('Select Shown')
+        self.select_shown_button.clicked.connect(lambda: self.checkShownDatabases(True))
+        self.deselect_shown_button = QPushButton('Deselect Shown')
+        self.deselect_shown_button.clicked.connect(lambda: self.checkShownDatabases(False))
+        selection_layout = QHBoxLayout()
+        selection_layout.addWidget(self.select_shown_button)
+        selection_layout.addWidget(self.deselect_shown_button)
+        self.dbCountLabel = QLabel('')
 
         self.fetch_dbname_button = QPushButton('Fetch Databases')
         self.fetch_dbname_button.clicked.connect(self.fetchDatabases)
 
         # left_layout.addWidget(QLabel("Select Databases:"))
-        left_layout.addWidget(self.db_list_widget)
+        left_layout.addLayout(filter_layout)
+        left_layout.addWidget(self.db_list_view)
+        left_layout.addLayout(selection_layout)
+        left_layout.addWidget(self.dbCountLabel)
         left_layout.addWidget(self.fetch_dbname_button)
 
         left_widget.setLayout(left_layout)
@@ -135,9 +258,56 @@ class MainWindow(QWidget):
 
         self.run_query_button = QPushButton('Execute')
         self.run_query_button.clicked.connect(self.runQuery)
+        self.read_query_button = QPushButton('Query Results')
+        self.read_query_button.setToolTip('Run the editor text as a read-only query on every selected database '
+                                          'and collect the rows in one grid')
+        self.read_query_button.clicked.connect(self.runReadQuery)
+        self.result_window = None
+        self.gatherModeInput = QComboBox()
+        self.gatherModeInput.addItems([GATHER_COLLECT, GATHER_MERGE, GATHER_AGGREGATE])
+        self.gatherModeInput.setToolTip('How Query Results combines the rows of the selected databases')
+        self.gatherModeInput.currentTextChanged.connect(self.onGatherModeChanged)
+        self.gatherSpecInput = QLineEdit()
+        self.gatherSpecInput.setEnabled(False)
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.setObjectName('cancelButton')
+        self.cancel_button.setToolTip('Start no further databases and cancel the ones in progress')
+        self.cancel_button.clicked.connect(self.cancelRun)
+        self.cancel_button.setEnabled(False)
+        self.resume_button = QPushButton('Resume Run')
+        self.resume_button.setToolTip('Patch the databases the last run did not finish, with its patch and settings')
+        self.resume_button.clicked.connect(self.resumeRun)
+
+        # Large patches are run straight from disk instead of being pasted into the editor.
+        self.patch_file = None
+        self.patchFileLabel = QLabel('')
+        self.open_patch_button = QPushButton('Run From File...')
+        self.open_patch_button.clicked.connect(self.openPatchFile)
+        self.copy_load_button = QPushButton('Bulk Load...')
+        self.copy_load_button.setToolTip('Load a CSV, text or binary file into a table of every selected database with COPY')
+        self.copy_load_button.clicked.connect(self.openCopyLoad)
+        self.clear_patch_button = QPushButton('Clear File')
+        self.clear_patch_button.clicked.connect(self.clearPatchFile)
+        self.clear_patch_button.setEnabled(False)
+
+        button_layout = QHBoxLayout()
+        button_layout.addWidget(self.open_patch_button)
+        button_layout.addWidget(self.copy_load_button)
+        button_layout.addWidget(self.clear_patch_button)
+        button_layout.addWidget(self.read_query_button)
+        button_layout.addWidget(self.run_query_button)
+        button_layout.addWidget(self.resume_button)
+        button_layout.addWidget(self.cancel_button)
+
+        gather_layout = QHBoxLayout()
+        gather_layout.addWidget(QLabel('Query results:'))
+        gather_layout.addWidget(self.gatherModeInput)
+        gather_layout.addWidget(self.gatherSpecInput)
 
         query_layout.addWidget(self.queryInput)
-        query_layout.addWidget(self.run_query_button)
+        query_layout.addWidget(self.patchFileLabel)
+        query_layout.addLayout(gather_layout)
+        query_layout.addLayout(button_layout)
 
         query_widget.setLayout(query_layout)
 
@@ -145,10 +315,20 @@ class MainWindow(QWidget):
         log_widget = QWidget()
         log_layout = QVBoxLayout()
 
-        self.logWindow = QTextEdit()
-        self.logWindow.setReadOnly(True)
+        self.logWindow = LogView()
+
+        self.progressBar = QProgressBar()
+        self.progressBar.setValue(0)
+        self.progressLabel = QLabel('')
+        # Phase timings of the current run, refreshed while it is in progress.
+        self.metricsLabel = QLabel('')
+        self.metricsLabel.setObjectName('metricsPanel')
+        self.metricsLabel.setTextInteractionFlags(Qt.TextSelectableByMouse)
 
         log_layout.addWidget(self.logWindow)
+        log_layout.addWidget(self.progressBar)
+        log_layout.addWidget(self.progressLabel)
+        log_layout.addWidget(self.metricsLabel)
         log_widget.setLayout(log_layout)
 
         # Add the two sections to the right splitter
@@ -166,88 +346,488 @@ class MainWindow(QWidget):
         main_layout.addWidget(bottom_splitter)
 
         self.setLayout(main_layout)
-        self.loadcredentials()
         self.apply_styles()
         self.show()
+        QTimer.singleShot(0, self.loadState)
+
+    def loadState(self):
+        # Runs from the event loop after show(), so the first paint does not wait for
+        # config.ini, patchrun or the SQLite files.
+        from catalog import DatabaseCatalog
+        from journal import RunJournal
+        self.loadcredentials()
+        self.catalog = DatabaseCatalog()
+        self.journal = RunJournal()
+        self.catalog_timer.start(self.catalog.ttl * 1000)
+        self.loadCachedCatalog()
 
     def loadcredentials(self):
+        import configparser
+        import patchrun
         config = configparser.ConfigParser()
-        config.read(CONFIG_FILE)
-        if 'PostgreSQL' in config:
-            self.pgHostInput.setText(config['PostgreSQL'].get('host', ''))
-            self.pgPortInput.setText(config['PostgreSQL'].get('port', ''))
-            self.pgUserInput.setText(config['PostgreSQL'].get('user', ''))
-            self.pgPasswordInput.setText(config['PostgreSQL'].get('password', ''))
+        config.read(patchrun.CONFIG_FILE)
+        self.lockTimeoutInput.setValue(timeout_milliseconds(patchrun.PatchOptions().lock_timeout))
+        credentials = patchrun.load_config_credentials(patchrun.CONFIG_FILE)
+        if credentials:
+            self.pgHostInput.setText(credentials['host'])
+            self.pgPortInput.setText(credentials['port'])
+            self.pgUserInput.setText(credentials['user'])
+            self.pgPasswordInput.setText(credentials['password'])
+            if 'Execution' in config:
+                self.engineInput.setCurrentText(config['Execution'].get('engine', ENGINE_THREADS))
+                self.concurrencyInput.setValue(config['Execution'].getint('concurrency', DEFAULT_CONCURRENCY))
+                self.inventoryCheck.setChecked(config['Execution'].getboolean('all_servers', False))
+                self.skipAppliedCheck.setChecked(config['Execution'].getboolean('skip_applied', True))
+                self.targetLedgerCheck.setChecked(config['Execution'].getboolean('target_ledger', False))
+            options = patchrun.load_config_options(patchrun.CONFIG_FILE)
+            self.loadTimeout('lock_timeout', self.lockTimeoutInput, options.lock_timeout)
+            self.loadTimeout('statement_timeout', self.statementTimeoutInput, options.statement_timeout)
+            self.probeLocksCheck.setChecked(options.probe_locks)
+            self.adaptiveCheck.setChecked(options.adaptive)
+            self.preflightCheck.setChecked(options.preflight)
+            self.pipelineCheck.setChecked(options.pipeline)
         else:
             self.logWindow.append("No existing configuration found. Please enter your PostgreSQL credentials.")
 
+    def loadTimeout(self, key, widget, value):
+        # A setting the spin box cannot show (e.g. '1d 2h') leaves it as it was.
+        milliseconds = timeout_milliseconds(value)
+        if milliseconds is not None:
+            widget.setValue(milliseconds)
+        self.configured_timeouts[key] = (value, widget.value())
+
+    def timeoutSetting(self, key, widget):
+        # The configured setting as written while the spin box still shows it, so that
+        # saving or running never rewrites it.
+        configured, shown = self.configured_timeouts.get(key, (None, None))
+        if configured is not None and widget.value() == shown:
+            return configured
+        return f"{widget.value()}ms"
+
     def savecredentials(self):
+        # Read first so that [PostgreSQL:<name>] inventory sections are preserved.
+        import configparser
+        import patchrun
         config = configparser.ConfigParser()
+        config.read(patchrun.CONFIG_FILE)
         config['PostgreSQL'] = {
             'host': self.pgHostInput.text(),
             'port': self.pgPortInput.text(),
             'user': self.pgUserInput.text(),
             'password': self.pgPasswordInput.text()
         }
-        with open(CONFIG_FILE, 'w') as configfile:
+        # Settings without a widget (max_retries, retry_backoff, ...) are kept as they are.
+        execution = dict(config['Execution']) if 'Execution' in config else {}
+        execution.update({
+            'concurrency': str(self.concurrencyInput.value()),
+            'engine': self.engineInput.currentText(),
+            'all_servers': str(self.inventoryCheck.isChecked()),
+            'skip_applied': str(self.skipAppliedCheck.isChecked()),
+            'target_ledger': str(self.targetLedgerCheck.isChecked()),
+            'lock_timeout': self.timeoutSetting('lock_timeout', self.lockTimeoutInput),
+            'statement_timeout': self.timeoutSetting('statement_timeout', self.statementTimeoutInput),
+            'probe_locks': str(self.probeLocksCheck.isChecked()),
+            'adaptive': str(self.adaptiveCheck.isChecked()),
+            'preflight': str(self.preflightCheck.isChecked()),
+            'pipeline': str(self.pipelineCheck.isChecked())
+        })
+        config['Execution'] = execution
+        with open(patchrun.CONFIG_FILE, 'w') as configfile:
             config.write(configfile)
 
+    def currentServers(self):
+        import patchrun
+        if self.inventoryCheck.isChecked():
+            return patchrun.load_config_inventory(patchrun.CONFIG_FILE)
+        return [patchrun.make_server(
+            self.pgHostInput.text(),
+            self.pgPortInput.text(),
+            self.pgUserInput.text(),
+            self.pgPasswordInput.text()
+        )]
+
     def fetchDatabases(self):
         self.savecredentials()
-        self.logWindow.append("Fetching databases...")
-        credentials = {
-            'host': self.pgHostInput.text(),
-            'port': self.pgPortInput.text(),
-            'user': self.pgUserInput.text(),
-            'password': self.pgPasswordInput.text()
-        }
-        self.db_thread = DatabaseThread(credentials)
-        self.db_thread.databases_fetched.connect(self.updateDatabaseList)
-        self.db_thread.error_occurred.connect(self.displayError)
+        self.refreshDatabases()
+
+    def refreshDatabases(self, background=False):
+        if self.db_thread and self.db_thread.isRunning():
+            return
+        servers = self.currentServers()
+        if not background:
+            self.logWindow.append(f"Fetching databases from {len(servers)} server(s)...")
+        from runthreads import DatabaseThread
+        self.db_thread = DatabaseThread(servers, self.pool, catalog=self.catalog)
+        self.db_thread.databases_fetched.connect(self.onDatabasesFetched)
+        # Background refreshes must not pop up dialogs; the cached list stays usable.
+        self.db_thread.error_occurred.connect(self.logWindow.append if background else self.displayError)
         self.db_thread.start()
 
+    def loadCachedCatalog(self):
+        if not self.pgHostInput.text():
+            return
+        from ledger import PatchLedger
+        servers = self.currentServers()
+        patch_ledger = PatchLedger()
+        entries = [entry for server in servers for entry in self.catalog.cached(server, patch_ledger)]
+        if entries:
+            self.updateDatabaseList(entries)
+            self.logWindow.append(f"Loaded {len(entries)} databases from the local catalog cache.")
+        self.refreshStaleCatalog()
+
+    def refreshStaleCatalog(self):
+        if not (self.catalog and self.pgHostInput.text()):
+            return
+        if any(self.catalog.is_stale(server) for server in self.currentServers()):
+            self.refreshDatabases(background=True)
+
     def runQuery(self):
         self.savecredentials()
-        selected_db = [item.text() for item in self.db_list_widget.selectedItems()]
-        if not selected_db:
+        selected_targets = self.db_model.selectedTargets()
+        if not selected_targets:
             QMessageBox.critical(self, "Warning!", 'No database has been selected')
             return
-        query = self.queryInput.toPlainText()
+        query = self.patch_file or self.queryInput.toPlainText()
         if not query:
             QMessageBox.critical(self, "Warning!", 'Please enter an SQL Query.')
             return
 
-        self.logWindow.append("Running query...")
-        credentials = {
-            'host': self.pgHostInput.text(),
-            'port': self.pgPortInput.text(),
-            'user': self.pgUserInput.text(),
-            'password': self.pgPasswordInput.text()
-        }
-        self.query_thread = DatabaseThread(credentials, query, selected_db)
+        from runthreads import DatabaseThread, AsyncDatabaseThread
+        from ledger import PatchLedger
+        from metrics import RunMetrics
+        if self.engineInput.currentText() == ENGINE_ASYNCIO:
+            thread_class = AsyncDatabaseThread
+        else:
+            thread_class = DatabaseThread
+        patch_ledger = PatchLedger(in_database=self.targetLedgerCheck.isChecked(),
+                                   skip_applied=self.skipAppliedCheck.isChecked())
+        self.run_metrics = RunMetrics()
+        thread = thread_class(None, self.pool, query, selected_targets, self.concurrencyInput.value(),
+                              patch_ledger, self.catalog, metrics=self.run_metrics, options=self.currentOptions(),
+                              journal=self.journal)
+        self.startRun(thread, "Running query...", self.onDatabaseFinished)
+
+    def resumeRun(self):
+        # Servers are looked up among both the single connection and the inventory.
+        import patchrun
+        from journal import settings_options, resume_plan, load_resumed_work, describe_run, skips_committed
+        from preflight import target_list
+        from runthreads import DatabaseThread, AsyncDatabaseThread
+        from ledger import PatchLedger
+        from metrics import RunMetrics
+        run = self.journal.last_run()
+        if run is None:
+            QMessageBox.information(self, "Resume Run", 'No run has been journaled yet.')
+            return
+        servers = patchrun.load_config_inventory(patchrun.CONFIG_FILE) + self.currentServers()
+        try:
+            targets, started = resume_plan(self.journal, run, servers)
+            query = load_resumed_work(run) if targets or started else None
+        except (ValueError, OSError) as e:
+            QMessageBox.critical(self, "Resume Run", str(e))
+            return
+        settings = run.settings
+        description = describe_run(self.journal, run)
+        if started and skips_committed(settings):
+            # The in-database ledger skips those that committed.
+            targets += started
+        elif started:
+            # They may have committed before the interruption: only patched again on request.
+            answer = QMessageBox.question(
+                self, "Resume Run",
+                f"{description}\n\n{len(started)} databases had started without a recorded result: "
+                f"{target_list(started)}.\n\nThose that committed before the interruption would be patched a "
+                f"second time, as the run does not use the in-database ledger. Patch them again as well?",
+                QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+            if answer == QMessageBox.Yes:
+                targets += started
+        if not targets:
+            QMessageBox.information(self, "Resume Run", f"{description}\n\nNothing to resume.")
+            return
+        answer = QMessageBox.question(self, "Resume Run", f"{description}\n\n"
+                                                          f"Patch the {len(targets)} unfinished databases?")
+        if answer != QMessageBox.Yes:
+            return
+        thread_class = AsyncDatabaseThread if settings['engine'] == ENGINE_ASYNCIO.lower() else DatabaseThread
+        patch_ledger = PatchLedger(in_database=settings['ledger_in_database'], skip_applied=settings['skip_applied'])
+        self.run_metrics = RunMetrics()
+        thread = thread_class(None, self.pool, query, targets, settings['concurrency'], patch_ledger, self.catalog,
+                              metrics=self.run_metrics, options=settings_options(settings), journal=self.journal,
+                              resumed_from=run.run_id)
+        self.startRun(thread, f"Resuming run {run.run_id}...", self.onDatabaseFinished)
+
+    def runReadQuery(self):
+        # Always runs on the threads engine: rows are fetched through psycopg2 named cursors.
+        import resultset
+        self.savecredentials()
+        selected_targets = self.db_model.selectedTargets()
+        if not selected_targets:
+            QMessageBox.critical(self, "Warning!", 'No database has been selected')
+            return
+        if self.patch_file:
+            QMessageBox.critical(self, "Warning!", 'Read queries are taken from the editor; clear the file first.')
+            return
+        try:
+            query = resultset.read_query_text(self.queryInput.toPlainText())
+        except ValueError:
+            QMessageBox.critical(self, "Warning!", 'Please enter an SQL Query.')
+            return
+        from gather import Aggregation, parse_order, parse_aggregation
+        from resultset import ResultSpool
+        from resultview import ResultWindow
+        from runthreads import ReadQueryThread
+        from metrics import RunMetrics
+        mode, spec = self.gatherModeInput.currentText(), self.gatherSpecInput.text()
+        try:
+            order = parse_order(spec) if mode == GATHER_MERGE else None
+            sink = Aggregation(*parse_aggregation(spec)) if mode == GATHER_AGGREGATE else ResultSpool()
+        except ValueError as e:
+            QMessageBox.critical(self, "Warning!", str(e))
+            return
+
+        self.closeResults()
+        self.result_title = f"Query results - {len(selected_targets)} databases"
+        if isinstance(sink, ResultSpool):
+            # Each database's rows show up as it finishes while the query runs; a merge replaces them at the end.
+            self.result_window = ResultWindow(sink, self.result_title, self)
+            self.result_window.show()
+        self.run_metrics = RunMetrics()
+        thread = ReadQueryThread(None, self.pool, query, selected_targets, self.concurrencyInput.value(), sink,
+                                 metrics=self.run_metrics, options=self.currentOptions(), order=order)
+        thread.results_ready.connect(self.onResultsReady)
+        self.startRun(thread, "Running read query...", self.onDatabaseRead)
+
+    def currentOptions(self):
+        import patchrun
+        return patchrun.load_config_options(patchrun.CONFIG_FILE)._replace(
+            lock_timeout=self.timeoutSetting('lock_timeout', self.lockTimeoutInput),
+            statement_timeout=self.timeoutSetting('statement_timeout', self.statementTimeoutInput),
+            probe_locks=self.probeLocksCheck.isChecked(),
+            adaptive=self.adaptiveCheck.isChecked(),
+            preflight=self.preflightCheck.isChecked(),
+            pipeline=self.pipelineCheck.isChecked()
+        )
+
+    def startRun(self, thread, message, on_database):
+        self.logWindow.append(message)
+        self.progressBar.setRange(0, len(thread.targets))
+        self.progressBar.setValue(0)
+        self.succeeded_count = 0
+        self.failed_count = 0
+        self.skipped_count = 0
+        self.cancelled_count = 0
+        self.run_started = time.perf_counter()
+        self.query_thread = thread
+        self.updateProgressLabel()
         self.query_thread.query_executed.connect(self.displayResults)
+        self.query_thread.finished.connect(self.onRunFinished)
+        self.metrics_timer.start(METRICS_REFRESH_MS)
+        self.query_thread.database_finished.connect(on_database)
         self.query_thread.error_occurred.connect(self.displayError)
+        self.run_query_button.setEnabled(False)
+        self.read_query_button.setEnabled(False)
+        self.resume_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
         self.query_thread.start()
 
-    def updateDatabaseList(self, databases):
-        self.db_list_widget.clear()
-        for db in databases:
-            self.db_list_widget.addItem(db)
-        self.logWindow.append("Databases fetched successfully.")
+    def onResultsReady(self, spool):
+        if self.result_window is None:
+            from resultview import ResultWindow
+            self.result_window = ResultWindow(spool, self.result_title, self)
+            self.result_window.show()
+        else:
+            self.result_window.setSpool(spool)
+
+    def onGatherModeChanged(self, mode):
+        self.gatherSpecInput.setPlaceholderText(GATHER_PLACEHOLDERS[mode])
+        self.gatherSpecInput.setEnabled(mode != GATHER_COLLECT)
+
+    def closeResults(self):
+        # The spool's temporary file is removed with its window; only called between runs.
+        if self.result_window:
+            self.result_window.close()
+            self.result_window.spool.close()
+            self.result_window = None
+
+    def cancelRun(self):
+        self.cancel_button.setEnabled(False)
+        self.logWindow.append("Cancelling: no further databases will be started, running patches are being cancelled...")
+        self.query_thread.cancel()
+
+    def openPatchFile(self):
+        path, _ = QFileDialog.getOpenFileName(self, 'Select patch file', '', 'SQL files (*.sql);;All files (*)')
+        if not path:
+            return
+        from sqlscript import PatchFile
+        patch_file = PatchFile(path)
+        try:
+            size = patch_file.size()
+        except OSError as e:
+            self.displayError(f"Error opening patch file: {e}")
+            return
+        if size == 0:
+            QMessageBox.critical(self, "Warning!", 'The selected patch file is empty.')
+            return
+        self.patch_file = patch_file
+        self.patchFileLabel.setText(f"Patch file: {path} ({size / (1024 * 1024):.1f} MB) - the editor is ignored")
+        self.queryInput.setEnabled(False)
+        self.clear_patch_button.setEnabled(True)
+
+    def openCopyLoad(self):
+        from copydialog import CopyLoadDialog
+        dialog = CopyLoadDialog(self)
+        if not dialog.exec_():
+            return
+        copy_load = dialog.copy_load
+        self.patch_file = copy_load
+        self.patchFileLabel.setText(
+            f"Bulk load: {copy_load} ({copy_load.size() / (1024 * 1024):.1f} MB) - the editor is ignored"
+        )
+        self.queryInput.setEnabled(False)
+        self.clear_patch_button.setEnabled(True)
+
+    def clearPatchFile(self):
+        self.patch_file = None
+        self.patchFileLabel.setText('')
+        self.queryInput.setEnabled(True)
+        self.clear_patch_button.setEnabled(False)
+
+    def onEngineChanged(self, engine):
+        if engine == ENGINE_ASYNCIO:
+            self.concurrencyInput.setMaximum(MAX_ASYNC_CONCURRENCY)
+        else:
+            self.concurrencyInput.setMaximum(MAX_CONCURRENCY)
+
+    def onDatabasesFetched(self, entries):
+        added, removed = self.updateDatabaseList(entries)
+        self.logWindow.append(f"Databases fetched successfully ({added} added, {removed} removed).")
+
+    def updateDatabaseList(self, entries):
+        # Check marks of databases that still exist survive a refresh.
+        added, removed = self.db_model.setEntries(entries)
+        self.db_proxy.resetIndex()
+        self.updateDatabaseCount()
+        return added, removed
+
+    def applyDatabaseFilter(self):
+        use_regex = self.dbRegexCheck.isChecked()
+        self.dbFilterInput.setPlaceholderText('Filter databases (regex)...' if use_regex else 'Filter databases (prefix)...')
+        self.db_proxy.setFilter(self.dbFilterInput.text(), use_regex)
+        self.dbFilterInput.setToolTip(self.db_proxy.error or '')
+        self.updateDatabaseCount()
+
+    def toggleDatabase(self, index):
+        self.db_model.toggle(self.db_proxy.mapToSource(index).row())
+        self.updateDatabaseCount()
+
+    def checkShownDatabases(self, checked):
+        self.db_model.setChecked(self.db_proxy.visibleSourceRows(), checked)
+        self.updateDatabaseCount()
+
+    def updateDatabaseCount(self):
+        self.dbCountLabel.setText(
+            f"{self.db_proxy.rowCount()} shown / {self.db_model.rowCount()} total, {len(self.db_model.checked)} selected"
+        )
 
     def displayResults(self, results):
         self.logWindow.append(results)
 
+    def onDatabaseFinished(self, outcome):
+        server, db, elapsed = outcome.server, outcome.database, outcome.elapsed
+        if outcome.skipped:
+            self.skipped_count += 1
+            self.logWindow.append(f"Skipped database {db} on {server}: patch already applied.")
+        elif outcome.cancelled:
+            # Databases that never started are listed once in the final report.
+            self.cancelled_count += 1
+            from patchrun import ROLLED_BACK
+            if outcome.cancelled == ROLLED_BACK:
+                self.logWindow.append(f"Cancelled on database {db} on {server} ({elapsed:.2f}s): rolled back.")
+        elif outcome.ok:
+            self.succeeded_count += 1
+            retried = f", attempt {outcome.attempts}" if outcome.attempts > 1 else ""
+            self.logWindow.append(f"Patch successfully applied to database {db} on {server} ({elapsed:.2f}s{retried}).")
+        else:
+            self.failed_count += 1
+            code = f" [{outcome.sqlstate}]" if outcome.sqlstate else ""
+            self.logWindow.append(f"Error from database {db} on {server} ({elapsed:.2f}s){code}: {outcome.error}")
+        self.progressBar.setValue(self.succeeded_count + self.failed_count + self.skipped_count + self.cancelled_count)
+        self.updateProgressLabel()
+
+    def onDatabaseRead(self, outcome):
+        server, db, elapsed = outcome.server, outcome.database, outcome.elapsed
+        if outcome.ok:
+            self.succeeded_count += 1
+            self.logWindow.append(f"Read {outcome.rows} rows from database {db} on {server} ({elapsed:.2f}s).")
+            if self.result_window:
+                self.result_window.refresh()
+        elif outcome.cancelled:
+            self.cancelled_count += 1
+        else:
+            self.failed_count += 1
+            code = f" [{outcome.sqlstate}]" if outcome.sqlstate else ""
+            self.logWindow.append(f"Error from database {db} on {server} ({elapsed:.2f}s){code}: {outcome.error}")
+        self.progressBar.setValue(self.succeeded_count + self.failed_count + self.cancelled_count)
+        self.updateProgressLabel()
+
+    def onRunFinished(self):
+        self.run_query_button.setEnabled(True)
+        self.read_query_button.setEnabled(True)
+        self.resume_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+        self.metrics_timer.stop()
+        self.updateMetricsPanel()
+
+    def updateMetricsPanel(self):
+        if self.run_metrics:
+            self.metricsLabel.setText(self.run_metrics.summary())
+
+    def updateProgressLabel(self):
+        from schedule import format_eta
+        done = self.succeeded_count + self.failed_count + self.skipped_count + self.cancelled_count
+        elapsed = time.perf_counter() - self.run_started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = self.query_thread.eta if self.query_thread else None
+        self.progressLabel.setText(
+            f"Succeeded: {self.succeeded_count}   Failed: {self.failed_count}   Skipped: {self.skipped_count}   "
+            f"Cancelled: {self.cancelled_count}   "
+            f"Done: {done}/{self.progressBar.maximum()}   {rate:.1f} db/s"
+            + (f"   ETA {format_eta(eta.seconds_left())}" if eta else "")
+        )
+
     def displayError(self, error):
         QMessageBox.critical(self, "Error", error)
 
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if self.startup_profile:
+            profile, self.startup_profile = self.startup_profile, None
+            profile.mark('first paint')
+            QTimer.singleShot(0, lambda: self.reportStartup(profile))
+
+    def reportStartup(self, profile):
+        report = profile.report()
+        self.logWindow.append(report)
+        if sys.stdout:
+            print(report)
+        try:
+            profile.save()
+        except OSError as e:
+            self.logWindow.append(f"Could not write {STARTUP_PROFILE_FILE}: {e}")
+
+    def closeEvent(self, event):
+        self.logWindow.closeHistory()
+        self.closeResults()
+        self.pool.close_all()
+        super().closeEvent(event)
+
     def apply_styles(self):
         style_sheet = """
         QWidget {
             font-family: 'Arial';
             font-size: 14px;
         }
-        QLineEdit, QTextEdit, QListWidget {
+        QLineEdit, QTextEdit, QPlainTextEdit, QListView {
             border: 1px solid #c5c5c5;
             border-radius: 5px;
             padding: 5px;
@@ -263,9 +843,20 @@ class MainWindow(QWidget):
         QPushButton:hover {
             background-color: #45a049;
         }
+        QPushButton#cancelButton {
+            background-color: #d9534f;
+        }
+        QPushButton:disabled {
+            background-color: #a5a5a5;
+        }
         QLabel {
             font-weight: bold;
         }
+        QLabel#metricsPanel {
+            font-family: 'Consolas', 'Courier New', monospace;
+            font-weight: normal;
+            font-size: 12px;
+        }
         QScrollBar:vertical {
             background-color: #F1F1F1;
             width: 8px;
@@ -275,6 +866,11 @@ class MainWindow(QWidget):
 
 
 if __name__ == '__main__':
+    startup_profile = StartupProfile() if '--profile-startup' in sys.argv else None
     app = QApplication(sys.argv)
-    obj = MainWindow()
+    if startup_profile:
+        startup_profile.mark('QApplication')
+    obj = MainWindow(startup_profile)
+    if startup_profile:
+        startup_profile.mark('MainWindow')
     sys.exit(app.exec_())
@@ -0,0 +1,148 @@
+import os
+import time
+import threading
+from bisect import bisect_left
+from runlog import outcome_status
+from patchrun import NOT_STARTED
+
+# Per-run metrics around the connect / execute / commit / close sequence of every
+# database: phase histograms, an in-flight gauge and throughput. Exported as a
+# Prometheus textfile (node_exporter textfile collector format) after each run.
+#
+# The connect phase is the pool checkout: libpq resolves, connects and authenticates
+# in one call, so DNS and authentication cannot be timed separately; a reused pooled
+# connection only costs its health check.
+
+METRICS_FILE = 'patchrun.prom'
+PHASES = ('connect', 'execute', 'commit', 'close')
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation, capped at the maximum.
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+
+class RunMetrics:
+    # Shared by every worker of one run; all updates go through one lock.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {phase: Histogram() for phase in PHASES}
+        self.total = Histogram()
+        self.statuses = {'ok': 0, 'failed': 0, 'skipped': 0, 'cancelled': 0}
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def enter(self):
+        with self.lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def observe(self, outcome):
+        with self.lock:
+            self.statuses[outcome_status(outcome)] += 1
+            if outcome.skipped or outcome.cancelled == NOT_STARTED:
+                return
+            self.total.observe(outcome.elapsed)
+            for phase in PHASES:
+                value = getattr(outcome, f'{phase}_time')
+                if value is not None:
+                    self.phases[phase].observe(value)
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    def elapsed(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    def throughput(self):
+        # Databases actually patched (or failed) per second; ledger skips cost nothing.
+        elapsed = self.elapsed()
+        return (self.statuses['ok'] + self.statuses['failed']) / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        with self.lock:
+            lines = [f"{'phase':<9}{'count':>7}{'mean':>9}{'p50':>9}{'p95':>9}{'max':>9}"]
+            for name, histogram in list(self.phases.items()) + [('total', self.total)]:
+                lines.append(
+                    f"{name:<9}{histogram.count:>7}{histogram.mean() * 1000:>7.0f}ms"
+                    f"{histogram.quantile(0.5) * 1000:>7.0f}ms{histogram.quantile(0.95) * 1000:>7.0f}ms"
+                    f"{histogram.max * 1000:>7.0f}ms"
+                )
+            lines.append(f"in flight {self.in_flight} (peak {self.peak_in_flight}), "
+                         f"{self.throughput():.1f} db/s over {self.elapsed():.1f}s")
+        return "\n".join(lines)
+
+    def prometheus(self):
+        with self.lock:
+            lines = [
+                '# HELP patchrun_phase_seconds Time spent per database in each phase of the last patch run.',
+                '# TYPE patchrun_phase_seconds histogram',
+            ]
+            for name, histogram in list(self.phases.items()) + [('total', self.total)]:
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'patchrun_phase_seconds_bucket{{phase="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'patchrun_phase_seconds_bucket{{phase="{name}",le="+Inf"}} {histogram.count}')
+                lines.append(f'patchrun_phase_seconds_sum{{phase="{name}"}} {histogram.sum:.6f}')
+                lines.append(f'patchrun_phase_seconds_count{{phase="{name}"}} {histogram.count}')
+            lines += ['# HELP patchrun_databases Databases of the last patch run by status.',
+                      '# TYPE patchrun_databases gauge']
+            lines += [f'patchrun_databases{{status="{status}"}} {count}' for status, count in self.statuses.items()]
+            lines += [
+                '# HELP patchrun_in_flight Databases being patched at the same time.',
+                '# TYPE patchrun_in_flight gauge',
+                f'patchrun_in_flight {self.in_flight}',
+                '# HELP patchrun_in_flight_peak Highest number of databases patched at the same time.',
+                '# TYPE patchrun_in_flight_peak gauge',
+                f'patchrun_in_flight_peak {self.peak_in_flight}',
+                '# HELP patchrun_throughput_databases_per_second Databases patched per second.',
+                '# TYPE patchrun_throughput_databases_per_second gauge',
+                f'patchrun_throughput_databases_per_second {self.throughput():.3f}',
+                '# HELP patchrun_run_duration_seconds Wall-clock duration of the last patch run.',
+                '# TYPE patchrun_run_duration_seconds gauge',
+                f'patchrun_run_duration_seconds {self.elapsed():.3f}',
+                '# HELP patchrun_last_run_timestamp_seconds Time the last patch run ended.',
+                '# TYPE patchrun_last_run_timestamp_seconds gauge',
+                f'patchrun_last_run_timestamp_seconds {time.time():.0f}',
+            ]
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path=METRICS_FILE):
+        # Written to a temporary file and renamed so a scraper never sees half a file.
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus())
+        os.replace(temporary, path)
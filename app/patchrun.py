@@ -0,0 +1,766 @@
+import re
+import time
+import heapq
+import random
+import itertools
+import threading
+import configparser
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from sqlscript import PatchFile
+from copyload import CopyLoad, COPY_CHUNK_SIZE
+from connpool import TOO_MANY_CONNECTIONS, CONNECTION_LIMIT_ERRORS
+import ledger
+
+# Database listing and patch execution shared by the GUI and the headless CLI.
+# Nothing in here may import Qt.
+#
+# A "server" is a credentials dict ('host', 'port', 'user', 'password') plus a
+# display 'name' and an optional per-server 'concurrency'. A "target" is a
+# (server, database name) pair.
+
+CONFIG_FILE = 'config.ini'
+PGCON_FILE = 'pgcon.txt'
+SERVER_SECTION_PREFIX = 'PostgreSQL:'
+
+DATABASE_LIST_QUERY = "SELECT datname FROM pg_database WHERE datname NOT LIKE '%azure%' AND datname <> 'template0' AND datname <> 'template1' AND datname<>'postgres' ORDER BY datname desc"
+# pg_database_size raises for databases we may not connect to, hence the privilege check.
+DATABASE_DETAILS_QUERY = "SELECT datname, CASE WHEN has_database_privilege(oid, 'CONNECT') THEN pg_database_size(oid) END, pg_encoding_to_char(encoding) FROM pg_database WHERE datname NOT LIKE '%azure%' AND datname <> 'template0' AND datname <> 'template1' AND datname<>'postgres' ORDER BY datname desc"
+
+# Phase times are in seconds and None when the run did not get that far; rows is the
+# number of rows reported by the server, sqlstate the error code of a failed patch.
+Outcome = namedtuple(
+    'Outcome',
+    ['server', 'database', 'ok', 'elapsed', 'error', 'skipped',
+     'connect_time', 'execute_time', 'commit_time', 'rows', 'sqlstate', 'close_time', 'attempts', 'cancelled'],
+    defaults=[False, None, None, None, None, None, None, 1, None]
+)
+
+# Outcome.cancelled of databases affected by RunControl.cancel(); databases that
+# committed before the cancel arrived keep their normal successful outcome.
+NOT_STARTED = 'not started'
+ROLLED_BACK = 'rolled back'
+
+# Timeouts are PostgreSQL setting values ('5s', '500ms', '0' for none) applied with
+# SET LOCAL semantics to each patch transaction. Databases failing with a lock timeout
+# or deadlock are retried up to max_retries times, retry_backoff * 2^n seconds later.
+# probe_locks postpones a database (as if it had hit the lock timeout) while other
+# sessions wait for locks there or hold them in transactions older than lock_probe_age.
+# adaptive lets the concurrency of each server follow its load (see adaptive.py),
+# keeping connection_headroom connection slots free on it. preflight dry-runs the
+# patch once per schema fingerprint before the run (see preflight.py). pipeline sends
+# each patch transaction as pipelined messages (see pipelined_messages).
+PatchOptions = namedtuple(
+    'PatchOptions',
+    ['lock_timeout', 'statement_timeout', 'max_retries', 'retry_backoff', 'probe_locks', 'lock_probe_age',
+     'adaptive', 'connection_headroom', 'preflight', 'pipeline'],
+    defaults=['5s', '0', 3, 2.0, False, 10.0, False, 5, False, False]
+)
+
+LOCK_NOT_AVAILABLE = '55P03'
+RETRYABLE_SQLSTATES = {LOCK_NOT_AVAILABLE, '40P01'}
+MAX_RETRY_DELAY = 300.0
+CANCEL_POLL_INTERVAL = 0.2
+SESSION_SETTINGS_QUERY = "SELECT set_config('lock_timeout', %s, true), set_config('statement_timeout', %s, true)"
+LOCK_PROBE_QUERY = (
+    "SELECT count(DISTINCT l.pid) FROM pg_locks l JOIN pg_stat_activity a ON a.pid = l.pid"
+    " WHERE l.locktype = 'relation' AND l.pid <> pg_backend_pid()"
+    " AND l.database = (SELECT oid FROM pg_database WHERE datname = current_database())"
+    " AND (NOT l.granted OR a.xact_start < now() - make_interval(secs => %s))"
+)
+# Literal form for pipelined messages, which carry no parameters.
+SESSION_SETTINGS_SQL = "SELECT set_config('lock_timeout', {}, true), set_config('statement_timeout', {}, true)"
+# Starts on a new line so that a patch ending in a -- comment still ends its statement.
+PIPELINE_SEPARATOR = "\n;\n"
+# asyncpg uses numbered placeholders.
+SESSION_SETTINGS_QUERY_ASYNC = "SELECT set_config('lock_timeout', $1, true), set_config('statement_timeout', $2, true)"
+LOCK_PROBE_QUERY_ASYNC = LOCK_PROBE_QUERY.replace('%s', '$1')
+
+
+class RunControl:
+    # Lets another thread cancel a running patch. Workers register a cancel callback
+    # (psycopg2 conn.cancel, or cancelling the asyncio tasks) for as long as they hold
+    # a session; cancel() stops further databases from starting and fires every
+    # callback in parallel, so the server-side cancels go out at once.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.callbacks = set()
+
+    def watch(self, callback):
+        # Returns False, without registering, when the run is already cancelled.
+        with self.lock:
+            if self.cancelled:
+                return False
+            self.callbacks.add(callback)
+            return True
+
+    def unwatch(self, callback):
+        with self.lock:
+            self.callbacks.discard(callback)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            callbacks = list(self.callbacks)
+        if not callbacks:
+            return
+        with ThreadPoolExecutor(max_workers=min(32, len(callbacks))) as executor:
+            for callback in callbacks:
+                executor.submit(call_quietly, callback)
+
+
+def call_quietly(callback):
+    try:
+        callback()
+    except Exception:
+        pass
+
+
+def is_cancelled(control):
+    return control is not None and control.cancelled
+
+
+def make_server(host, port, user, password, name=None, concurrency=None):
+    return {
+        'name': name or f"{host}:{port}",
+        'host': host,
+        'port': port,
+        'user': user,
+        'password': password,
+        'concurrency': concurrency
+    }
+
+
+def load_config_credentials(path=CONFIG_FILE):
+    config = configparser.ConfigParser()
+    config.read(path)
+    if 'PostgreSQL' not in config:
+        return None
+    section = config['PostgreSQL']
+    return {
+        'host': section.get('host', ''),
+        'port': section.get('port', ''),
+        'user': section.get('user', ''),
+        'password': section.get('password', '')
+    }
+
+
+def load_config_options(path=CONFIG_FILE):
+    # PatchOptions from the [Execution] section; missing keys keep their defaults.
+    config = configparser.ConfigParser()
+    config.read(path)
+    defaults = PatchOptions()
+    if 'Execution' not in config:
+        return defaults
+    section = config['Execution']
+    return PatchOptions(
+        lock_timeout=section.get('lock_timeout', defaults.lock_timeout),
+        statement_timeout=section.get('statement_timeout', defaults.statement_timeout),
+        max_retries=section.getint('max_retries', defaults.max_retries),
+        retry_backoff=section.getfloat('retry_backoff', defaults.retry_backoff),
+        probe_locks=section.getboolean('probe_locks', defaults.probe_locks),
+        lock_probe_age=section.getfloat('lock_probe_age', defaults.lock_probe_age),
+        adaptive=section.getboolean('adaptive', defaults.adaptive),
+        connection_headroom=section.getint('connection_headroom', defaults.connection_headroom),
+        preflight=section.getboolean('preflight', defaults.preflight),
+        pipeline=section.getboolean('pipeline', defaults.pipeline)
+    )
+
+
+def load_config_inventory(path=CONFIG_FILE):
+    # [PostgreSQL] is the default server; every [PostgreSQL:<name>] section adds one more.
+    config = configparser.ConfigParser()
+    config.read(path)
+    servers = []
+    for section_name in config.sections():
+        if section_name == 'PostgreSQL':
+            name = None
+        elif section_name.startswith(SERVER_SECTION_PREFIX):
+            name = section_name[len(SERVER_SECTION_PREFIX):].strip()
+        else:
+            continue
+        section = config[section_name]
+        servers.append(make_server(
+            section.get('host', ''),
+            section.get('port', ''),
+            section.get('user', ''),
+            section.get('password', ''),
+            name=name,
+            concurrency=section.getint('concurrency', fallback=None)
+        ))
+    return servers
+
+
+def parse_pgcon(content):
+    pghost_match = re.search(r'Server=([^;]+);', content)
+    pgport_match = re.search(r'Port=([^;]+);', content)
+    pgpass_match = re.search(r'Password=([^;]+);', content)
+    pguser_match = re.search(r'User Id=([^;]+);', content)
+    if not (pghost_match and pgport_match and pguser_match and pgpass_match):
+        return None
+    return {
+        'host': pghost_match.group(1),
+        'port': pgport_match.group(1),
+        'user': pguser_match.group(1),
+        'password': pgpass_match.group(1)
+    }
+
+
+def load_pgcon_credentials(path=PGCON_FILE):
+    with open(path, 'r') as f:
+        return parse_pgcon(f.read())
+
+
+def load_pgcon_inventory(path=PGCON_FILE):
+    # One connection string per line.
+    servers = []
+    with open(path, 'r') as f:
+        for line in f:
+            credentials = parse_pgcon(line)
+            if credentials:
+                servers.append(make_server(**credentials))
+    return servers
+
+
+def list_databases(pool, credentials):
+    with pool.connection(credentials, 'postgres') as conn:
+        cursor = conn.cursor()
+        cursor.execute(DATABASE_LIST_QUERY)
+        databases = cursor.fetchall()
+        conn.commit()
+    return [db[0] for db in databases]
+
+
+def list_database_details(pool, server):
+    # Rows of (name, size in bytes or None, encoding).
+    with pool.connection(server, 'postgres') as conn:
+        cursor = conn.cursor()
+        cursor.execute(DATABASE_DETAILS_QUERY)
+        rows = cursor.fetchall()
+        conn.commit()
+    return rows
+
+
+def discover_targets(pool, servers):
+    # Lists every server in parallel. Returns (targets, errors) where errors maps
+    # server name to the error text of servers that could not be listed.
+    targets = []
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max(1, len(servers))) as executor:
+        futures = {executor.submit(list_databases, pool, server): server for server in servers}
+        for future in as_completed(futures):
+            server = futures[future]
+            try:
+                targets.extend((server, db) for db in future.result())
+            except Exception as e:
+                errors[server['name']] = str(e)
+    order = {server['name']: index for index, server in enumerate(servers)}
+    targets.sort(key=lambda target: order[target[0]['name']])
+    return targets, errors
+
+
+def server_concurrency(server, concurrency):
+    return max(1, server.get('concurrency') or concurrency)
+
+
+def group_by_server(targets):
+    groups = {}
+    for server, db in targets:
+        groups.setdefault(server['name'], (server, []))[1].append(db)
+    return list(groups.values())
+
+
+def execute_patch(cursor, query):
+    # query is the patch text, a PatchFile streamed from disk in batches, or a CopyLoad
+    # streamed with COPY FROM STDIN. Returns the rows affected as reported for the last
+    # statement of each batch, or the rows copied.
+    if isinstance(query, CopyLoad):
+        cursor.copy_expert(query.copy_sql(), query.reader(), COPY_CHUNK_SIZE)
+        return max(cursor.rowcount, 0)
+    rows = 0
+    batches = query.batches() if isinstance(query, PatchFile) else [query]
+    for batch in batches:
+        cursor.execute(batch)
+        if cursor.rowcount > 0:
+            rows += cursor.rowcount
+    return rows
+
+
+async def execute_patch_async(conn, query):
+    if isinstance(query, CopyLoad):
+        return command_rows(await conn.copy_to_table(query.table, source=query.async_chunks(), **query.copy_options()))
+    rows = 0
+    batches = query.batches() if isinstance(query, PatchFile) else [query]
+    for batch in batches:
+        rows += command_rows(await conn.execute(batch))
+    return rows
+
+
+def quote_literal(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def pipelined_messages(query, options, ledger_hash=None, commit=True):
+    # The whole patch transaction as simple-query messages of many statements each,
+    # which the server runs back to back without waiting on the client: the first
+    # message also opens the transaction and applies the session settings, the last
+    # also records the patch in the target's ledger and commits (or rolls back, for a
+    # dry run). A patch that fits in one batch takes one round trip instead of one for
+    # BEGIN, the settings, every batch and the COMMIT. An error skips the rest of its
+    # message and leaves the transaction aborted, so nothing after it commits.
+    head = ["BEGIN", SESSION_SETTINGS_SQL.format(quote_literal(options.lock_timeout),
+                                                 quote_literal(options.statement_timeout))]
+    tail = ([ledger.record_in_target_sql(ledger_hash)] if ledger_hash else []) + ["COMMIT" if commit else "ROLLBACK"]
+    pending = None
+    for batch in (query.batches() if isinstance(query, PatchFile) else [query]):
+        if pending is not None:
+            yield PIPELINE_SEPARATOR.join(head + [pending])
+            head = []
+        pending = batch
+    yield PIPELINE_SEPARATOR.join(head + ([pending] if pending is not None else []) + tail)
+
+
+def execute_pipelined(cursor, query, options, ledger_hash=None, commit=True):
+    # The connection is in autocommit mode, where psycopg2's rollback() does nothing,
+    # so a failed transaction is ended here before the connection goes back to the pool.
+    try:
+        for message in pipelined_messages(query, options, ledger_hash, commit):
+            cursor.execute(message)
+    except Exception:
+        call_quietly(lambda: cursor.execute("ROLLBACK"))
+        raise
+
+
+def error_sqlstate(error):
+    # psycopg2 exposes the SQLSTATE as pgcode, asyncpg as sqlstate.
+    return getattr(error, 'pgcode', None) or getattr(error, 'sqlstate', None)
+
+
+def command_rows(status):
+    # asyncpg returns the command tag, e.g. "INSERT 0 5" or "UPDATE 3".
+    last = status.rsplit(' ', 1)[-1] if status else ''
+    return int(last) if last.isdigit() else 0
+
+
+def should_probe(options, attempt):
+    # The last attempt runs regardless of contention and relies on the lock timeout.
+    return options.probe_locks and attempt <= options.max_retries
+
+
+def is_connection_limit(outcome):
+    return outcome.sqlstate == TOO_MANY_CONNECTIONS or any(text in (outcome.error or '')
+                                                           for text in CONNECTION_LIMIT_ERRORS)
+
+
+def should_retry(outcome, options):
+    retryable = outcome.sqlstate in RETRYABLE_SQLSTATES or is_connection_limit(outcome)
+    return not outcome.ok and retryable and outcome.attempts <= options.max_retries
+
+
+def retry_delay(options, attempt):
+    # Exponential backoff with jitter, so databases postponed together do not return together.
+    return min(MAX_RETRY_DELAY, options.retry_backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+
+
+def postponed_message(sessions):
+    return f"Postponed: {sessions} other session(s) hold or wait for locks in this database"
+
+
+def not_started(server, db, attempt=1):
+    return Outcome(server['name'], db, False, 0.0, 'Cancelled before it started', attempts=attempt,
+                   cancelled=NOT_STARTED)
+
+
+def apply_patch(pool, server, db, query, ledger_hash=None, options=None, attempt=1, control=None, dry_run=False,
+                skip_applied=True):
+    # Runs on a pool worker; every database gets its own connection and transaction.
+    # With ledger_hash the patch is recorded in the target's own ledger table, and
+    # skipped when that table already has it unless skip_applied is False.
+    # control is an optional RunControl that can cancel the session from another thread.
+    # A dry run executes the patch the same way and rolls it back instead of committing.
+    # Pipelined patches are sent as pipelined_messages; their rows are not reported, as
+    # the server only returns the command tag of the last statement of each message.
+    if is_cancelled(control):
+        return not_started(server, db, attempt)
+    options = options or PatchOptions()
+    pipelined = options.pipeline and not isinstance(query, CopyLoad)
+    started = time.perf_counter()
+    phases = {'attempts': attempt}
+    mark = started
+    try:
+        with pool.connection(server, db) as conn:
+            now = time.perf_counter()
+            phases['connect_time'], mark = now - mark, now
+            if control and not control.watch(conn.cancel):
+                return not_started(server, db, attempt)
+            try:
+                if pipelined:
+                    # The messages open and end the transaction themselves.
+                    conn.autocommit = True
+                cursor = conn.cursor()
+                if should_probe(options, attempt):
+                    cursor.execute(LOCK_PROBE_QUERY, (options.lock_probe_age,))
+                    sessions = cursor.fetchone()[0]
+                    if sessions:
+                        return Outcome(server['name'], db, False, time.perf_counter() - started,
+                                       postponed_message(sessions), sqlstate=LOCK_NOT_AVAILABLE, **phases)
+                if not pipelined:
+                    cursor.execute(SESSION_SETTINGS_QUERY, (options.lock_timeout, options.statement_timeout))
+                if ledger_hash and skip_applied and ledger.target_has_patch(cursor, ledger_hash):
+                    return Outcome(server['name'], db, True, time.perf_counter() - started, '', True, **phases)
+                if pipelined:
+                    execute_pipelined(cursor, query, options, ledger_hash, commit=not dry_run)
+                else:
+                    phases['rows'] = execute_patch(cursor, query)
+                    if ledger_hash:
+                        ledger.record_in_target(cursor, ledger_hash)
+                now = time.perf_counter()
+                phases['execute_time'], mark = now - mark, now
+                if dry_run:
+                    conn.rollback()
+                else:
+                    conn.commit()
+                now = time.perf_counter()
+                phases['commit_time'], mark = now - mark, now
+            finally:
+                if control:
+                    control.unwatch(conn.cancel)
+                if pipelined and not conn.closed:
+                    conn.autocommit = False
+        phases['close_time'] = time.perf_counter() - mark
+        return Outcome(server['name'], db, True, time.perf_counter() - started, '', **phases)
+    except Exception as e:
+        return Outcome(server['name'], db, False, time.perf_counter() - started, str(e),
+                       sqlstate=error_sqlstate(e), cancelled=ROLLED_BACK if is_cancelled(control) else None,
+                       **phases)
+
+
+def plan_with_ledger(patch_ledger, targets, query, on_result):
+    # Reports targets the ledger already knows about as skipped and wraps on_result so
+    # that every success is recorded. Returns (pending targets, skipped outcomes,
+    # callback, hash for the in-database ledger or None).
+    if not patch_ledger:
+        return targets, [], on_result, None
+    patch_hash = ledger.hash_patch(query)
+    pending, done = patch_ledger.partition(patch_hash, targets)
+    servers = {server['name']: server for server, _ in targets}
+
+    def record(outcome):
+        if outcome.ok:
+            patch_ledger.record(patch_hash, servers[outcome.server], outcome.database)
+        if on_result:
+            on_result(outcome)
+
+    skipped = [Outcome(server['name'], db, True, 0.0, '', True) for server, db in done]
+    if on_result:
+        for outcome in skipped:
+            on_result(outcome)
+    return pending, skipped, record, patch_hash if patch_ledger.in_database else None
+
+
+def skips_applied(patch_ledger):
+    # Whether the in-database ledger is consulted, or only written (a forced run).
+    return patch_ledger.skip_applied if patch_ledger else True
+
+
+def observed(metrics, on_result):
+    if not metrics:
+        return on_result
+
+    def observe(outcome):
+        metrics.observe(outcome)
+        if on_result:
+            on_result(outcome)
+    return observe
+
+
+def tracked(metrics, function, *args, **kwargs):
+    # Counts the call as in flight for the concurrency gauge.
+    if not metrics:
+        return function(*args, **kwargs)
+    metrics.enter()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        metrics.leave()
+
+
+def run_patch(pool, targets, query, concurrency, on_result=None, patch_ledger=None, metrics=None, options=None,
+              control=None, limits=None, on_start=None):
+    # Each server gets its own worker pool and is handed no more databases at a time
+    # than its concurrency limit, so a slow server only holds up its own databases.
+    # The limit is fixed, or follows the server's load when limits (an
+    # adaptive.AdaptiveConcurrency) is given. on_result is called on the calling
+    # thread as each database finishes, on_start(server name, database) as each
+    # attempt is handed to a worker. metrics is an optional metrics.RunMetrics.
+    # Databases to retry wait in a heap ordered by due time and are queued again
+    # between completions, so they never hold a worker while backing off. After
+    # control.cancel() queued databases are reported as not started.
+    options = options or PatchOptions()
+    on_result = observed(metrics, on_result)
+    targets, outcomes, on_result, ledger_hash = plan_with_ledger(patch_ledger, targets, query, on_result)
+    skip_applied = skips_applied(patch_ledger)
+    servers = {server['name']: server for server, _ in targets}
+    executors = {}
+    queued = {}
+    running = {}
+    futures = {}
+    retries = []
+    sequence = itertools.count()
+
+    def limit(name):
+        return limits.limit(name) if limits else server_concurrency(servers[name], concurrency)
+
+    def dispatch():
+        for name, queue in queued.items():
+            while queue and running[name] < limit(name):
+                db, attempt = queue.popleft()
+                running[name] += 1
+                if limits:
+                    limits.started(name)
+                if on_start:
+                    on_start(name, db)
+                future = executors[name].submit(tracked, metrics, apply_patch, pool, servers[name], db, query,
+                                                ledger_hash, options, attempt, control, skip_applied=skip_applied)
+                futures[future] = name
+
+    groups = group_by_server(targets)
+    if limits:
+        limits.start([server for server, _ in groups], concurrency)
+    try:
+        for server, databases in groups:
+            name = server['name']
+            executors[name] = ThreadPoolExecutor(max_workers=server_concurrency(server, concurrency))
+            queued[name] = deque((db, 1) for db in databases)
+            running[name] = 0
+        dispatch()
+        while futures or retries:
+            timeout = None
+            if retries:
+                # Wake up regularly so a cancel does not wait for the next retry.
+                timeout = min(CANCEL_POLL_INTERVAL, max(0.0, retries[0][0] - time.monotonic()))
+            done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            finished = []
+            for future in done:
+                name = futures.pop(future)
+                running[name] -= 1
+                outcome = future.result()
+                if limits:
+                    limits.finished(name)
+                    limits.record(outcome)
+                finished.append(outcome)
+            if is_cancelled(control):
+                # A database waiting for its retry was last rolled back.
+                finished += [entry[4]._replace(cancelled=ROLLED_BACK) for entry in retries]
+                retries = []
+                for name, queue in queued.items():
+                    finished += [not_started(servers[name], db, attempt) for db, attempt in queue]
+                    queue.clear()
+            for outcome in finished:
+                if should_retry(outcome, options) and not is_cancelled(control):
+                    due = time.monotonic() + retry_delay(options, outcome.attempts)
+                    server, db = servers[outcome.server], outcome.database
+                    heapq.heappush(retries, (due, next(sequence), server, db, outcome))
+                    continue
+                outcomes.append(outcome)
+                if on_result:
+                    on_result(outcome)
+            while retries and retries[0][0] <= time.monotonic():
+                _, _, server, db, outcome = heapq.heappop(retries)
+                # Ahead of databases not tried yet: they have already waited their turn.
+                queued[server['name']].appendleft((db, outcome.attempts + 1))
+            dispatch()
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=True)
+        if limits:
+            limits.stop()
+        if metrics:
+            metrics.finish()
+    return outcomes
+
+
+def run_patch_async(targets, query, concurrency, on_result=None, patch_ledger=None, metrics=None, options=None,
+                    control=None, limits=None, on_start=None):
+    # Alternative backend: a single event loop drives every per-database session,
+    # so hundreds of databases can be in flight without one OS thread each.
+    # Raises ImportError when asyncpg is not installed.
+    import asyncio
+    import asyncpg
+    on_result = observed(metrics, on_result)
+    targets, skipped, on_result, ledger_hash = plan_with_ledger(patch_ledger, targets, query, on_result)
+    try:
+        outcomes = asyncio.run(_run_patch_async(asyncpg, targets, query, concurrency, on_result, ledger_hash, metrics,
+                                                options or PatchOptions(), control, limits, on_start,
+                                                skips_applied(patch_ledger)))
+    finally:
+        if limits:
+            limits.stop()
+        if metrics:
+            metrics.finish()
+    return skipped + list(outcomes)
+
+
+async def _run_patch_async(asyncpg, targets, query, concurrency, on_result, ledger_hash, metrics, options, control,
+                           limits, on_start, skip_applied=True):
+    # Cancelling the run cancels every task; asyncpg then sends the server-side cancel
+    # for a query in progress and each task reports what became of its database.
+    import asyncio
+    groups = group_by_server(targets)
+    if limits:
+        limits.start([server for server, _ in groups], concurrency)
+    semaphores = {}
+    for server, _ in groups:
+        if limits:
+            semaphores[server['name']] = limits.async_slot(server['name'])
+        else:
+            semaphores[server['name']] = asyncio.Semaphore(server_concurrency(server, concurrency))
+    tasks = [
+        asyncio.ensure_future(_apply_patch_async(asyncpg, semaphores[server['name']], server, db, query, on_result,
+                                                 ledger_hash, metrics, options, limits, on_start, skip_applied))
+        for server, db in targets
+    ]
+    loop = asyncio.get_running_loop()
+
+    def cancel_tasks():
+        for task in tasks:
+            task.cancel()
+
+    def request_cancel():
+        loop.call_soon_threadsafe(cancel_tasks)
+
+    if control and not control.watch(request_cancel):
+        cancel_tasks()
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        if control:
+            control.unwatch(request_cancel)
+
+
+async def _apply_patch_async(asyncpg, semaphore, server, db, query, on_result, ledger_hash, metrics, options, limits,
+                             on_start, skip_applied=True):
+    # Backs off outside the semaphore, so a retrying database does not hold a slot.
+    import asyncio
+    attempt = 1
+    outcome = None
+    try:
+        while True:
+            async with semaphore:
+                if on_start:
+                    on_start(server['name'], db)
+                if metrics:
+                    metrics.enter()
+                try:
+                    outcome = await _attempt_patch_async(asyncpg, server, db, query, ledger_hash, options, attempt,
+                                                         skip_applied)
+                finally:
+                    if metrics:
+                        metrics.leave()
+                if limits:
+                    limits.record(outcome)
+            if not should_retry(outcome, options):
+                break
+            await asyncio.sleep(retry_delay(options, attempt))
+            attempt += 1
+    except asyncio.CancelledError:
+        # Cancelled while waiting for a slot or backing off before a retry.
+        outcome = outcome._replace(cancelled=ROLLED_BACK) if outcome else not_started(server, db)
+    if on_result:
+        on_result(outcome)
+    return outcome
+
+
+async def _attempt_patch_async(asyncpg, server, db, query, ledger_hash, options, attempt, skip_applied=True):
+    import asyncio
+    started = time.perf_counter()
+    phases = {'attempts': attempt}
+    skipped = False
+    try:
+        conn = await asyncpg.connect(
+            database=db,
+            host=server['host'],
+            port=int(server['port']),
+            user=server['user'],
+            password=server['password']
+        )
+        now = time.perf_counter()
+        phases['connect_time'], mark = now - started, now
+        try:
+            if should_probe(options, attempt):
+                sessions = await conn.fetchval(LOCK_PROBE_QUERY_ASYNC, float(options.lock_probe_age))
+                if sessions:
+                    return Outcome(server['name'], db, False, time.perf_counter() - started,
+                                   postponed_message(sessions), sqlstate=LOCK_NOT_AVAILABLE, **phases)
+            if options.pipeline and not isinstance(query, CopyLoad):
+                # No transaction object: the messages open and commit it. On an error the
+                # connection is closed below, which ends the aborted transaction.
+                if ledger_hash and skip_applied and await ledger.target_has_patch_async(conn, ledger_hash):
+                    skipped = True
+                else:
+                    for message in pipelined_messages(query, options, ledger_hash):
+                        await conn.execute(message)
+                now = time.perf_counter()
+                phases['execute_time'], mark = now - mark, now
+            else:
+                transaction = conn.transaction()
+                await transaction.start()
+                try:
+                    await conn.execute(SESSION_SETTINGS_QUERY_ASYNC, options.lock_timeout, options.statement_timeout)
+                    if ledger_hash and skip_applied and await ledger.target_has_patch_async(conn, ledger_hash):
+                        skipped = True
+                    else:
+                        phases['rows'] = await execute_patch_async(conn, query)
+                        if ledger_hash:
+                            await ledger.record_in_target_async(conn, ledger_hash)
+                    now = time.perf_counter()
+                    phases['execute_time'], mark = now - mark, now
+                except BaseException:
+                    await transaction.rollback()
+                    raise
+                await transaction.commit()
+            if not skipped:
+                now = time.perf_counter()
+                phases['commit_time'], mark = now - mark, now
+        finally:
+            await conn.close()
+        if not skipped:
+            phases['close_time'] = time.perf_counter() - mark
+        return Outcome(server['name'], db, True, time.perf_counter() - started, '', skipped, **phases)
+    except asyncio.CancelledError:
+        if 'commit_time' in phases:
+            # The cancel arrived while closing an already committed session.
+            return Outcome(server['name'], db, True, time.perf_counter() - started, '', skipped, **phases)
+        if 'connect_time' not in phases:
+            return not_started(server, db, attempt)
+        return Outcome(server['name'], db, False, time.perf_counter() - started, 'Cancelled', cancelled=ROLLED_BACK,
+                       **phases)
+    except Exception as e:
+        return Outcome(server['name'], db, False, time.perf_counter() - started, str(e),
+                       sqlstate=error_sqlstate(e), **phases)
+
+
+def summarize(outcomes):
+    skipped = sum(1 for outcome in outcomes if outcome.skipped)
+    succeeded = sum(1 for outcome in outcomes if outcome.ok) - skipped
+    rolled_back = sum(1 for outcome in outcomes if outcome.cancelled == ROLLED_BACK)
+    not_started = sum(1 for outcome in outcomes if outcome.cancelled == NOT_STARTED)
+    failed = len(outcomes) - succeeded - skipped - rolled_back - not_started
+    if rolled_back or not_started:
+        return (f"Patch run cancelled: {succeeded} committed, {failed} failed, {skipped} skipped (already applied), "
+                f"{rolled_back} rolled back, {not_started} not started.")
+    return f"Patch run finished: {succeeded} succeeded, {failed} failed, {skipped} skipped (already applied)."
+
+
+def cancellation_report(outcomes):
+    # One line per category naming every database, for a cancelled run.
+    lines = []
+    for label, selected in (
+        ('Committed', [outcome for outcome in outcomes if outcome.ok and not outcome.skipped]),
+        ('Rolled back', [outcome for outcome in outcomes if outcome.cancelled == ROLLED_BACK]),
+        ('Not started', [outcome for outcome in outcomes if outcome.cancelled == NOT_STARTED]),
+    ):
+        names = ", ".join(f"{outcome.server}/{outcome.database}" for outcome in selected)
+        lines.append(f"{label} ({len(selected)}): {names or '-'}")
+    return lines
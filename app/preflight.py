@@ -0,0 +1,187 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from sqlscript import PatchFile, iter_statements, find_transaction_control
+from copyload import CopyLoad
+from patchrun import (PatchOptions, apply_patch, group_by_server, server_concurrency, is_cancelled, not_started,
+                      skips_applied)
+import ledger
+
+# Pre-flight check of a patch. Every selected database gets a schema fingerprint (a
+# hash of its columns and function signatures), computed in parallel and cached in
+# the catalog. Databases with the same fingerprint would run the patch against the
+# same schema, so it is dry-run (executed, then rolled back) on one database per
+# group instead of on every tenant. Groups other than the largest are reported as
+# schema drift. Nothing in here may import Qt.
+#
+# A dry run still takes the patch's locks for its duration, and sequence values it
+# consumes are not given back. A patch with its own transaction control (BEGIN,
+# COMMIT, END, ROLLBACK, ...) would commit for real in the middle of a dry run, so
+# the check refuses it without touching any database.
+
+LEDGER_SCHEMA, LEDGER_TABLE = ledger.TARGET_LEDGER_TABLE.split('.')
+FINGERPRINT_QUERY = (
+    "SELECT md5(concat_ws('|',"
+    " (SELECT string_agg(format('%s.%s.%s %s %s', table_schema, table_name, column_name, data_type, is_nullable),"
+    " ',' ORDER BY table_schema, table_name, column_name)"
+    " FROM information_schema.columns"
+    " WHERE table_schema NOT IN ('pg_catalog', 'information_schema') AND table_schema NOT LIKE 'pg\\_%'"
+    f" AND (table_schema, table_name) <> ('{LEDGER_SCHEMA}', '{LEDGER_TABLE}')),"
+    " (SELECT string_agg(format('%s.%s(%s) %s', n.nspname, p.proname, pg_get_function_identity_arguments(p.oid),"
+    " pg_get_function_result(p.oid)), ',' ORDER BY n.nspname, p.proname, pg_get_function_identity_arguments(p.oid))"
+    " FROM pg_proc p JOIN pg_namespace n ON n.oid = p.pronamespace"
+    " WHERE n.nspname NOT IN ('pg_catalog', 'information_schema') AND n.nspname NOT LIKE 'pg\\_%')))"
+)
+DRIFT_LISTED = 10
+
+# targets share the fingerprint, largest group first; outcome is the dry run of one
+# of them, or None when the check was cancelled before it.
+SchemaGroup = namedtuple('SchemaGroup', ['fingerprint', 'targets', 'outcome'])
+# unchecked maps (server name, database) of targets without a fingerprint to the error;
+# refused is the transaction control statement the check was refused for, or None.
+PreflightReport = namedtuple('PreflightReport', ['groups', 'unchecked', 'refused'], defaults=[None])
+MAX_STATEMENT_SHOWN = 80
+
+
+def fingerprint_database(pool, server, db, control=None):
+    if is_cancelled(control):
+        return None
+    with pool.connection(server, db) as conn:
+        cursor = conn.cursor()
+        cursor.execute(FINGERPRINT_QUERY)
+        fingerprint = cursor.fetchone()[0]
+        conn.rollback()
+    return fingerprint
+
+
+def compute_fingerprints(pool, targets, concurrency, catalog=None, control=None):
+    # Returns ({(server name, database): fingerprint}, {(server name, database): error}).
+    # Fingerprints cached in the catalog within its TTL are not computed again.
+    fingerprints = catalog.fingerprints(targets) if catalog else {}
+    missing = [(server, db) for server, db in targets if (server['name'], db) not in fingerprints]
+    computed = {}
+    errors = {}
+    executors = []
+    try:
+        futures = {}
+        for server, databases in group_by_server(missing):
+            executor = ThreadPoolExecutor(max_workers=server_concurrency(server, concurrency))
+            executors.append(executor)
+            for db in databases:
+                futures[executor.submit(fingerprint_database, pool, server, db, control)] = (server['name'], db)
+        for future in as_completed(futures):
+            try:
+                fingerprint = future.result()
+            except Exception as e:
+                errors[futures[future]] = str(e)
+                continue
+            if fingerprint is not None:
+                computed[futures[future]] = fingerprint
+    finally:
+        for executor in executors:
+            executor.shutdown(wait=True)
+    if catalog and computed:
+        catalog.store_fingerprints({server['name']: server for server, _ in targets}, computed)
+    fingerprints.update(computed)
+    return fingerprints, errors
+
+
+def group_by_fingerprint(targets, fingerprints):
+    # [(fingerprint, targets)], largest group first; targets keep their order.
+    groups = {}
+    for server, db in targets:
+        fingerprint = fingerprints.get((server['name'], db))
+        if fingerprint is not None:
+            groups.setdefault(fingerprint, []).append((server, db))
+    return sorted(groups.items(), key=lambda item: len(item[1]), reverse=True)
+
+
+def dry_run_group(pool, members, query, ledger_hash, options, control, skip_applied=True):
+    # Dry-runs the first member that has not been patched yet according to its
+    # in-database ledger; a group patched everywhere reports the last skip.
+    outcome = None
+    for server, db in members:
+        if is_cancelled(control):
+            return not_started(server, db)
+        outcome = apply_patch(pool, server, db, query, ledger_hash, options, control=control, dry_run=True,
+                              skip_applied=skip_applied)
+        if not outcome.skipped:
+            break
+    return outcome
+
+
+def transaction_control(query):
+    # The statement of the patch that begins, ends or commits a transaction, or None.
+    if isinstance(query, CopyLoad):
+        return None
+    return find_transaction_control(query.statements() if isinstance(query, PatchFile) else iter_statements([query]))
+
+
+def preflight(pool, targets, query, concurrency, options=None, control=None, catalog=None, patch_ledger=None):
+    # Returns a PreflightReport for the targets the run would patch. With a catalog the
+    # smallest known database of each group is dry-run first. Dry runs do not wait for
+    # busy databases (probe_locks); lock_timeout still applies.
+    refused = transaction_control(query)
+    if refused is not None:
+        return PreflightReport([], {}, refused)
+    options = (options or PatchOptions())._replace(probe_locks=False)
+    ledger_hash = None
+    if patch_ledger:
+        targets, _ = patch_ledger.partition(ledger.hash_patch(query), targets)
+        if patch_ledger.in_database:
+            ledger_hash = ledger.hash_patch(query)
+    fingerprints, unchecked = compute_fingerprints(pool, targets, concurrency, catalog, control)
+    groups = group_by_fingerprint(targets, fingerprints)
+    sizes = catalog.history(targets) if catalog else {}
+
+    def size(target):
+        known = sizes.get((target[0]['name'], target[1]), (None, None))[1]
+        return (known is None, known or 0)
+
+    outcomes = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(groups)))) as executor:
+        futures = {executor.submit(dry_run_group, pool, sorted(members, key=size), query, ledger_hash, options,
+                                   control, skips_applied(patch_ledger)): fingerprint
+                   for fingerprint, members in groups}
+        for future in as_completed(futures):
+            outcomes[futures[future]] = future.result()
+    return PreflightReport([SchemaGroup(fingerprint, members, outcomes.get(fingerprint))
+                            for fingerprint, members in groups], unchecked)
+
+
+def preflight_passed(report):
+    # Databases without a fingerprint do not block the run; it reports them itself.
+    return report.refused is None and all(group.outcome is not None and group.outcome.ok for group in report.groups)
+
+
+def target_list(targets, limit=DRIFT_LISTED):
+    names = [f"{server['name']}/{db}" for server, db in targets[:limit]]
+    more = f" and {len(targets) - limit} more" if len(targets) > limit else ""
+    return ", ".join(names) + more
+
+
+def preflight_report(report):
+    # Lines describing every schema group, drift and failed dry run.
+    if report.refused is not None:
+        statement = " ".join(report.refused.split())
+        if len(statement) > MAX_STATEMENT_SHOWN:
+            statement = statement[:MAX_STATEMENT_SHOWN - 3] + "..."
+        return [f"Pre-flight refused: the patch controls its own transaction ({statement}), so a dry run would "
+                f"commit it for real. Run it without the pre-flight check, or remove the transaction control."]
+    databases = sum(len(group.targets) for group in report.groups)
+    lines = [f"Pre-flight: {databases} databases in {len(report.groups)} schema groups."]
+    for number, group in enumerate(report.groups, 1):
+        outcome = group.outcome
+        if outcome is None or outcome.cancelled:
+            result = "dry run cancelled"
+        elif outcome.skipped:
+            result = "already applied everywhere"
+        elif outcome.ok:
+            result = f"dry run OK on {outcome.server}/{outcome.database} ({outcome.elapsed:.2f}s)"
+        else:
+            code = f" [{outcome.sqlstate}]" if outcome.sqlstate else ""
+            result = f"dry run FAILED on {outcome.server}/{outcome.database}{code}: {outcome.error}"
+        drift = f", schema differs from group 1: {target_list(group.targets)}" if number > 1 else ""
+        lines.append(f"  Group {number} ({len(group.targets)} databases{drift}): {result}")
+    for (server, db), error in sorted(report.unchecked.items()):
+        lines.append(f"  Not checked {server}/{db}: {error}")
+    return lines
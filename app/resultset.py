@@ -0,0 +1,283 @@
+import csv
+import json
+import time
+import tempfile
+import itertools
+import threading
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from patchrun import (Outcome, PatchOptions, ROLLED_BACK, group_by_server, server_concurrency, observed, tracked,
+                      is_cancelled, not_started, error_sqlstate)
+
+# Read queries across many databases. Each database is read through a server-side
+# (named) cursor in fetchmany batches. Rows are tagged with their server and
+# database and staged per database (see SpoolSegment), so a worker holds at most
+# STAGING_MEMORY of them in memory; once the database has been read completely they
+# are appended to one ResultSpool on disk, which the GUI pages through and which
+# exports to CSV by streaming. A database that fails mid-fetch leaves no rows behind.
+# Nothing in here may import Qt.
+
+FETCH_SIZE = 2000
+PAGE_SIZE = 500
+RESULTS_FILE = 'query_results.csv'
+TAG_COLUMNS = ['server', 'database']
+STREAM_CHUNK_SIZE = 64
+STAGING_MEMORY = 1024 * 1024
+DECIMAL_TAG = '$decimal'
+READ_ONLY_QUERY = "SET TRANSACTION READ ONLY"
+STATEMENT_TIMEOUT_QUERY = "SELECT set_config('statement_timeout', %s, true)"
+
+cursor_names = itertools.count(1)
+
+
+def read_query_text(text):
+    # A named cursor takes exactly one statement; a trailing semicolon is tolerated.
+    query = text.strip().rstrip(';').strip()
+    if not query:
+        raise ValueError("The read query is empty.")
+    return query
+
+
+def encode_value(value):
+    # json.dumps fallback. Decimals (numeric, and sum() of integers) are kept exact so
+    # they still compare and add up as numbers after a round trip through the spool;
+    # dates, times and the rest become their text form.
+    if isinstance(value, Decimal):
+        return {DECIMAL_TAG: str(value)}
+    return str(value)
+
+
+def decode_object(mapping):
+    return Decimal(mapping[DECIMAL_TAG]) if DECIMAL_TAG in mapping else mapping
+
+
+def encode_row(row):
+    return json.dumps(row, default=encode_value, ensure_ascii=False).encode('utf-8') + b'\n'
+
+
+def check_columns(expected, columns):
+    # expected is None until the first database has been read.
+    if expected is not None and list(columns) != expected:
+        raise ValueError(f"Result columns ({', '.join(columns)}) differ from the other databases "
+                         f"({', '.join(expected)})")
+
+
+class ResultSpool:
+    # Append-only store of result rows in a temporary file, one JSON array per line so
+    # NULLs and types survive until export. Workers append a whole database at a time
+    # under the lock (see segment); the byte offset of every PAGE_SIZE-th row is kept
+    # so any page can be read back with one seek, and each database's rows are indexed
+    # as a segment so they can be streamed back on their own. The first database read
+    # fixes the columns. tag_columns are prefixed to every row ([] for derived results).
+    def __init__(self, page_size=PAGE_SIZE, tag_columns=TAG_COLUMNS):
+        self.page_size = page_size
+        self.tag_columns = list(tag_columns)
+        self.lock = threading.Lock()
+        self.file = tempfile.TemporaryFile()
+        self.columns = None
+        self.row_count = 0
+        self.page_offsets = []
+        self.segments = {}
+        self.end = 0
+
+    def segment(self, server, database):
+        return SpoolSegment(self, server, database)
+
+    def check_columns(self, columns):
+        with self.lock:
+            check_columns(self.columns, columns)
+
+    def write(self, columns, rows, source=None):
+        # rows already carry their tag values.
+        self.append(columns, (encode_row(row) for row in rows), source)
+
+    def append(self, columns, lines, source=None):
+        # lines are rows encoded by encode_row.
+        with self.lock:
+            check_columns(self.columns, columns)
+            if self.columns is None:
+                self.columns = list(columns)
+            if source is not None:
+                self.segments.setdefault(source, [])
+            start = self.end
+            self.file.seek(start)
+            count = 0
+            for line in lines:
+                if self.row_count % self.page_size == 0:
+                    self.page_offsets.append(self.file.tell())
+                self.file.write(line)
+                self.row_count += 1
+                count += 1
+            self.end = self.file.tell()
+            if source is not None and count:
+                self.segments[source].append((start, count))
+
+    def read_lines(self, offset, count):
+        # Returns (rows, offset after them); callers hold no lock.
+        with self.lock:
+            self.file.seek(offset)
+            rows = [json.loads(self.file.readline(), object_hook=decode_object) for _ in range(count)]
+            return rows, self.file.tell()
+
+    def page_count(self):
+        return len(self.page_offsets)
+
+    def page(self, number):
+        # Rows of page number (0-based) as lists: the tags, then the columns.
+        with self.lock:
+            if not 0 <= number < len(self.page_offsets):
+                return []
+            offset = self.page_offsets[number]
+            size = min(self.page_size, self.row_count - number * self.page_size)
+        return self.read_lines(offset, size)[0]
+
+    def sources(self):
+        # (server, database) of every database that returned a result, empty or not.
+        with self.lock:
+            return list(self.segments)
+
+    def stream(self, source, chunk_size=STREAM_CHUNK_SIZE):
+        # Rows of one database in the order they were fetched, chunk_size rows at a time.
+        with self.lock:
+            segments = list(self.segments.get(source, []))
+        for offset, count in segments:
+            while count:
+                rows, offset = self.read_lines(offset, min(count, chunk_size))
+                count -= len(rows)
+                yield from rows
+
+    def header(self):
+        return self.tag_columns + (self.columns or [])
+
+    def export_csv(self, path):
+        # Reads the spool a page at a time, so writers are only held up per page.
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.header())
+            for number in itertools.count():
+                rows = self.page(number)
+                if not rows:
+                    break
+                writer.writerows(['' if value is None else value for value in row] for row in rows)
+        return self.row_count
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class SpoolSegment:
+    # The rows of one database while it is being read, staged in memory and past
+    # STAGING_MEMORY in a temporary file of their own. commit() appends them to the
+    # spool in one go; discard() drops them, e.g. when the database failed mid-fetch.
+    def __init__(self, spool, server, database):
+        self.spool = spool
+        self.source = (server, database)
+        self.file = tempfile.SpooledTemporaryFile(max_size=STAGING_MEMORY)
+        self.columns = None
+
+    def add(self, columns, rows):
+        # Columns are checked as soon as they are known, not only on commit.
+        self.spool.check_columns(columns)
+        self.columns = list(columns)
+        for row in rows:
+            self.file.write(encode_row(list(self.source) + list(row)))
+
+    def commit(self):
+        if self.columns is not None:
+            self.file.seek(0)
+            self.spool.append(self.columns, self.file, self.source)
+        self.file.close()
+
+    def discard(self):
+        self.file.close()
+
+
+def read_database(pool, server, db, query, spool, options=None, control=None, fetch_size=FETCH_SIZE):
+    # Runs on a pool worker: one read-only transaction per database, rolled back at the
+    # end. Outcome.rows is the number of rows fetched; there is no commit phase. The
+    # rows reach the spool (or aggregation) only when the whole database was read.
+    if is_cancelled(control):
+        return not_started(server, db)
+    options = options or PatchOptions()
+    started = time.perf_counter()
+    phases = {}
+    mark = started
+    rows = 0
+    segment = spool.segment(server['name'], db)
+    try:
+        with pool.connection(server, db) as conn:
+            now = time.perf_counter()
+            phases['connect_time'], mark = now - mark, now
+            if control and not control.watch(conn.cancel):
+                return not_started(server, db)
+            try:
+                settings = conn.cursor()
+                settings.execute(READ_ONLY_QUERY)
+                settings.execute(STATEMENT_TIMEOUT_QUERY, (options.statement_timeout,))
+                cursor = conn.cursor(name=f"patchrun_read_{next(cursor_names)}")
+                cursor.itersize = fetch_size
+                cursor.execute(query)
+                # A named cursor only has a description after its first fetch. Empty
+                # results still go through add() so their columns are checked too.
+                batch = cursor.fetchmany(fetch_size)
+                columns = [column[0] for column in cursor.description]
+                while True:
+                    segment.add(columns, batch)
+                    rows += len(batch)
+                    if len(batch) < fetch_size:
+                        break
+                    batch = cursor.fetchmany(fetch_size)
+                cursor.close()
+                now = time.perf_counter()
+                phases['execute_time'], mark = now - mark, now
+                conn.rollback()
+            finally:
+                if control:
+                    control.unwatch(conn.cancel)
+        phases['close_time'] = time.perf_counter() - mark
+        segment.commit()
+        return Outcome(server['name'], db, True, time.perf_counter() - started, '', rows=rows, **phases)
+    except Exception as e:
+        return Outcome(server['name'], db, False, time.perf_counter() - started, str(e), rows=rows,
+                       sqlstate=error_sqlstate(e), cancelled=ROLLED_BACK if is_cancelled(control) else None,
+                       **phases)
+    finally:
+        segment.discard()
+
+
+def run_read_query(pool, targets, query, concurrency, spool, on_result=None, metrics=None, options=None,
+                   control=None):
+    # Same per-server worker pools as patchrun.run_patch, without ledger or retries.
+    on_result = observed(metrics, on_result)
+    query = read_query_text(query)
+    outcomes = []
+    executors = []
+    try:
+        futures = []
+        for server, databases in group_by_server(targets):
+            executor = ThreadPoolExecutor(max_workers=server_concurrency(server, concurrency))
+            executors.append(executor)
+            futures += [executor.submit(tracked, metrics, read_database, pool, server, db, query, spool, options,
+                                        control)
+                        for db in databases]
+        for future in as_completed(futures):
+            outcome = future.result()
+            outcomes.append(outcome)
+            if on_result:
+                on_result(outcome)
+    finally:
+        for executor in executors:
+            executor.shutdown(wait=True)
+        if metrics:
+            metrics.finish()
+    return outcomes
+
+
+def summarize(outcomes, spool):
+    read = sum(1 for outcome in outcomes if outcome.ok)
+    cancelled = sum(1 for outcome in outcomes if outcome.cancelled)
+    failed = len(outcomes) - read - cancelled
+    status = "cancelled" if cancelled else "finished"
+    return (f"Read query {status}: {spool.row_count} rows from {read} databases, {failed} failed"
+            + (f", {cancelled} cancelled." if cancelled else "."))
@@ -0,0 +1,114 @@
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex
+from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QTableView, QPushButton, QLabel, QFileDialog,
+                             QMessageBox)
+from resultset import RESULTS_FILE
+
+# Paginated grid over a resultset.ResultSpool. Only the page on screen is loaded;
+# the spool keeps growing on disk while the read query runs.
+
+NULL_TEXT = 'NULL'
+
+
+class ResultPageModel(QAbstractTableModel):
+    def __init__(self, spool, parent=None):
+        super().__init__(parent)
+        self.spool = spool
+        self.header = spool.header()
+        self.rows = []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.header)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role not in (Qt.DisplayRole, Qt.ToolTipRole):
+            return None
+        value = self.rows[index.row()][index.column()]
+        return NULL_TEXT if value is None else str(value)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return self.header[section] if section < len(self.header) else None
+        return None
+
+    def loadPage(self, number):
+        self.beginResetModel()
+        self.header = self.spool.header()
+        self.rows = self.spool.page(number)
+        self.endResetModel()
+
+
+class ResultWindow(QWidget):
+    def __init__(self, spool, title, parent=None):
+        super().__init__(parent, Qt.Window)
+        self.setWindowTitle(title)
+        self.resize(900, 500)
+        self.spool = spool
+        self.page = 0
+        self.model = ResultPageModel(spool, self)
+
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self.table.setAlternatingRowColors(True)
+        self.table.verticalHeader().setVisible(False)
+
+        self.previous_button = QPushButton('< Previous')
+        self.previous_button.clicked.connect(lambda: self.showPage(self.page - 1))
+        self.next_button = QPushButton('Next >')
+        self.next_button.clicked.connect(lambda: self.showPage(self.page + 1))
+        self.pageLabel = QLabel('')
+        self.export_button = QPushButton('Export CSV...')
+        self.export_button.clicked.connect(self.exportCsv)
+
+        navigation_layout = QHBoxLayout()
+        navigation_layout.addWidget(self.previous_button)
+        navigation_layout.addWidget(self.pageLabel)
+        navigation_layout.addWidget(self.next_button)
+        navigation_layout.addStretch()
+        navigation_layout.addWidget(self.export_button)
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.table)
+        layout.addLayout(navigation_layout)
+        self.setLayout(layout)
+        self.showPage(0)
+
+    def showPage(self, number):
+        self.page = max(0, min(number, self.spool.page_count() - 1))
+        self.model.loadPage(self.page)
+        self.updateNavigation()
+
+    def refresh(self):
+        # Called as databases finish; reloads the current page only while it is still filling.
+        if len(self.model.rows) < self.spool.page_size or self.model.header != self.spool.header():
+            self.model.loadPage(self.page)
+        self.updateNavigation()
+
+    def setSpool(self, spool):
+        # Replaces the rows shown, e.g. with the merged result; the old spool is discarded.
+        if spool is not self.spool:
+            self.spool.close()
+            self.spool = spool
+            self.model.spool = spool
+        self.showPage(0)
+
+    def updateNavigation(self):
+        pages = self.spool.page_count()
+        self.pageLabel.setText(f"Page {self.page + 1 if pages else 0} of {pages} ({self.spool.row_count} rows)")
+        self.previous_button.setEnabled(self.page > 0)
+        self.next_button.setEnabled(self.page < pages - 1)
+
+    def exportCsv(self):
+        path, _ = QFileDialog.getSaveFileName(self, 'Export results', RESULTS_FILE, 'CSV files (*.csv);;All files (*)')
+        if not path:
+            return
+        try:
+            rows = self.spool.export_csv(path)
+        except OSError as e:
+            QMessageBox.critical(self, "Error", f"Could not write {path}: {e}")
+            return
+        QMessageBox.information(self, "Export", f"{rows} rows written to {path}.")
@@ -0,0 +1,123 @@
+import sys
+import json
+import time
+import uuid
+import queue
+import logging
+import argparse
+from logging.handlers import QueueHandler, QueueListener
+
+# Structured run log: one JSON line per database per run, with the phase timings of
+# the patch. Workers only put records on a queue; a listener thread does the file I/O.
+#
+#   python runlog.py --slowest 20          slowest databases of the last run
+#   python runlog.py --run <id> --failed   failures of a given run
+
+RUN_LOG_FILE = 'patch_runs.jsonl'
+
+
+def milliseconds(seconds):
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+def outcome_status(outcome):
+    if outcome.skipped:
+        return 'skipped'
+    if outcome.cancelled:
+        return 'cancelled'
+    return 'ok' if outcome.ok else 'failed'
+
+
+class JsonLineFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(record.msg, ensure_ascii=False)
+
+
+class RunLog:
+    # One instance per patch run. record() is safe to call from any worker thread
+    # and never waits on the disk; close() drains the queue and closes the file.
+    def __init__(self, patch_hash, path=RUN_LOG_FILE):
+        self.patch_hash = patch_hash
+        self.path = path
+        self.run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        records = queue.SimpleQueue()
+        handler = QueueHandler(records)
+        handler.setFormatter(JsonLineFormatter())
+        # A private logger, so nothing propagates to the root logger or app.log.
+        self.logger = logging.Logger(f'patchrun.runs.{self.run_id}')
+        self.logger.addHandler(handler)
+        file_handler = logging.FileHandler(path, encoding='utf-8', delay=True)
+        file_handler.setFormatter(logging.Formatter('%(message)s'))
+        self.listener = QueueListener(records, file_handler)
+        self.listener.start()
+
+    def record(self, outcome):
+        self.logger.info({
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'run_id': self.run_id,
+            'patch_hash': self.patch_hash,
+            'server': outcome.server,
+            'database': outcome.database,
+            'status': outcome_status(outcome),
+            'connect_ms': milliseconds(outcome.connect_time),
+            'execute_ms': milliseconds(outcome.execute_time),
+            'commit_ms': milliseconds(outcome.commit_time),
+            'close_ms': milliseconds(outcome.close_time),
+            'total_ms': milliseconds(outcome.elapsed),
+            'rows': outcome.rows,
+            'attempts': outcome.attempts,
+            'cancelled': outcome.cancelled,
+            'sqlstate': outcome.sqlstate,
+            'error': outcome.error or None,
+        })
+
+    def close(self):
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+
+
+def read_records(path=RUN_LOG_FILE, run_id=None):
+    # Without run_id only the records of the last run in the file are returned.
+    with open(path, encoding='utf-8') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if run_id is None and records:
+        run_id = records[-1]['run_id']
+    return [record for record in records if record['run_id'] == run_id]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Query the structured patch run log.')
+    parser.add_argument('--file', default=RUN_LOG_FILE, help='run log file (default: %(default)s)')
+    parser.add_argument('--run', help='run id (default: the last run in the file)')
+    parser.add_argument('--slowest', type=int, metavar='N', help='only the N slowest databases')
+    parser.add_argument('--failed', action='store_true', help='only failed databases')
+    args = parser.parse_args(argv)
+    try:
+        records = read_records(args.file, args.run)
+    except OSError as e:
+        print(f"Error reading run log: {e}", file=sys.stderr)
+        return 2
+    if args.failed:
+        records = [record for record in records if record['status'] == 'failed']
+    if args.slowest:
+        records = sorted(records, key=lambda record: record['total_ms'] or 0, reverse=True)[:args.slowest]
+    for record in records:
+        phases = '/'.join('-' if record.get(key) is None else f"{record[key]:.0f}"
+                          for key in ('connect_ms', 'execute_ms', 'commit_ms', 'close_ms'))
+        line = (f"{record['status']:<8}{record['server']}/{record['database']}  {record['total_ms']:.0f} ms "
+                f"(connect/execute/commit/close {phases})")
+        if record['rows'] is not None:
+            line += f"  rows={record['rows']}"
+        if record.get('attempts', 1) > 1:
+            line += f"  attempts={record['attempts']}"
+        if record['status'] == 'cancelled':
+            line += f"  ({record['cancelled']})"
+        if record['status'] == 'failed':
+            line += f"  [{record['sqlstate'] or '?'}] {record['error'].splitlines()[0] if record['error'] else ''}"
+        print(line)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+import threading
+from PyQt5.QtCore import QThread, pyqtSignal
+from adaptive import AdaptiveConcurrency
+import patchrun
+from copyload import CopyLoad
+from ledger import PatchLedger, hash_patch
+from schedule import longest_first, RunEta
+from preflight import preflight, preflight_passed, preflight_report
+from journal import FINISHED, CANCELLED, run_settings
+from runlog import RunLog
+from metrics import METRICS_FILE
+import resultset
+from gather import gathered
+
+# The GUI's worker threads. main.py imports this module when the first fetch or run
+# starts, so patchrun, SQLite and the rest are not loaded before the window is shown.
+
+ENGINE_THREADS = 'threads'
+ENGINE_ASYNCIO = 'asyncio'
+
+
+class DatabaseThread(QThread):
+    databases_fetched = pyqtSignal(list)
+    error_occurred = pyqtSignal(str)
+    query_executed = pyqtSignal(str)
+    # patchrun.Outcome of one database
+    database_finished = pyqtSignal(object)
+
+    engine = ENGINE_THREADS
+
+    def __init__(self, servers, pool, query=None, targets=None, concurrency=1, patch_ledger=None, catalog=None,
+                 metrics=None, options=None, journal=None, resumed_from=None):
+        super().__init__()
+        self.metrics = metrics
+        self.options = options
+        self.catalog = catalog
+        self.servers = servers
+        self.pool = pool
+        self.query = query
+        self.targets = targets
+        self.concurrency = max(1, concurrency)
+        self.patch_ledger = patch_ledger
+        self.run_log = None
+        # A journal.RunJournal records the run so it can be resumed; resumed_from is the
+        # run this one resumes.
+        self.journal = journal
+        self.resumed_from = resumed_from
+        self.journal_run = None
+        self.control = patchrun.RunControl()
+        self.eta = None
+        self.limits = None
+        if options and options.adaptive:
+            self.limits = AdaptiveConcurrency(pool, options.connection_headroom, on_change=self.report_limit)
+
+    def run(self):
+        if self.query:
+            self.execute_query()
+        else:
+            self.fetch_databases()
+
+    def fetch_databases(self):
+        try:
+            entries, errors, _, _ = self.catalog.refresh(self.pool, self.servers, PatchLedger())
+        except Exception as e:
+            self.error_occurred.emit(f"Error fetching databases: {str(e)}")
+            return
+        if errors:
+            details = "\n".join(f"{name}: {error}" for name, error in errors.items())
+            self.error_occurred.emit(f"Error fetching databases:\n{details}")
+        if entries or not errors:
+            self.databases_fetched.emit(entries)
+
+    def schedule(self):
+        # Longest expected databases first, from the durations and sizes in the catalog.
+        estimates = {}
+        if self.catalog:
+            self.targets, estimates = longest_first(self.targets, self.catalog.history(self.targets))
+        self.eta = RunEta(self.targets, estimates, self.concurrency)
+
+    def check_patch(self):
+        # The pre-flight dry runs; returns False when the run must not go ahead.
+        if not (self.options and self.options.preflight):
+            return True
+        try:
+            report = preflight(self.pool, self.targets, self.query, self.concurrency, self.options, self.control,
+                               self.catalog, self.patch_ledger)
+        except Exception as e:
+            self.error_occurred.emit(f"Error in the pre-flight check: {str(e)}")
+            return False
+        self.query_executed.emit("\n".join(preflight_report(report)))
+        if not preflight_passed(report):
+            self.error_occurred.emit("Pre-flight check failed; no database was patched.")
+            return False
+        return True
+
+    def begin_run(self):
+        self.run_log = RunLog(hash_patch(self.query))
+        if self.journal:
+            settings = run_settings(self.concurrency, self.engine, self.options, self.patch_ledger)
+            self.journal_run = self.journal.begin(self.run_log.run_id, self.query, self.run_log.patch_hash,
+                                                  self.targets, settings, self.resumed_from)
+
+    def report_start(self, server, db):
+        if self.journal_run:
+            self.journal_run.started(server, db)
+
+    def execute_query(self):
+        # The run log and journal are opened inside the try so a failure there is reported too.
+        status = None
+        try:
+            self.schedule()
+            if not self.check_patch():
+                return
+            self.begin_run()
+            outcomes = patchrun.run_patch(self.pool, self.targets, self.query, self.concurrency,
+                                          self.report_outcome, self.patch_ledger, self.metrics, self.options,
+                                          self.control, self.limits, self.report_start)
+            status = CANCELLED if self.control.cancelled else FINISHED
+        except Exception as e:
+            self.error_occurred.emit(f"Error running patch: {str(e)}")
+            return
+        finally:
+            self.close_run(status)
+        self.report_summary(outcomes)
+
+    def close_run(self, status=None):
+        # Without a status (the run raised) the journal keeps the run as interrupted.
+        if self.run_log:
+            self.run_log.close()
+        if self.journal_run:
+            self.journal_run.close(status)
+        self.close_query()
+
+    def close_query(self):
+        if isinstance(self.query, CopyLoad):
+            # Unmapped between runs so the data file can be replaced.
+            self.query.close()
+
+    def cancel(self):
+        # Sending the server-side cancels can take a moment; keep it off the GUI thread.
+        threading.Thread(target=self.control.cancel, daemon=True).start()
+
+    def report_outcome(self, outcome):
+        self.run_log.record(outcome)
+        if self.journal_run:
+            self.journal_run.record(outcome)
+        if self.eta:
+            self.eta.finished(outcome)
+        self.database_finished.emit(outcome)
+
+    def report_limit(self, server, before, after, reason):
+        self.query_executed.emit(f"Parallel limit on {server}: {before} -> {after} ({reason}).")
+
+    def report_summary(self, outcomes):
+        if self.catalog:
+            servers = {server['name']: server for server, _ in self.targets}
+            self.catalog.record_durations(servers, outcomes)
+            self.catalog.forget_fingerprints(servers, outcomes)
+        self.query_executed.emit(f"{patchrun.summarize(outcomes)} Run log: {self.run_log.run_id} in {self.run_log.path}")
+        if self.limits:
+            self.query_executed.emit(f"Adaptive parallel limit: {self.limits.summary()}")
+        if self.control.cancelled:
+            self.query_executed.emit("\n".join(patchrun.cancellation_report(outcomes)))
+        if self.metrics:
+            try:
+                self.metrics.write_textfile()
+            except OSError as e:
+                self.query_executed.emit(f"Could not write {METRICS_FILE}: {e}")
+
+class AsyncDatabaseThread(DatabaseThread):
+    engine = ENGINE_ASYNCIO
+
+    def execute_query(self):
+        status = None
+        try:
+            self.schedule()
+            if not self.check_patch():
+                return
+            self.begin_run()
+            outcomes = patchrun.run_patch_async(self.targets, self.query, self.concurrency,
+                                                self.report_outcome, self.patch_ledger, self.metrics, self.options,
+                                                self.control, self.limits, self.report_start)
+            status = CANCELLED if self.control.cancelled else FINISHED
+        except ImportError:
+            self.error_occurred.emit("The Asyncio engine requires the asyncpg package (pip install asyncpg).")
+            return
+        except Exception as e:
+            self.error_occurred.emit(f"Error running patch: {str(e)}")
+            return
+        finally:
+            self.close_run(status)
+        self.report_summary(outcomes)
+
+class ReadQueryThread(DatabaseThread):
+    # Collects the rows of a read-only query from every target into sink (a ResultSpool
+    # or a gather.Aggregation) instead of patching; with order the spooled rows are
+    # merged on that key at the end. The final ResultSpool goes out with results_ready.
+    results_ready = pyqtSignal(object)
+
+    def __init__(self, servers, pool, query, targets, concurrency, sink, metrics=None, options=None, order=None):
+        super().__init__(servers, pool, query, targets, concurrency, metrics=metrics, options=options)
+        self.sink = sink
+        self.order = order
+
+    def execute_query(self):
+        self.run_log = RunLog(hash_patch(self.query))
+        try:
+            outcomes = resultset.run_read_query(self.pool, self.targets, self.query, self.concurrency, self.sink,
+                                                self.report_outcome, self.metrics, self.options, self.control)
+        except Exception as e:
+            self.error_occurred.emit(f"Error running read query: {str(e)}")
+            return
+        finally:
+            self.close_run()
+        self.query_executed.emit(f"{resultset.summarize(outcomes, self.sink)} "
+                                 f"Run log: {self.run_log.run_id} in {self.run_log.path}")
+        try:
+            self.results_ready.emit(gathered(self.sink, self.order))
+        except ValueError as e:
+            self.error_occurred.emit(f"Error merging results: {str(e)}")
@@ -0,0 +1,98 @@
+import threading
+from statistics import median
+from patchrun import server_concurrency
+
+# Longest-job-first ordering of patch targets and a run ETA. With databases patched
+# in parallel the run lasts at least as long as its slowest database, so the big
+# ones are dispatched first and the small ones fill the gaps around them instead
+# of one 200 GB tenant starting last and running alone.
+#
+# A database's expected duration is its remembered duration from earlier runs
+# (DatabaseCatalog.history), else its size times the median seconds per byte of the
+# databases that have both, else the median remembered duration. Without any
+# durations the order falls back to size alone.
+
+
+def estimate_durations(targets, history):
+    # Maps (server name, database) to expected seconds, or None when nothing is known.
+    known = [(seconds, size) for seconds, size in history.values() if seconds is not None]
+    rates = [seconds / size for seconds, size in known if size]
+    rate = median(rates) if rates else None
+    fallback = median(seconds for seconds, _ in known) if known else None
+    estimates = {}
+    for server, db in targets:
+        seconds, size = history.get((server['name'], db), (None, None))
+        if seconds is None and size and rate is not None:
+            seconds = size * rate
+        estimates[(server['name'], db)] = seconds if seconds is not None else fallback
+    return estimates
+
+
+def longest_first(targets, history):
+    # Returns (targets reordered, estimates). Ties and unknowns keep their order.
+    estimates = estimate_durations(targets, history)
+    if any(seconds is not None for seconds in estimates.values()):
+        def expected(target):
+            return estimates[(target[0]['name'], target[1])] or 0.0
+    else:
+        def expected(target):
+            return history.get((target[0]['name'], target[1]), (None, None))[1] or 0
+    return sorted(targets, key=expected, reverse=True), estimates
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return '-'
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class RunEta:
+    # Remaining time of a run from the estimates of the databases not finished yet,
+    # spread over each server's parallel slots. The estimates are scaled by how the
+    # finished databases compared with theirs (this patch may be faster or slower
+    # than earlier ones); databases without an estimate count as the mean so far.
+    # finished() is called by the run, seconds_left() from any thread.
+    def __init__(self, targets, estimates, concurrency):
+        self.lock = threading.Lock()
+        self.pending = {(server['name'], db): estimates.get((server['name'], db)) for server, db in targets}
+        self.parallel = {server['name']: server_concurrency(server, concurrency) for server, _ in targets}
+        self.actual = 0.0
+        self.estimated = 0.0
+        self.finished_count = 0
+        self.finished_seconds = 0.0
+
+    def finished(self, outcome):
+        with self.lock:
+            estimate = self.pending.pop((outcome.server, outcome.database), None)
+            if outcome.skipped or outcome.cancelled:
+                return
+            self.finished_count += 1
+            self.finished_seconds += outcome.elapsed
+            if estimate:
+                self.actual += outcome.elapsed
+                self.estimated += estimate
+
+    def seconds_left(self):
+        with self.lock:
+            scale = self.actual / self.estimated if self.estimated else 1.0
+            mean = self.finished_seconds / self.finished_count if self.finished_count else None
+            work = {}
+            count = {}
+            longest = {}
+            for (server, _), estimate in self.pending.items():
+                seconds = estimate * scale if estimate is not None else mean
+                if seconds is None:
+                    return None
+                work[server] = work.get(server, 0.0) + seconds
+                count[server] = count.get(server, 0) + 1
+                longest[server] = max(longest.get(server, 0.0), seconds)
+            if not work:
+                return 0.0
+            # No server can finish before its longest remaining database does.
+            return max(max(work[server] / min(self.parallel[server], count[server]), longest[server])
+                       for server in work)
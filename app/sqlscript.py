@@ -0,0 +1,257 @@
+import os
+import re
+
+# Incremental SQL script splitting, so that patch files of any size can be sent to
+# the server statement batch by statement batch without ever being held in memory
+# as a whole. Understands quoted strings, E'' escape strings, quoted identifiers,
+# dollar quoting, -- line comments and nested /* */ block comments.
+
+CHUNK_SIZE = 1024 * 1024
+BATCH_SIZE = 1024 * 1024
+# Starts on a new line so that a statement ending in a -- comment still ends there.
+BATCH_SEPARATOR = "\n;\n"
+
+NORMAL = 0
+SINGLE_QUOTE = 1
+ESCAPE_QUOTE = 2
+DOUBLE_QUOTE = 3
+DOLLAR_QUOTE = 4
+LINE_COMMENT = 5
+BLOCK_COMMENT = 6
+
+_NORMAL_TOKEN = re.compile(r"[;'\"$]|--|/\*")
+_NON_SPACE = re.compile(r"\S")
+_DOLLAR_TAG = re.compile(r"\$(?:[A-Za-z_\u0080-\uffff][A-Za-z0-9_\u0080-\uffff]*)?\$")
+_PARTIAL_DOLLAR_TAG = re.compile(r"\$[A-Za-z0-9_\u0080-\uffff]*")
+_ESCAPE_TOKEN = re.compile(r"\\.|'", re.S)
+_BLOCK_TOKEN = re.compile(r"/\*|\*/")
+_LEADING_COMMENTS = re.compile(r"(?:\s+|--[^\n]*|/\*.*?\*/)*", re.S)
+# Statements that begin, end or commit a transaction. ROLLBACK TO SAVEPOINT stays
+# inside the transaction and is not one of them.
+_TRANSACTION_CONTROL = re.compile(
+    r"(?:begin|start\s+transaction|commit|end|abort|prepare\s+transaction"
+    r"|rollback(?!\s+(?:(?:work|transaction)\s+)?to\b))\b",
+    re.IGNORECASE
+)
+
+
+def _is_identifier_char(char):
+    return char.isalnum() or char in '_$'
+
+
+class StatementSplitter:
+    # feed() text in arbitrary pieces and collect the completed statements; call
+    # finish() at the end for whatever follows the last semicolon. Only the
+    # statement currently being read is buffered.
+    def __init__(self):
+        self.buffer = ''
+        self.pos = 0
+        self.state = NORMAL
+        self.tag = None
+        self.depth = 0
+        self.has_code = False
+
+    def feed(self, text):
+        self.buffer += text
+        return self._split(final=False)
+
+    def finish(self):
+        statements = self._split(final=True)
+        if self.has_code:
+            statements.append(self.buffer.strip())
+        self.buffer = ''
+        self.pos = 0
+        self.has_code = False
+        return statements
+
+    def _split(self, final):
+        buf = self.buffer
+        pos = self.pos
+        start = 0
+        statements = []
+        while True:
+            if self.state == NORMAL:
+                match = _NORMAL_TOKEN.search(buf, pos)
+                if match:
+                    end = match.start()
+                elif not final and buf.endswith(('-', '/')):
+                    # A trailing '-' or '/' may start a comment completed by the next chunk.
+                    end = len(buf) - 1
+                else:
+                    end = len(buf)
+                if not self.has_code and _NON_SPACE.search(buf, pos, end):
+                    self.has_code = True
+                if not match:
+                    pos = end
+                    break
+                token = match.group()
+                if token == ';':
+                    if self.has_code:
+                        statements.append(buf[start:match.start()].strip())
+                    self.has_code = False
+                    start = pos = match.end()
+                elif token == "'":
+                    self.has_code = True
+                    before = buf[match.start() - 1] if match.start() > start else ''
+                    before2 = buf[match.start() - 2] if match.start() - 1 > start else ''
+                    if before in ('e', 'E') and not _is_identifier_char(before2):
+                        self.state = ESCAPE_QUOTE
+                    else:
+                        self.state = SINGLE_QUOTE
+                    pos = match.end()
+                elif token == '"':
+                    self.has_code = True
+                    self.state = DOUBLE_QUOTE
+                    pos = match.end()
+                elif token == '--':
+                    self.state = LINE_COMMENT
+                    pos = match.end()
+                elif token == '/*':
+                    self.state = BLOCK_COMMENT
+                    self.depth = 1
+                    pos = match.end()
+                else:
+                    self.has_code = True
+                    before = buf[match.start() - 1] if match.start() > start else ''
+                    dollar = _DOLLAR_TAG.match(buf, match.start())
+                    if _is_identifier_char(before):
+                        pos = match.end()
+                    elif dollar:
+                        self.state = DOLLAR_QUOTE
+                        self.tag = dollar.group()
+                        pos = dollar.end()
+                    elif not final and _PARTIAL_DOLLAR_TAG.fullmatch(buf, match.start()):
+                        pos = match.start()
+                        break
+                    else:
+                        pos = match.end()
+            elif self.state in (SINGLE_QUOTE, DOUBLE_QUOTE):
+                quote = "'" if self.state == SINGLE_QUOTE else '"'
+                index = buf.find(quote, pos)
+                if index < 0:
+                    pos = len(buf)
+                    break
+                if index + 1 == len(buf) and not final:
+                    # Could be the first half of a doubled quote.
+                    pos = index
+                    break
+                if index + 1 < len(buf) and buf[index + 1] == quote:
+                    pos = index + 2
+                else:
+                    self.state = NORMAL
+                    pos = index + 1
+            elif self.state == ESCAPE_QUOTE:
+                match = _ESCAPE_TOKEN.search(buf, pos)
+                if not match:
+                    pos = len(buf) - 1 if buf.endswith('\\') and not final else len(buf)
+                    break
+                if match.group() != "'":
+                    pos = match.end()
+                elif match.end() == len(buf) and not final:
+                    pos = match.start()
+                    break
+                elif match.end() < len(buf) and buf[match.end()] == "'":
+                    pos = match.end() + 1
+                else:
+                    self.state = NORMAL
+                    pos = match.end()
+            elif self.state == LINE_COMMENT:
+                index = buf.find('\n', pos)
+                if index < 0:
+                    pos = len(buf)
+                    break
+                self.state = NORMAL
+                pos = index + 1
+            elif self.state == BLOCK_COMMENT:
+                match = _BLOCK_TOKEN.search(buf, pos)
+                if not match:
+                    pos = len(buf) - 1 if not final and buf.endswith(('/', '*')) else len(buf)
+                    break
+                self.depth += 1 if match.group() == '/*' else -1
+                if self.depth == 0:
+                    self.state = NORMAL
+                pos = match.end()
+            else:
+                index = buf.find(self.tag, pos)
+                if index < 0:
+                    pos = max(pos, len(buf) - len(self.tag) + 1)
+                    break
+                self.state = NORMAL
+                pos = index + len(self.tag)
+            if pos >= len(buf):
+                break
+        self.buffer = buf[start:]
+        self.pos = pos - start
+        return statements
+
+
+def iter_statements(chunks):
+    splitter = StatementSplitter()
+    for chunk in chunks:
+        yield from splitter.feed(chunk)
+    yield from splitter.finish()
+
+
+def strip_leading_comments(statement):
+    return statement[_LEADING_COMMENTS.match(statement).end():]
+
+
+def controls_transaction(statement):
+    # Whether a top-level statement (as split by StatementSplitter) begins, ends or
+    # commits a transaction; BEGIN inside a DO block or function body is not one.
+    return _TRANSACTION_CONTROL.match(strip_leading_comments(statement)) is not None
+
+
+def find_transaction_control(statements):
+    # The first statement that controls the transaction, without its leading
+    # comments, or None.
+    for statement in statements:
+        if controls_transaction(statement):
+            return strip_leading_comments(statement)
+    return None
+
+
+def iter_batches(statements, batch_size=BATCH_SIZE):
+    # Groups statements into multi-statement strings of roughly batch_size characters
+    # so a large script costs a handful of round trips, not one per statement.
+    batch = []
+    size = 0
+    for statement in statements:
+        batch.append(statement)
+        size += len(statement)
+        if size >= batch_size:
+            yield BATCH_SEPARATOR.join(batch)
+            batch = []
+            size = 0
+    if batch:
+        yield BATCH_SEPARATOR.join(batch)
+
+
+class PatchFile:
+    # A patch that stays on disk. Every database re-reads it in CHUNK_SIZE pieces,
+    # so client memory is bounded by chunk size plus the largest single statement.
+    def __init__(self, path, chunk_size=CHUNK_SIZE, batch_size=BATCH_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.content_hash = None
+
+    def __str__(self):
+        return self.path
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def chunks(self):
+        with open(self.path, 'r', encoding='utf-8-sig') as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def statements(self):
+        return iter_statements(self.chunks())
+
+    def batches(self):
+        return iter_batches(self.statements(), self.batch_size)
@@ -1,25 +1,46 @@
+import os
 import sys
 import re
+import time
 import psycopg2
+import atexit
 import logging
-from PyQt5.QtWidgets import (QApplication,QGridLayout, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QListWidget, QAbstractItemView, QPushButton, QTextEdit, QMessageBox)
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from PyQt5.QtWidgets import (QApplication,QGridLayout, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QListWidget, QAbstractItemView, QPushButton, QTextEdit, QMessageBox, QSpinBox)
 from PyQt5.QtCore import QThread, pyqtSignal
 
+# Per-database results go to the same structured run log as the app/ GUI and CLI.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app'))
+from patchrun import Outcome, error_sqlstate
+from ledger import hash_patch
+from runlog import RunLog
+
 pgcon_path = r'C:\Users\sultan.m\Documents\Ginesys\PatchRun\pgcon.txt'
+DEFAULT_CONCURRENCY = 8
+MAX_CONCURRENCY = 64
 
-# Configure logging
-logging.basicConfig(filename='app.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Configure logging. Workers only enqueue records; the listener thread writes app.log.
+log_file_handler = logging.FileHandler('app.log')
+log_file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+log_queue = SimpleQueue()
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+log_listener = QueueListener(log_queue, log_file_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 class DatabaseWorker(QThread):
     databases_fetched = pyqtSignal(list)
-    query_executed = pyqtSignal(list)
+    query_executed = pyqtSignal(str)
 
-    def __init__(self, operation, credentials, query=None, databases=None):
+    def __init__(self, operation, credentials, query=None, databases=None, concurrency=1):
         super().__init__()
         self.operation = operation
         self.credentials = credentials
         self.query = query
         self.databases = databases
+        self.concurrency = max(1, concurrency)
 
     def run(self):
         if self.operation == 'fetch':
@@ -47,27 +68,54 @@ class DatabaseWorker(QThread):
             logging.error(f"Error fetching databases: {e}")
             self.databases_fetched.emit([])
 
-    def execute_query(self):
-        results = []
-        for db in self.databases:
+    def apply_patch(self, db):
+        # Returns an Outcome with the phase timings, as patchrun does, for the run log.
+        server = self.credentials['host']
+        started = time.perf_counter()
+        connect_time = execute_time = commit_time = rows = None
+        try:
+            conn = psycopg2.connect(
+                dbname=db,
+                host=self.credentials['host'],
+                port=self.credentials['port'],
+                user=self.credentials['user'],
+                password=self.credentials['password']
+            )
+            connect_time = time.perf_counter() - started
             try:
-                conn = psycopg2.connect(
-                    dbname=db,
-                    host=self.credentials['host'],
-                    port=self.credentials['port'],
-                    user=self.credentials['user'],
-                    password=self.credentials['password']
-                )
                 cursor = conn.cursor()
+                phase = time.perf_counter()
                 cursor.execute(self.query)
+                execute_time = time.perf_counter() - phase
+                rows = max(cursor.rowcount, 0)
+                phase = time.perf_counter()
                 conn.commit()
+                commit_time = time.perf_counter() - phase
                 cursor.close()
+            finally:
                 conn.close()
-                results.append(f'Patch successfully applied to database {db}.')
-            except Exception as e:
-                logging.error(f"Error executing query on database {db}: {e}")
-                results.append(f"Error executing query on database {db}: {str(e)}")
-        self.query_executed.emit(results)
+        except Exception as e:
+            return Outcome(server, db, False, time.perf_counter() - started, str(e), False,
+                           connect_time, execute_time, commit_time, rows, error_sqlstate(e))
+        return Outcome(server, db, True, time.perf_counter() - started, '', False,
+                       connect_time, execute_time, commit_time, rows)
+
+    def execute_query(self):
+        run_log = RunLog(hash_patch(self.query))
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                futures = [executor.submit(self.apply_patch, db) for db in self.databases]
+                for future in as_completed(futures):
+                    outcome = future.result()
+                    run_log.record(outcome)
+                    if outcome.ok:
+                        self.query_executed.emit(f'Patch successfully applied to database {outcome.database}.')
+                    else:
+                        logging.error(f"Error executing query on database {outcome.database}: {outcome.error}")
+                        self.query_executed.emit(f"Error executing query on database {outcome.database}: {outcome.error}")
+        finally:
+            run_log.close()
+        self.query_executed.emit(f"Run log: {run_log.run_id} in {run_log.path}")
 
 class MainWindow(QWidget):
     def __init__(self):
@@ -107,6 +155,13 @@ class MainWindow(QWidget):
         grid_layout.addWidget(self.pgPasswordLabel, 1, 2)
         grid_layout.addWidget(self.pgPasswordInput, 1, 3)
 
+        self.concurrencyLabel = QLabel('Parallel:')
+        self.concurrencyInput = QSpinBox()
+        self.concurrencyInput.setRange(1, MAX_CONCURRENCY)
+        self.concurrencyInput.setValue(DEFAULT_CONCURRENCY)
+        grid_layout.addWidget(self.concurrencyLabel, 2, 0)
+        grid_layout.addWidget(self.concurrencyInput, 2, 1)
+
         # Layout for database select lists
         self.db_list_widget = QListWidget()
         self.db_list_widget.setSelectionMode(QAbstractItemView.MultiSelection)
@@ -195,13 +250,15 @@ class MainWindow(QWidget):
             'user': self.pgUserInput.text(),
             'password': self.pgPasswordInput.text()
         }
-        self.query_worker = DatabaseWorker(operation='execute', credentials=credentials, query=query, databases=selected_dbs)
+        self.query_worker = DatabaseWorker(operation='execute', credentials=credentials, query=query, databases=selected_dbs, concurrency=self.concurrencyInput.value())
         self.query_worker.query_executed.connect(self.onQueryExecuted)
+        self.query_worker.finished.connect(self.onQueryFinished)
         self.query_worker.start()
 
-    def onQueryExecuted(self, results):
-        for result in results:
-            self.logWindow.append(result)
+    def onQueryExecuted(self, result):
+        self.logWindow.append(result)
+
+    def onQueryFinished(self):
         logging.info("Query executed. Check the log window for results.")
 
 if __name__ == '__main__':
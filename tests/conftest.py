@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The application modules are flat scripts that import their siblings.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
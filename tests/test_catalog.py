@@ -0,0 +1,44 @@
+import patchrun
+from catalog import DatabaseCatalog
+
+SERVER = patchrun.make_server('fake', 5432, 'u', 'p')
+
+
+class TracingCatalog(DatabaseCatalog):
+    # Records the statements of every connection, to see which rows store() writes.
+    def __init__(self, path):
+        self.statements = []
+        super().__init__(path)
+
+    def connect(self):
+        conn = super().connect()
+        conn.set_trace_callback(self.statements.append)
+        return conn
+
+
+def writes(statements, verb):
+    return [statement for statement in statements if statement.startswith(verb) and 'databases' in statement]
+
+
+def test_store_writes_only_changed_rows(tmp_path):
+    catalog = TracingCatalog(str(tmp_path / 'catalog.db'))
+    rows = [('tenant_a', 100, 'UTF8'), ('tenant_b', 200, 'UTF8'), ('tenant_c', 300, 'UTF8')]
+    assert catalog.store(SERVER, rows) == ({'tenant_a', 'tenant_b', 'tenant_c'}, set())
+    assert len(writes(catalog.statements, 'INSERT OR REPLACE INTO databases')) == 3
+
+    catalog.statements.clear()
+    added, removed = catalog.store(SERVER, [('tenant_a', 100, 'UTF8'), ('tenant_b', 250, 'UTF8'),
+                                            ('tenant_d', 400, 'UTF8')])
+    assert (added, removed) == ({'tenant_d'}, {'tenant_c'})
+    upserts = writes(catalog.statements, 'INSERT OR REPLACE INTO databases')
+    assert len(upserts) == 2
+    assert any("'tenant_b'" in statement for statement in upserts)
+    assert any("'tenant_d'" in statement for statement in upserts)
+    assert len(writes(catalog.statements, 'DELETE FROM databases')) == 1
+
+    catalog.statements.clear()
+    catalog.store(SERVER, [('tenant_a', 100, 'UTF8'), ('tenant_b', 250, 'UTF8'), ('tenant_d', 400, 'UTF8')])
+    assert writes(catalog.statements, 'INSERT OR REPLACE INTO databases') == []
+    assert writes(catalog.statements, 'DELETE FROM databases') == []
+    cached = [(entry.name, entry.size) for entry in catalog.cached(SERVER)]
+    assert sorted(cached) == [('tenant_a', 100), ('tenant_b', 250), ('tenant_d', 400)]
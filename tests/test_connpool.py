@@ -0,0 +1,74 @@
+import patchrun
+from bench import FakeServer
+from connpool import ConnectionPool
+
+
+def fake_server(databases, **kwargs):
+    # No latency and no failures unless asked for.
+    return FakeServer(databases, 0, 0, 0, 0, kwargs.pop('failure_rate', 0.0), seed=1, **kwargs)
+
+
+def counting_pool(fake, **kwargs):
+    connects = []
+
+    def connect(**params):
+        connects.append(params['dbname'])
+        return fake.connect(**params)
+    return ConnectionPool(connect=connect, **kwargs), connects
+
+
+SERVER = patchrun.make_server('fake', 5432, 'u', 'p')
+
+
+def test_connections_beyond_concurrency_are_reused_on_the_next_run():
+    fake = fake_server(50)
+    pool, connects = counting_pool(fake)
+    targets = [(SERVER, db) for db in fake.databases]
+    try:
+        first = patchrun.run_patch(pool, targets, 'UPDATE t SET a = 1', 8)
+        assert all(outcome.ok for outcome in first)
+        assert len(connects) == 50
+        assert fake.open == 50
+        second = patchrun.run_patch(pool, targets, 'UPDATE t SET a = 1', 8)
+        assert all(outcome.ok for outcome in second)
+        assert len(connects) == 50
+    finally:
+        pool.close_all()
+    assert fake.open == 0
+
+
+def test_idle_connections_are_capped_per_server():
+    fake = fake_server(10)
+    pool, connects = counting_pool(fake, idle_per_server=4)
+    try:
+        patchrun.run_patch(pool, [(SERVER, db) for db in fake.databases], 'UPDATE t SET a = 1', 2)
+        assert fake.open == 4
+    finally:
+        pool.close_all()
+
+
+def test_connection_limit_frees_idle_connections_for_retries():
+    fake = fake_server(30, max_connections=10)
+    pool, _ = counting_pool(fake)
+    options = patchrun.PatchOptions(max_retries=3, retry_backoff=0.001)
+    try:
+        outcomes = patchrun.run_patch(pool, [(SERVER, db) for db in fake.databases], 'UPDATE t SET a = 1', 4,
+                                      options=options)
+        assert all(outcome.ok for outcome in outcomes)
+        assert any(outcome.attempts > 1 for outcome in outcomes)
+    finally:
+        pool.close_all()
+
+
+def test_unhealthy_idle_connection_is_replaced():
+    fake = fake_server(1)
+    pool, connects = counting_pool(fake)
+    try:
+        with pool.connection(SERVER, 'tenant_00000') as conn:
+            pass
+        conn.close()
+        with pool.connection(SERVER, 'tenant_00000') as again:
+            assert again is not conn
+        assert len(connects) == 2
+    finally:
+        pool.close_all()
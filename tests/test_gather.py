@@ -0,0 +1,46 @@
+import pytest
+from resultset import ResultSpool
+from gather import parse_order, merge_spool
+
+
+def spool_of(databases):
+    spool = ResultSpool(page_size=3)
+    for db, rows in databases.items():
+        segment = spool.segment('main', db)
+        segment.add(['name', 'id'], rows)
+        segment.commit()
+    return spool
+
+
+def merged_rows(spool, order):
+    merged = merge_spool(spool, parse_order(order))
+    try:
+        return [row[2:] for page in range(merged.page_count()) for row in merged.page(page)]
+    finally:
+        merged.close()
+
+
+@pytest.mark.parametrize('order, databases, expected', [
+    ('id', {'a': [['x', 1], ['y', 4]], 'b': [['z', 2], ['w', 3]]}, [['x', 1], ['z', 2], ['w', 3], ['y', 4]]),
+    # NULLs first when descending, as in PostgreSQL.
+    ('id DESC', {'a': [['y', 4], ['x', 1]], 'b': [[None, None], ['w', 3]]},
+     [[None, None], ['y', 4], ['w', 3], ['x', 1]]),
+    # COLLATE "C" order: upper case before lower case.
+    ('name', {'a': [['B', 1], ['a', 2]], 'b': [['C', 3], ['b', 4]]}, [['B', 1], ['C', 3], ['a', 2], ['b', 4]]),
+])
+def test_merge(order, databases, expected):
+    spool = spool_of(databases)
+    try:
+        assert merged_rows(spool, order) == expected
+    finally:
+        spool.close()
+
+
+def test_text_key_in_collation_order_is_refused():
+    # ORDER BY name under en_US.UTF-8 returns 'a' before 'B'.
+    spool = spool_of({'a': [['a', 1], ['B', 2]]})
+    try:
+        with pytest.raises(ValueError, match='COLLATE "C"'):
+            merged_rows(spool, 'name')
+    finally:
+        spool.close()
@@ -0,0 +1,66 @@
+import pytest
+import patchrun
+from bench import FakeServer
+from connpool import ConnectionPool
+from journal import RunJournal, FINISHED, resume_plan, run_settings, skips_committed
+from ledger import PatchLedger, hash_patch
+from patchrun import Outcome, PatchOptions
+
+PATCH = 'UPDATE t SET a = 1'
+SERVER = patchrun.make_server('fake', 5432, 'u', 'p')
+NAME = SERVER['name']
+DATABASES = ['tenant_a', 'tenant_b', 'tenant_c', 'tenant_d', 'tenant_e']
+
+
+def journaled_run(tmp_path):
+    journal = RunJournal(str(tmp_path / 'journal.db'))
+    targets = [(SERVER, db) for db in DATABASES]
+    settings = run_settings(4, 'threads', PatchOptions())
+    run = journal.begin('run-1', PATCH, hash_patch(PATCH), targets, settings)
+    return journal, run
+
+
+def test_resume_plan_splits_unfinished_from_started(tmp_path):
+    journal, run = journaled_run(tmp_path)
+    run.record(Outcome(NAME, 'tenant_a', True, 0.1, ''))
+    run.record(Outcome(NAME, 'tenant_b', False, 0.1, 'syntax error', sqlstate='42601'))
+    run.started(NAME, 'tenant_c')
+    run.record(Outcome(NAME, 'tenant_d', False, 0.0, 'Cancelled before it started', cancelled=patchrun.NOT_STARTED))
+    # tenant_e stays planned; the process "crashes" without closing the run.
+    pending, started = resume_plan(journal, journal.last_run(), [SERVER])
+    assert pending == [(SERVER, 'tenant_d'), (SERVER, 'tenant_e')]
+    assert started == [(SERVER, 'tenant_c')]
+    run.close()
+
+
+def test_resume_plan_matches_servers_by_host_and_port(tmp_path):
+    journal, run = journaled_run(tmp_path)
+    run.close()
+    renamed = patchrun.make_server('fake', 5432, 'u', 'new password', name='renamed')
+    pending, started = resume_plan(journal, journal.last_run(), [renamed])
+    assert pending == [(renamed, db) for db in DATABASES]
+    assert started == []
+    with pytest.raises(ValueError, match='not configured'):
+        resume_plan(journal, journal.last_run(), [patchrun.make_server('other', 5432, 'u', 'p')])
+
+
+def test_a_finished_run_has_nothing_to_resume(tmp_path):
+    fake = FakeServer(len(DATABASES), 0, 0, 0, 0, 0.0, seed=1)
+    pool = ConnectionPool(connect=fake.connect)
+    journal = RunJournal(str(tmp_path / 'journal.db'))
+    targets = [(SERVER, db) for db in fake.databases]
+    run = journal.begin('run-1', PATCH, hash_patch(PATCH), targets, run_settings(2, 'threads', PatchOptions()))
+    try:
+        patchrun.run_patch(pool, targets, PATCH, 2, on_result=run.record, on_start=run.started)
+    finally:
+        pool.close_all()
+    run.close(FINISHED)
+    assert journal.last_run().status == FINISHED
+    assert resume_plan(journal, journal.last_run(), [SERVER]) == ([], [])
+
+
+def test_only_the_in_database_ledger_protects_started_databases(tmp_path):
+    path = str(tmp_path / 'ledger.db')
+    for in_database, skip_applied, protected in [(True, True, True), (True, False, False), (False, True, False)]:
+        settings = run_settings(4, 'threads', PatchOptions(), PatchLedger(path, in_database, skip_applied))
+        assert bool(skips_committed(settings)) is protected
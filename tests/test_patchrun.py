@@ -0,0 +1,105 @@
+import threading
+import patchrun
+from bench import FakeServer
+from connpool import ConnectionPool
+from ledger import PatchLedger
+from patchrun import PatchOptions, RunControl, NOT_STARTED, ROLLED_BACK, LOCK_NOT_AVAILABLE
+
+PATCH = 'UPDATE t SET a = 1'
+SERVER = patchrun.make_server('fake', 5432, 'u', 'p')
+
+
+def fake_run(databases, execute_ms=0, failure_rate=0.0):
+    # A fake server, its targets and a pool that counts the patches sent to it.
+    fake = FakeServer(databases, 0, execute_ms, 0, 0, failure_rate, seed=1)
+    targets = [(SERVER, db) for db in fake.databases]
+    return fake, targets, ConnectionPool(connect=fake.connect)
+
+
+def retrying(max_retries):
+    return PatchOptions(max_retries=max_retries, retry_backoff=0.001)
+
+
+def test_lock_timeouts_are_retried_until_they_succeed():
+    fake, targets, pool = fake_run(40, failure_rate=0.3)
+    try:
+        outcomes = patchrun.run_patch(pool, targets, PATCH, 8, options=retrying(20))
+    finally:
+        pool.close_all()
+    assert sorted(outcome.database for outcome in outcomes) == fake.databases
+    assert all(outcome.ok for outcome in outcomes)
+    assert any(outcome.attempts > 1 for outcome in outcomes)
+
+
+def test_retries_stop_after_max_retries():
+    fake, targets, pool = fake_run(5, failure_rate=1.0)
+    try:
+        outcomes = patchrun.run_patch(pool, targets, PATCH, 2, options=retrying(2))
+    finally:
+        pool.close_all()
+    assert len(outcomes) == 5
+    assert all(not outcome.ok for outcome in outcomes)
+    assert all(outcome.attempts == 3 for outcome in outcomes)
+    assert all(outcome.sqlstate == LOCK_NOT_AVAILABLE for outcome in outcomes)
+
+
+def test_cancel_reports_committed_rolled_back_and_not_started():
+    # Two databases at a time, 100 ms each: the cancel at 250 ms lands on the third pair.
+    fake, targets, pool = fake_run(10, execute_ms=100)
+    control = RunControl()
+    timer = threading.Timer(0.25, control.cancel)
+    timer.start()
+    try:
+        outcomes = patchrun.run_patch(pool, targets, PATCH, 2, control=control)
+    finally:
+        timer.cancel()
+        pool.close_all()
+    assert sorted(outcome.database for outcome in outcomes) == fake.databases
+    committed = [outcome for outcome in outcomes if outcome.ok]
+    rolled_back = [outcome for outcome in outcomes if outcome.cancelled == ROLLED_BACK]
+    not_started = [outcome for outcome in outcomes if outcome.cancelled == NOT_STARTED]
+    assert committed and rolled_back and not_started
+    assert len(committed) + len(rolled_back) + len(not_started) == 10
+    assert all(outcome.cancelled is None for outcome in committed)
+    assert all(not outcome.ok for outcome in rolled_back + not_started)
+    assert fake.open == 0
+
+
+def test_cancel_before_the_run_starts_nothing():
+    fake, targets, pool = fake_run(6)
+    control = RunControl()
+    control.cancel()
+    try:
+        outcomes = patchrun.run_patch(pool, targets, PATCH, 2, control=control)
+    finally:
+        pool.close_all()
+    assert [outcome.cancelled for outcome in outcomes] == [NOT_STARTED] * 6
+    assert "6 not started" in patchrun.summarize(outcomes)
+
+
+def test_ledger_skips_databases_already_patched(tmp_path):
+    fake, targets, pool = fake_run(5)
+    patch_ledger = PatchLedger(str(tmp_path / 'ledger.db'))
+    try:
+        first = patchrun.run_patch(pool, targets[:3], PATCH, 2, patch_ledger=patch_ledger)
+        second = patchrun.run_patch(pool, targets, PATCH, 2, patch_ledger=patch_ledger)
+        other_patch = patchrun.run_patch(pool, targets[:1], 'UPDATE t SET a = 2', 2, patch_ledger=patch_ledger)
+    finally:
+        pool.close_all()
+    assert all(outcome.ok and not outcome.skipped for outcome in first)
+    skipped = sorted(outcome.database for outcome in second if outcome.skipped)
+    patched = sorted(outcome.database for outcome in second if outcome.ok and not outcome.skipped)
+    assert skipped == fake.databases[:3]
+    assert patched == fake.databases[3:]
+    assert not other_patch[0].skipped
+
+
+def test_forced_run_patches_databases_already_patched(tmp_path):
+    fake, targets, pool = fake_run(3)
+    path = str(tmp_path / 'ledger.db')
+    try:
+        patchrun.run_patch(pool, targets, PATCH, 2, patch_ledger=PatchLedger(path))
+        forced = patchrun.run_patch(pool, targets, PATCH, 2, patch_ledger=PatchLedger(path, skip_applied=False))
+    finally:
+        pool.close_all()
+    assert all(outcome.ok and not outcome.skipped for outcome in forced)
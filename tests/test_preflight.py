@@ -0,0 +1,21 @@
+import pytest
+from preflight import preflight, preflight_passed, preflight_report
+
+SERVER = {'name': 'main', 'host': 'localhost', 'port': 5432, 'user': 'u', 'password': 'p'}
+
+
+class UnusablePool:
+    def connection(self, server, db):
+        raise AssertionError('a refused pre-flight must not connect')
+
+
+@pytest.mark.parametrize('patch', [
+    "BEGIN; UPDATE t SET a = 1; COMMIT;",
+    "UPDATE t SET a = 1;\nCOMMIT;\nUPDATE t2 SET b = 2;",
+    "UPDATE t SET a = 1; END",
+])
+def test_transaction_control_is_refused(patch):
+    report = preflight(UnusablePool(), [(SERVER, 'tenant')], patch, 4)
+    assert report.refused is not None
+    assert not preflight_passed(report)
+    assert 'dry run would commit' in preflight_report(report)[0]
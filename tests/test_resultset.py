@@ -0,0 +1,93 @@
+from contextlib import contextmanager
+from decimal import Decimal
+import pytest
+from resultset import ResultSpool, read_database
+from gather import Aggregation
+
+SERVER = {'name': 'main', 'host': 'localhost', 'port': 5432, 'user': 'u', 'password': 'p'}
+
+
+class FakeCursor:
+    # A named cursor over rows that raises after failing_after fetchmany calls.
+    def __init__(self, rows, failing_after):
+        self.rows = rows
+        self.fetches = 0
+        self.failing_after = failing_after
+        self.description = None
+
+    def execute(self, query, params=None):
+        pass
+
+    def fetchmany(self, size):
+        if self.failing_after is not None and self.fetches >= self.failing_after:
+            raise RuntimeError('canceling statement due to statement timeout')
+        self.fetches += 1
+        self.description = [('status',), ('amount',)]
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, rows, failing_after):
+        self.rows = rows
+        self.failing_after = failing_after
+
+    def cursor(self, name=None):
+        return FakeCursor(list(self.rows), self.failing_after)
+
+    def rollback(self):
+        pass
+
+    def cancel(self):
+        pass
+
+
+class FakePool:
+    def __init__(self, databases):
+        self.databases = databases
+
+    @contextmanager
+    def connection(self, server, db):
+        yield FakeConnection(*self.databases[db])
+
+
+ROWS = [('open', Decimal('1.5')), ('closed', Decimal('2')), ('open', None), ('open', Decimal('3'))]
+
+
+@pytest.mark.parametrize('failing_after', [0, 1, 2])
+def test_failed_database_leaves_no_rows(failing_after):
+    pool = FakePool({'good': (ROWS, None), 'bad': (ROWS, failing_after)})
+    spool = ResultSpool(page_size=2)
+    try:
+        good = read_database(pool, SERVER, 'good', 'SELECT', spool, fetch_size=1)
+        bad = read_database(pool, SERVER, 'bad', 'SELECT', spool, fetch_size=1)
+        assert good.ok and not bad.ok
+        assert spool.row_count == len(ROWS)
+        assert spool.sources() == [('main', 'good')]
+        assert [row[1] for page in range(spool.page_count()) for row in spool.page(page)] == ['good'] * len(ROWS)
+        assert list(spool.stream(('main', 'bad'))) == []
+    finally:
+        spool.close()
+
+
+@pytest.mark.parametrize('failing_after', [0, 1, 3])
+def test_failed_database_leaves_no_aggregates(failing_after):
+    pool = FakePool({'good': (ROWS, None), 'bad': (ROWS, failing_after)})
+    aggregation = Aggregation([('count', None), ('count', 'amount'), ('sum', 'amount'), ('max', 'amount')], ['status'])
+    assert read_database(pool, SERVER, 'good', 'SELECT', aggregation, fetch_size=1).ok
+    assert not read_database(pool, SERVER, 'bad', 'SELECT', aggregation, fetch_size=1).ok
+    assert aggregation.row_count == len(ROWS)
+    assert aggregation.rows() == [['closed', 1, 1, Decimal('2'), Decimal('2')],
+                                  ['open', 3, 2, Decimal('4.5'), Decimal('3')]]
+
+
+def test_aggregates_combine_across_databases():
+    pool = FakePool({'one': (ROWS, None), 'two': (ROWS[:2], None)})
+    aggregation = Aggregation([('count', None), ('sum', 'amount'), ('min', 'amount')], ['status'])
+    for db in ('one', 'two'):
+        assert read_database(pool, SERVER, db, 'SELECT', aggregation, fetch_size=3).ok
+    assert aggregation.rows() == [['closed', 2, Decimal('4'), Decimal('2')],
+                                  ['open', 4, Decimal('6.0'), Decimal('1.5')]]
@@ -0,0 +1,118 @@
+import pytest
+from sqlscript import (StatementSplitter, iter_statements, iter_batches, PatchFile, controls_transaction,
+                       find_transaction_control)
+
+SPLIT_CASES = [
+    # (script, expected statements)
+    ("SELECT 1; SELECT 2", ["SELECT 1", "SELECT 2"]),
+    ("SELECT 1;\n\n  SELECT 2;\n", ["SELECT 1", "SELECT 2"]),
+    ("SELECT 1/2; SELECT 3-1", ["SELECT 1/2", "SELECT 3-1"]),
+    # Quoted strings and identifiers
+    ("SELECT 'a;b', 'it''s'; SELECT 2;", ["SELECT 'a;b', 'it''s'", "SELECT 2"]),
+    ("SELECT 'no\\'; SELECT 3", ["SELECT 'no\\'", "SELECT 3"]),
+    ("SELECT E'a\\';b'; SELECT 2", ["SELECT E'a\\';b'", "SELECT 2"]),
+    ("SELECT e'a''b;c'; SELECT 2", ["SELECT e'a''b;c'", "SELECT 2"]),
+    ("SELECT one'x;'; SELECT 2", ["SELECT one'x;'", "SELECT 2"]),
+    ('SELECT "a;""b"; SELECT 2', ['SELECT "a;""b"', "SELECT 2"]),
+    # Dollar quoting
+    ("SELECT $$a;b$$; SELECT 2", ["SELECT $$a;b$$", "SELECT 2"]),
+    ("DO $body$ BEGIN PERFORM $x$;$x$; END $body$; SELECT 2",
+     ["DO $body$ BEGIN PERFORM $x$;$x$; END $body$", "SELECT 2"]),
+    ("SELECT $a$ $b$; $a$; SELECT 2", ["SELECT $a$ $b$; $a$", "SELECT 2"]),
+    ("SELECT a$b; SELECT 2", ["SELECT a$b", "SELECT 2"]),
+    ("PREPARE p AS SELECT $1; SELECT 2", ["PREPARE p AS SELECT $1", "SELECT 2"]),
+    # Comments
+    ("SELECT 1 -- a;b\n; SELECT 2", ["SELECT 1 -- a;b", "SELECT 2"]),
+    ("SELECT /* a; /* b; */ c; */ 1; SELECT 2", ["SELECT /* a; /* b; */ c; */ 1", "SELECT 2"]),
+    ("SELECT 'a -- b'; SELECT '/* c'; SELECT 2", ["SELECT 'a -- b'", "SELECT '/* c'", "SELECT 2"]),
+    ("-- only a comment;\n;  ; /* x; */ ; SELECT 1", ["SELECT 1"]),
+    ("UPDATE t SET a = 1 -- fix\n;\nUPDATE t2 SET b = 2;", ["UPDATE t SET a = 1 -- fix", "UPDATE t2 SET b = 2"]),
+    # Unterminated input is returned as it is, for the server to reject.
+    ("SELECT 'open; SELECT 2", ["SELECT 'open; SELECT 2"]),
+    ("", []),
+]
+
+
+def split_in_chunks(script, size):
+    splitter = StatementSplitter()
+    statements = []
+    for index in range(0, len(script), size):
+        statements += splitter.feed(script[index:index + size])
+    return statements + splitter.finish()
+
+
+@pytest.mark.parametrize('script, expected', SPLIT_CASES)
+def test_split(script, expected):
+    assert list(iter_statements([script])) == expected
+
+
+@pytest.mark.parametrize('script, expected', SPLIT_CASES)
+def test_split_at_every_chunk_boundary(script, expected):
+    for cut in range(1, len(script)):
+        assert list(iter_statements([script[:cut], script[cut:]])) == expected, cut
+
+
+@pytest.mark.parametrize('script, expected', SPLIT_CASES)
+def test_split_one_character_at_a_time(script, expected):
+    assert split_in_chunks(script, 1) == expected
+
+
+@pytest.mark.parametrize('statements, batch_size, expected', [
+    (["SELECT 1", "SELECT 2"], 1024, ["SELECT 1\n;\nSELECT 2"]),
+    (["SELECT 1", "SELECT 2", "SELECT 3"], 8, ["SELECT 1", "SELECT 2", "SELECT 3"]),
+    (["SELECT 1", "SELECT 2", "SELECT 3"], 16, ["SELECT 1\n;\nSELECT 2", "SELECT 3"]),
+    (["UPDATE t SET a = 1 -- fix", "UPDATE t2 SET b = 2"], 1024,
+     ["UPDATE t SET a = 1 -- fix\n;\nUPDATE t2 SET b = 2"]),
+    ([], 1024, []),
+])
+def test_batches(statements, batch_size, expected):
+    assert list(iter_batches(statements, batch_size)) == expected
+
+
+@pytest.mark.parametrize('script, expected', SPLIT_CASES)
+def test_batches_split_back_into_the_same_statements(script, expected):
+    # A batch is sent as one multi-statement string; the server must see the same statements.
+    for batch_size in (1, 16, 1024):
+        statements = []
+        for batch in iter_batches(iter_statements([script]), batch_size):
+            statements += iter_statements([batch])
+        assert statements == expected, batch_size
+
+
+def test_patch_file_reads_in_chunks(tmp_path):
+    path = tmp_path / 'patch.sql'
+    path.write_text("﻿UPDATE t SET a = 'x;y' -- fix\n;\nDO $$ BEGIN NULL; END $$;\nSELECT 1;\n", encoding='utf-8')
+    patch = PatchFile(str(path), chunk_size=3, batch_size=1024)
+    assert list(patch.statements()) == ["UPDATE t SET a = 'x;y' -- fix", "DO $$ BEGIN NULL; END $$", "SELECT 1"]
+    assert list(patch.batches()) == ["UPDATE t SET a = 'x;y' -- fix\n;\nDO $$ BEGIN NULL; END $$\n;\nSELECT 1"]
+
+
+@pytest.mark.parametrize('statement, expected', [
+    ("BEGIN", True),
+    ("begin transaction isolation level serializable", True),
+    ("START TRANSACTION", True),
+    ("COMMIT", True),
+    ("COMMIT PREPARED 'x'", True),
+    ("PREPARE TRANSACTION 'x'", True),
+    ("END", True),
+    ("ROLLBACK", True),
+    ("rollback work", True),
+    ("ABORT", True),
+    ("-- done\n/* all of it */ COMMIT", True),
+    ("ROLLBACK TO SAVEPOINT before_update", False),
+    ("rollback transaction to before_update", False),
+    ("SAVEPOINT before_update", False),
+    ("RELEASE before_update", False),
+    ("DO $$ BEGIN UPDATE t SET a = 1; END $$", False),
+    ("UPDATE t SET begin = 1", False),
+    ("SELECT endpoint FROM t", False),
+    ("-- COMMIT\nUPDATE t SET a = 1", False),
+])
+def test_controls_transaction(statement, expected):
+    assert controls_transaction(statement) == expected
+
+
+def test_find_transaction_control():
+    script = "UPDATE t SET a = 1; DO $$ BEGIN NULL; END $$; COMMIT; UPDATE t2 SET b = 2;"
+    assert find_transaction_control(iter_statements([script])) == "COMMIT"
+    assert find_transaction_control(iter_statements(["UPDATE t SET a = 'COMMIT';"])) is None